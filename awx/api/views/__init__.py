@@ -27,7 +27,7 @@ from django.utils.safestring import mark_safe
 from django.utils.timezone import now
 from django.views.decorators.csrf import csrf_exempt
 from django.template.loader import render_to_string
-from django.http import HttpResponse
+from django.http import StreamingHttpResponse
 from django.contrib.contenttypes.models import ContentType
 from django.utils.translation import ugettext_lazy as _
 
@@ -59,7 +59,6 @@ from social_core.backends.utils import load_backends
 from oauth2_provider.models import get_access_token_model
 
 import pytz
-from wsgiref.util import FileWrapper
 
 # AWX
 from awx.main.tasks import send_notifications, update_inventory_computed_fields
@@ -4107,39 +4106,6 @@ def redact_ansi(line):
     return re.sub(r'\x1b[^m]*m', '', line)
 
 
-class StdoutFilter(object):
-
-    def __init__(self, fileobj):
-        self._functions = []
-        self.fileobj = fileobj
-        self.extra_data = ''
-        if hasattr(fileobj, 'close'):
-            self.close = fileobj.close
-
-    def read(self, size=-1):
-        data = self.extra_data
-        while size > 0 and len(data) < size:
-            line = self.fileobj.readline(size)
-            if not line:
-                break
-            line = self.process_line(line)
-            data += line
-        if size > 0 and len(data) > size:
-            self.extra_data = data[size:]
-            data = data[:size]
-        else:
-            self.extra_data = ''
-        return data
-
-    def register(self, func):
-        self._functions.append(func)
-
-    def process_line(self, line):
-        for func in self._functions:
-            line = func(line)
-        return line
-
-
 class UnifiedJobStdout(RetrieveAPIView):
 
     authentication_classes = api_settings.DEFAULT_AUTHENTICATION_CLASSES
@@ -4195,13 +4161,14 @@ class UnifiedJobStdout(RetrieveAPIView):
                     pk=unified_job.id,
                     suffix='.ansi' if target_format == 'ansi_download' else ''
                 )
-                content_fd = unified_job.result_stdout_raw_handle(enforce_max_bytes=False)
-                redactor = StdoutFilter(content_fd)
+                # stream the output (and filter it) a line at a time, so that
+                # large downloads don't need to fit in memory
+                lines = unified_job.result_stdout_raw_lines()
                 if target_format == 'txt_download':
-                    redactor.register(redact_ansi)
+                    lines = map(redact_ansi, lines)
                 if type(unified_job) == models.ProjectUpdate:
-                    redactor.register(UriCleaner.remove_sensitive)
-                response = HttpResponse(FileWrapper(redactor), content_type='text/plain')
+                    lines = map(UriCleaner.remove_sensitive, lines)
+                response = StreamingHttpResponse(lines, content_type='text/plain')
                 response["Content-Disposition"] = 'attachment; filename="{}"'.format(filename)
                 return response
             else:
@@ -15,6 +15,7 @@ from rest_framework.exceptions import PermissionDenied
 # AWX
 # from awx.main.analytics import collectors
 from awx.main.analytics.metrics import metrics
+from awx.main.scheduler.profiler import get_cycle_history
 from awx.api import renderers
 
 from awx.api.generics import (
@@ -40,3 +41,14 @@ class MetricsView(APIView):
             return Response(metrics().decode('UTF-8'))
         raise PermissionDenied()
 
+
+class TaskManagerCyclesView(APIView):
+
+    name = _('Task Manager Cycles')
+    swagger_topic = 'Metrics'
+
+    def get(self, request):
+        ''' Show the time and queries spent in each phase of recent task manager cycles '''
+        if (request.user.is_superuser or request.user.is_system_auditor):
+            return Response({'cycles': get_cycle_history()})
+        raise PermissionDenied()
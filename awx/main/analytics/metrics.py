@@ -17,11 +17,13 @@ from awx.main.analytics.collectors import (
     job_instance_counts,
     job_counts,
 )
+from awx.main.analytics.subsystem_metrics import SubsystemMetricsCollector
 
 
 REGISTRY.unregister(PROCESS_COLLECTOR)
 REGISTRY.unregister(PLATFORM_COLLECTOR)
 REGISTRY.unregister(GC_COLLECTOR)
+REGISTRY.register(SubsystemMetricsCollector())
 
 SYSTEM_INFO = Info('awx_system', 'AWX System Information')
 ORG_COUNT = Gauge('awx_organizations_total', 'Number of organizations')
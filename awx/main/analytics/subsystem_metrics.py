@@ -0,0 +1,130 @@
+import logging
+import os
+import time
+
+import redis
+
+from prometheus_client import (
+    generate_latest,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    parser,
+)
+from prometheus_client.samples import Sample
+
+from django.conf import settings
+
+
+SUBSYSTEM_METRICS_REDIS_KEY_PREFIX = 'awx_subsystem_metrics'
+
+
+logger = logging.getLogger('awx.analytics.subsystem_metrics')
+
+
+class SubsystemMetrics():
+    '''
+    Metrics recorded by a single long-running AWX process (e.g., a callback
+    receiver worker or a dispatcher worker).
+
+    Values are kept in a private CollectorRegistry and periodically
+    serialized to redis; awx.main.analytics.metrics merges the values from
+    every process in the cluster into the /api/v2/metrics/ output, labeled
+    with the node and pid that recorded them.
+
+    The stored values expire after `expire` seconds (by default, six times
+    SUBSYSTEM_METRICS_INTERVAL) without being sent again; processes that
+    only send now and then must pass a longer one, or their series will come
+    and go.
+    '''
+
+    def __init__(self, subsystem, expire=None):
+        self.subsystem = subsystem
+        self.expire = expire
+        self.registry = CollectorRegistry()
+        self.last_send = time.time()
+        self._metrics = dict()
+        self._conn = None
+
+    def _name(self, name):
+        return f'awx_{self.subsystem}_{name}'
+
+    def _get_or_create(self, cls, name, description, **kwargs):
+        if name not in self._metrics:
+            self._metrics[name] = cls(self._name(name), description, registry=self.registry, **kwargs)
+        return self._metrics[name]
+
+    def counter(self, name, description, **kwargs):
+        return self._get_or_create(Counter, name, description, **kwargs)
+
+    def gauge(self, name, description, **kwargs):
+        return self._get_or_create(Gauge, name, description, **kwargs)
+
+    def histogram(self, name, description, **kwargs):
+        return self._get_or_create(Histogram, name, description, **kwargs)
+
+    @property
+    def redis_key(self):
+        # computed on every send so that metrics recorded by forked worker
+        # processes are stored under the pid of the child
+        return f'{SUBSYSTEM_METRICS_REDIS_KEY_PREFIX}:{settings.CLUSTER_HOST_ID}:{os.getpid()}:{self.subsystem}'
+
+    def send(self, force=False):
+        interval = settings.SUBSYSTEM_METRICS_INTERVAL
+        if not force and time.time() - self.last_send < interval:
+            return
+        self.last_send = time.time()
+        try:
+            if self._conn is None:
+                self._conn = redis.Redis.from_url(settings.BROKER_URL)
+            # expire the key so that stale data from exited processes
+            # eventually falls out of the metrics output
+            self._conn.set(self.redis_key, generate_latest(self.registry), ex=self.expire or interval * 6)
+        except Exception:
+            logger.exception(f'encountered an error communicating with redis to store {self.subsystem} metrics')
+
+
+def load_subsystem_metrics():
+    '''
+    Read the metrics recorded by every AWX process in the cluster, and return
+    a list of prometheus metric families with `node` and `worker` labels
+    added to each sample
+    '''
+    families = {}
+    try:
+        conn = redis.Redis.from_url(settings.BROKER_URL)
+        for key in conn.scan_iter(f'{SUBSYSTEM_METRICS_REDIS_KEY_PREFIX}:*'):
+            data = conn.get(key)
+            if not data:
+                continue
+            _, node, pid, _ = key.decode('utf-8').split(':', 3)
+            for family in parser.text_string_to_metric_families(data.decode('utf-8')):
+                samples = [
+                    Sample(s.name, dict(s.labels, node=node, worker=pid), s.value, s.timestamp, s.exemplar)
+                    for s in family.samples
+                ]
+                if family.name in families:
+                    families[family.name].samples.extend(samples)
+                else:
+                    family.samples = samples
+                    families[family.name] = family
+    except redis.exceptions.RedisError:
+        logger.exception('encountered an error communicating with redis to load subsystem metrics')
+        return []
+    return list(families.values())
+
+
+class SubsystemMetricsCollector():
+    '''
+    A prometheus collector which exposes the values stored by
+    SubsystemMetrics.send() alongside the rest of the AWX metrics
+    '''
+
+    def describe(self):
+        # prevent the registry from calling collect() (and talking to redis)
+        # at registration time
+        return []
+
+    def collect(self):
+        return load_subsystem_metrics()
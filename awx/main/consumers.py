@@ -13,10 +13,16 @@ from channels.generic.websocket import AsyncJsonWebsocketConsumer
 from channels.layers import get_channel_layer
 from channels.db import database_sync_to_async
 
+from awx.main.utils import codec
+
 
 logger = logging.getLogger('awx.main.consumers')
 XRF_KEY = '_auth_user_xrf'
 
+# events that are sent without their (potentially large) module result to
+# subscribers that have fallen behind
+SUMMARIZED_EVENTS = set(['runner_on_ok', 'runner_item_on_ok'])
+
 
 class WebsocketSecretAuthHelper:
     """
@@ -112,6 +118,10 @@ class BroadcastConsumer(AsyncJsonWebsocketConsumer):
 
 
 class EventConsumer(AsyncJsonWebsocketConsumer):
+    # whether the client has asked to receive batched events as a single
+    # `event_batch` frame (see emit_channel_notification_batch)
+    batch_events = False
+
     async def connect(self):
         user = self.scope['user']
         if user and not user.is_anonymous:
@@ -162,6 +172,9 @@ class EventConsumer(AsyncJsonWebsocketConsumer):
             await self.send_json({"error": "access denied to channel"})
             return
 
+        if 'batch_events' in data:
+            self.batch_events = bool(data['batch_events'])
+
         if 'groups' in data:
             groups = data['groups']
             new_groups = set()
@@ -205,6 +218,22 @@ class EventConsumer(AsyncJsonWebsocketConsumer):
     async def internal_message(self, event):
         await self.send(event['text'])
 
+    async def internal_batch(self, event):
+        messages = event['messages']
+        # `emitted` is always a time on this node's clock; batches relayed
+        # from other nodes are stamped when they're received
+        if time.time() - event['emitted'] > settings.UI_LIVE_UPDATES_MAX_LAG:
+            # this client has fallen behind the event stream; send the
+            # summarized form of noisy events so that it can catch up
+            texts = [summary or text for text, summary in messages]
+        else:
+            texts = [text for text, _ in messages]
+        if self.batch_events:
+            await self.send(_batch_frame(event['group_name'], texts))
+        else:
+            for text in texts:
+                await self.send(text)
+
 
 def run_sync(func):
     event_loop = asyncio.new_event_loop()
@@ -214,12 +243,88 @@ def run_sync(func):
 
 def _dump_payload(payload):
     try:
-        return json.dumps(payload, cls=DjangoJSONEncoder)
+        return codec.dumps(payload, cls=DjangoJSONEncoder)
     except ValueError:
         logger.error("Invalid payload to emit")
         return None
 
 
+def _batch_frame(group_name, texts):
+    # splice the already-serialized events into the frame rather than
+    # decoding and re-encoding them for every client
+    frame = codec.dumps({'type': 'event_batch', 'group_name': group_name, 'events': []})
+    return frame[:-2] + ','.join(texts) + ']}'
+
+
+def _summarize_payload(payload):
+    # the module result is by far the largest part of most events; the full
+    # event is still available from the API
+    event_data = payload.get('event_data') or {}
+    if 'res' in event_data:
+        payload = dict(payload, event_data=dict(event_data, res={}))
+    return payload
+
+
+def _chunk_messages(messages, limit):
+    '''
+    Split serialized [text, summary] messages into lists whose combined size
+    is at most `limit` characters (a single larger message is a list of its
+    own)
+    '''
+    chunk, size = [], 0
+    for message in messages:
+        message_size = sum(len(text) for text in message if text)
+        if chunk and size + message_size > limit:
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(message)
+        size += message_size
+    if chunk:
+        yield chunk
+
+
+def emit_channel_notification_batch(group, payloads):
+    '''
+    Emit several payloads to a group using as few channel layer messages as
+    possible (each at most BROADCAST_WEBSOCKET_BATCH_SIZE characters of
+    events); clients receive them as individual frames or, if they've asked
+    for batches, as one `event_batch` frame per message
+    '''
+    from awx.main.wsbroadcast import wrap_broadcast_msg # noqa
+
+    messages = []
+    for payload in payloads:
+        payload_dumped = _dump_payload(payload)
+        if payload_dumped is None:
+            continue
+        summary = None
+        if payload.get('event') in SUMMARIZED_EVENTS:
+            summary = _dump_payload(_summarize_payload(payload))
+        messages.append([payload_dumped, summary])
+    if not messages:
+        return
+
+    channel_layer = get_channel_layer()
+
+    for chunk in _chunk_messages(messages, settings.BROADCAST_WEBSOCKET_BATCH_SIZE):
+        batch = {
+            "type": "internal.batch",
+            "group_name": payloads[0].get('group_name', group),
+            "emitted": time.time(),
+            "messages": chunk,
+        }
+
+        run_sync(channel_layer.group_send(group, batch))
+
+        run_sync(channel_layer.group_send(
+            settings.BROADCAST_WEBSOCKET_GROUP_NAME,
+            {
+                "type": "internal.message",
+                "text": wrap_broadcast_msg(group, batch),
+            },
+        ))
+
+
 def emit_channel_notification(group, payload):
     from awx.main.wsbroadcast import wrap_broadcast_msg # noqa
 
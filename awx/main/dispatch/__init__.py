@@ -1,10 +1,13 @@
 import psycopg2
+from psycopg2.extras import execute_values
 import select
 
 from contextlib import contextmanager
 
 from django.conf import settings
 
+from awx.main.dispatch.envelope import wrap_payload
+
 
 NOT_READY = ([], [], [])
 
@@ -28,7 +31,47 @@ class PubSub(object):
 
     def notify(self, channel, payload):
         with self.conn.cursor() as cur:
-            cur.execute('SELECT pg_notify(%s, %s);', (channel, payload))
+            cur.execute('SELECT pg_notify(%s, %s);', (channel, wrap_payload(channel, payload)))
+
+    def notify_many(self, notifications, page_size=500):
+        '''
+        Send a list of (channel, payload) notifications, `page_size` of them
+        per round trip.  The payloads must already have been wrapped (see
+        wrap_payload).
+
+        More than one page is sent in a transaction, so that if the
+        connection is lost partway through, none of the notifications are
+        delivered, and all of them can be sent again.
+        '''
+        transactional = len(notifications) > page_size
+        with self.conn.cursor() as cur:
+            if transactional:
+                cur.execute('BEGIN;')
+            try:
+                execute_values(
+                    cur,
+                    'SELECT pg_notify(channel, payload) FROM (VALUES %s) AS notifications (channel, payload);',
+                    notifications,
+                    page_size=page_size
+                )
+            except psycopg2.Error:
+                if transactional and not self.conn.closed:
+                    try:
+                        cur.execute('ROLLBACK;')
+                    except psycopg2.Error:
+                        pass
+                raise
+            if transactional:
+                cur.execute('COMMIT;')
+
+    def queue_usage(self):
+        '''
+        Return the fraction of the database's notification queue in use by
+        notifications that haven't been read by every listener yet
+        '''
+        with self.conn.cursor() as cur:
+            cur.execute('SELECT pg_notification_queue_usage();')
+            return cur.fetchone()[0]
 
     def events(self, select_timeout=5, yield_timeouts=False):
         while True:
@@ -44,8 +87,7 @@ class PubSub(object):
         self.conn.close()
 
 
-@contextmanager
-def pg_bus_conn():
+def connect_pg_bus():
     conf = settings.DATABASES['default']
     conn = psycopg2.connect(dbname=conf['NAME'],
                             host=conf['HOST'],
@@ -55,8 +97,11 @@ def pg_bus_conn():
                             **conf.get("OPTIONS", {}))
     # Django connection.cursor().connection doesn't have autocommit=True on
     conn.set_session(autocommit=True)
-    pubsub = PubSub(conn)
-    yield pubsub
-    conn.close()
+    return PubSub(conn)
 
 
+@contextmanager
+def pg_bus_conn():
+    pubsub = connect_pg_bus()
+    yield pubsub
+    pubsub.close()
@@ -6,6 +6,7 @@ from django.conf import settings
 import redis
 
 from awx.main.dispatch import get_local_queuename
+from awx.main.dispatch.envelope import unwrap_payload
 
 from . import pg_bus_conn
 
@@ -57,7 +58,10 @@ class Control(object):
                     raise RuntimeError(f"{self.service} did not reply within {timeout}s")
                 break
 
-        return json.loads(reply.payload)
+        payload = unwrap_payload(reply.channel, reply.payload)
+        if payload is None:
+            raise RuntimeError(f"the reply from {self.service} could not be loaded")
+        return json.loads(payload)
 
     def control(self, msg, **kwargs):
         with pg_bus_conn() as conn:
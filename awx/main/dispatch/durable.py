@@ -0,0 +1,162 @@
+import json
+import logging
+
+from django.conf import settings
+
+import redis
+
+from awx.main.dispatch.envelope import BROADCAST_QUEUE, get_redis
+
+
+logger = logging.getLogger('awx.main.dispatch')
+
+STREAM_KEY_PREFIX = 'awx_dispatcher_stream'
+
+# the consumer group of every stream; each node reads its own queue's
+# stream, as a consumer named after the node
+GROUP = 'dispatcher'
+
+# notified on a durable queue to let its dispatcher know that there are
+# messages to read from the queue's stream
+DOORBELL = '{"durable": true}'
+
+
+def is_durable(queue):
+    # messages broadcast to every node are still only notified
+    return settings.DISPATCHER_DURABLE_QUEUES and queue != BROADCAST_QUEUE
+
+
+def stream_key(queue):
+    return '{}:{}'.format(STREAM_KEY_PREFIX, queue)
+
+
+def add_messages(notifications):
+    '''
+    Add a list of (queue, payload) messages to the streams of their queues,
+    and return the queues that they were added to.  The oldest messages are
+    trimmed from a stream that grows beyond DISPATCHER_DURABLE_MAXLEN.
+    '''
+    pipe = get_redis().pipeline(transaction=False)
+    queues = []
+    for queue, payload in notifications:
+        # approximate trimming (MAXLEN ~) only removes whole radix tree
+        # nodes, which is much cheaper than trimming exactly
+        pipe.xadd(stream_key(queue), {'body': payload}, maxlen=settings.DISPATCHER_DURABLE_MAXLEN, approximate=True)
+        if queue not in queues:
+            queues.append(queue)
+    pipe.execute()
+    return queues
+
+
+def acknowledge(body):
+    '''
+    Remove a message from its stream, once a worker has started it; if the
+    dispatcher stops before then, it reads the message again when it starts
+    '''
+    delivery = body.get('delivery') if isinstance(body, dict) else None
+    if not delivery:
+        return
+    try:
+        pipe = get_redis().pipeline()
+        pipe.xack(delivery['stream'], GROUP, delivery['id'])
+        pipe.xdel(delivery['stream'], delivery['id'])
+        pipe.execute()
+    except redis.RedisError:
+        logger.exception('could not acknowledge message {} of {}'.format(delivery['id'], delivery['stream']))
+
+
+def remove_queue(queue):
+    '''
+    Remove the stream of a queue that will never be read again (e.g., that of
+    a deprovisioned node)
+    '''
+    if not is_durable(queue):
+        return
+    try:
+        get_redis().delete(stream_key(queue))
+    except redis.RedisError:
+        logger.exception('could not remove the stream of {}'.format(queue))
+
+
+def queued_uuids(queues):
+    '''
+    Return the uuids of the messages waiting in the streams of `queues` for a
+    worker to start them
+    '''
+    uuids = []
+    for queue in queues:
+        if not is_durable(queue):
+            continue
+        try:
+            for entry_id, fields in get_redis().xrange(stream_key(queue)):
+                if fields.get(b'body'):
+                    uuids.append(json.loads(fields[b'body']).get('uuid'))
+        except redis.RedisError:
+            logger.exception('could not read the stream of {}'.format(queue))
+    return uuids
+
+
+class DurableQueue(object):
+    '''
+    The messages published to a dispatcher queue, kept in a redis stream
+    until a worker starts them, so that they aren't lost if the dispatcher
+    isn't listening when they're sent (as notifications would be).
+
+    Each message is delivered to the dispatcher along with where it came
+    from (in `body['delivery']`), and stays pending in the stream until the
+    worker running it acknowledges it.  Once the dispatcher restarts, it
+    first reads the messages that were delivered to it but never started,
+    then any new ones.
+    '''
+
+    def __init__(self, queue, consumer=None):
+        self.queue = queue
+        self.key = stream_key(queue)
+        self.consumer = consumer or settings.CLUSTER_HOST_ID
+        self.redis = get_redis()
+        # whether the messages delivered before a restart have been read
+        self.recovered = False
+
+    def create_group(self):
+        # the group starts at the beginning of the stream (id 0), so the
+        # messages added before the dispatcher first reads it are delivered
+        # too
+        try:
+            self.redis.xgroup_create(self.key, GROUP, id='0', mkstream=True)
+        except redis.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def read(self):
+        '''
+        Yield the messages waiting in the stream, in batches of
+        DISPATCHER_DURABLE_BATCH_SIZE
+        '''
+        if not self.recovered:
+            self.create_group()
+            yield from self._read('0')
+            self.recovered = True
+        yield from self._read('>')
+
+    def _read(self, start):
+        while True:
+            response = self.redis.xreadgroup(
+                GROUP, self.consumer, {self.key: start},
+                count=settings.DISPATCHER_DURABLE_BATCH_SIZE
+            )
+            entries = response[0][1] if response else []
+            if not entries:
+                return
+            for entry_id, fields in entries:
+                entry_id = entry_id.decode('utf-8')
+                if not fields:
+                    # deleted after it was delivered, but before it was
+                    # acknowledged
+                    self.redis.xack(self.key, GROUP, entry_id)
+                    continue
+                body = json.loads(fields[b'body'])
+                body['delivery'] = {'stream': self.key, 'id': entry_id}
+                yield body
+            if start != '>':
+                # pending messages are read from after the last one read
+                start = entries[-1][0]
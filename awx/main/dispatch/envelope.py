@@ -0,0 +1,69 @@
+import json
+import logging
+from uuid import uuid4
+
+from django.conf import settings
+
+import redis
+
+
+logger = logging.getLogger('awx.main.dispatch')
+
+SPILL_KEY_PREFIX = 'awx_dispatcher_payload'
+
+# what a payload that was spilled is sent as instead
+SPILLED_PREFIX = '{"spilled": "' + SPILL_KEY_PREFIX
+
+# every dispatcher in the cluster listens on this queue, so the payloads sent
+# to it are read more than once
+BROADCAST_QUEUE = 'tower_broadcast_all'
+
+
+_redis = None
+
+
+def get_redis():
+    global _redis
+    if _redis is None:
+        _redis = redis.Redis.from_url(settings.BROKER_URL)
+    return _redis
+
+
+def payload_size(payload):
+    return len(payload.encode('utf-8'))
+
+
+def wrap_payload(channel, payload):
+    '''
+    Return what to send to `channel` for `payload`: the payload itself, or,
+    if it's larger than pg_notify allows (DISPATCHER_NOTIFY_PAYLOAD_LIMIT),
+    a reference to a copy of it stored in redis
+    '''
+    if payload_size(payload) <= settings.DISPATCHER_NOTIFY_PAYLOAD_LIMIT:
+        return payload
+    key = '{}:{}'.format(SPILL_KEY_PREFIX, uuid4())
+    get_redis().set(key, payload, ex=settings.DISPATCHER_SPILL_TIMEOUT)
+    return json.dumps({'spilled': key})
+
+
+def unwrap_payload(channel, payload):
+    '''
+    Return the payload sent by wrap_payload(), or None if it was spilled, and
+    can't be found
+    '''
+    if not payload.startswith(SPILLED_PREFIX):
+        return payload
+    key = json.loads(payload)['spilled']
+    try:
+        conn = get_redis()
+        spilled = conn.get(key)
+        # only one dispatcher reads each message sent to any other queue
+        if spilled is not None and channel != BROADCAST_QUEUE:
+            conn.delete(key)
+    except redis.RedisError:
+        logger.exception('could not load spilled payload {} sent to {}'.format(key, channel))
+        return None
+    if spilled is None:
+        logger.error('spilled payload {} sent to {} has expired'.format(key, channel))
+        return None
+    return spilled.decode('utf-8')
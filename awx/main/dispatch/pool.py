@@ -1,4 +1,6 @@
+import fnmatch
 import logging
+import math
 import os
 import random
 import signal
@@ -16,9 +18,11 @@ from queue import Full as QueueFull, Empty as QueueEmpty
 from django.conf import settings
 from django.db import connection as django_connection, connections
 from django.core.cache import cache as django_cache
+from django.core.exceptions import ImproperlyConfigured
 from jinja2 import Template
 import psutil
 
+from awx.main.analytics.subsystem_metrics import SubsystemMetrics
 from awx.main.models import UnifiedJob
 from awx.main.dispatch import reaper
 
@@ -46,7 +50,8 @@ class PoolWorker(object):
                   process that is forked will get() from this queue and handle
                   received messages in an endless loop
     - self.finished: this is a queue which the worker process uses to signal
-                     that it has finished processing a message
+                     that it has finished processing a message (along with
+                     when it started and finished it)
 
     When a message is put() onto this worker, it is tracked in
     self.managed_tasks.
@@ -61,6 +66,9 @@ class PoolWorker(object):
 
     A worker is "busy" when it has at least one message in self.managed_tasks.
     It is "idle" when self.managed_tasks is empty.
+
+    If self.demand is set, the time each message waited in the queue, and the
+    time the worker spent on it, are recorded there once it's finished.
     '''
 
     track_managed_tasks = False
@@ -69,6 +77,10 @@ class PoolWorker(object):
         self.messages_sent = 0
         self.messages_finished = 0
         self.managed_tasks = collections.OrderedDict()
+        # uuid -> when the message was put() onto this worker
+        self.queued_at = {}
+        self.idle_since = time.time()
+        self.demand = None
         self.finished = MPQueue(queue_size) if self.track_managed_tasks else NoOpResultQueue()
         self.queue = MPQueue(queue_size)
         self.process = Process(target=target, args=(self.queue, self.finished) + args)
@@ -85,6 +97,8 @@ class PoolWorker(object):
             uuid = body['uuid']
         if self.track_managed_tasks:
             self.managed_tasks[uuid] = body
+            self.queued_at[uuid] = time.time()
+            self.idle_since = None
         self.queue.put(body, block=True, timeout=5)
         self.messages_sent += 1
         self.calculate_managed_tasks()
@@ -133,10 +147,21 @@ class PoolWorker(object):
 
         # if any tasks were finished, removed them from the managed tasks for
         # this worker
-        for uuid in finished:
+        for item in finished:
+            if isinstance(item, tuple):
+                uuid, started, stopped = item
+            else:
+                uuid, started, stopped = item, None, None
+            queued_at = self.queued_at.pop(uuid, None)
             try:
-                del self.managed_tasks[uuid]
+                body = self.managed_tasks.pop(uuid)
                 self.messages_finished += 1
+                if self.demand is not None and started is not None:
+                    self.demand.finished(
+                        body,
+                        max(started - (queued_at or started), 0),
+                        max(stopped - started, 0)
+                    )
             except KeyError:
                 # ansible _sometimes_ appears to send events w/ duplicate UUIDs;
                 # UUIDs for ansible events are *not* actually globally unique
@@ -144,6 +169,22 @@ class PoolWorker(object):
                 # the purpose of self.managed_tasks is to just track internal
                 # state of which events are *currently* being processed.
                 logger.warn('Event UUID {} appears to be have been duplicated.'.format(uuid))
+        if finished and not self.managed_tasks and self.idle_since is None:
+            self.idle_since = time.time()
+
+    def waiting(self, now=None):
+        '''
+        Return how long each message queued behind the one this worker is
+        running has been waiting for it
+        '''
+        if not self.track_managed_tasks:
+            return []
+        now = now or time.time()
+        return [
+            now - self.queued_at[uuid]
+            for uuid in list(self.managed_tasks.keys())[1:]
+            if uuid in self.queued_at
+        ]
 
     @property
     def current_task(self):
@@ -257,6 +298,18 @@ class WorkerPool(object):
             logger.warn('scaling up worker pid:{}'.format(worker.pid))
         return idx, worker
 
+    def supervise(self):
+        '''
+        Replace any worker processes that have exited, so that the pool
+        always has at least min_workers
+        '''
+        for w in self.workers[::]:
+            if not w.alive:
+                logger.error('worker pid:{} is gone (exit={}), replacing it'.format(w.pid, w.exitcode))
+                self.workers.remove(w)
+        while len(self.workers) < self.min_workers:
+            self.up()
+
     def debug(self, *args, **kwargs):
         tmpl = Template(
             'Recorded at: {{ dt }} \n'
@@ -313,33 +366,180 @@ class WorkerPool(object):
             logger.exception('could not kill {}'.format(worker.pid))
 
 
+def is_heartbeat(body):
+    return isinstance(body, dict) and 'cluster_node_heartbeat' in body['task']
+
+
+def task_name(body):
+    if isinstance(body, dict) and body.get('task'):
+        return body['task'].rsplit('.', 1)[-1]
+    return 'unknown'
+
+
+class Demand(object):
+    '''
+    What an AutoscalePool has recently been asked to do: how often messages
+    of each task arrive, how long they wait in a worker's queue before it
+    starts them, and how long a worker spends on them.
+
+    By Little's law, the number of messages of a task being worked on at
+    once is their arrival rate times how long each takes; so the pool needs
+    about that many workers (summed over every task) to start each message
+    as soon as it arrives.
+    '''
+
+    # the weight of each new measurement in the moving averages
+    alpha = 0.2
+
+    def __init__(self, window=None, group=None, metrics=None):
+        self.window = window or settings.DISPATCHER_AUTOSCALE_WINDOW
+        self.group = group or 'default'
+        # (time, task) of each message written in the last window
+        self.arrivals = collections.deque()
+        self.arrival_counts = collections.Counter()
+        # task -> moving average of the time a worker spends on it
+        self.runtimes = {}
+        # task -> {'count', 'avg', 'max'} of the time it waited for a worker
+        self.waits = collections.OrderedDict()
+        # the pools of every worker group of a dispatcher share their metrics
+        self.metrics = metrics or SubsystemMetrics('dispatcher')
+        self.last_record = 0
+        self.queue_wait = self.metrics.histogram(
+            'queue_wait_seconds', 'Time dispatcher messages waited for a worker to start them',
+            labelnames=['group', 'task'],
+            buckets=(.01, .1, .5, 1, 5, 10, 30, 60, 300, float('inf'))
+        )
+        self.worker_count = self.metrics.gauge(
+            'workers', 'Number of dispatcher worker processes', labelnames=['group', 'state']
+        )
+
+    def arrived(self, body, now=None):
+        now = now or time.time()
+        task = task_name(body)
+        self.arrivals.append((now, task))
+        self.arrival_counts[task] += 1
+        self.expire(now)
+
+    def expire(self, now):
+        while self.arrivals and self.arrivals[0][0] < now - self.window:
+            _, task = self.arrivals.popleft()
+            self.arrival_counts[task] -= 1
+            if not self.arrival_counts[task]:
+                del self.arrival_counts[task]
+
+    def finished(self, body, wait, runtime):
+        task = task_name(body)
+        self.queue_wait.labels(group=self.group, task=task).observe(wait)
+        stats = self.waits.setdefault(task, {'count': 0, 'avg': wait, 'max': 0})
+        stats['count'] += 1
+        stats['avg'] += self.alpha * (wait - stats['avg'])
+        stats['max'] = max(stats['max'], wait)
+        if task in self.runtimes:
+            self.runtimes[task] += self.alpha * (runtime - self.runtimes[task])
+        else:
+            self.runtimes[task] = runtime
+
+    def rate(self, now=None):
+        '''
+        The number of messages written per second, over the last window
+        '''
+        self.expire(now or time.time())
+        return len(self.arrivals) / self.window
+
+    def workers_needed(self, now=None):
+        self.expire(now or time.time())
+        return int(math.ceil(sum(
+            count / self.window * self.runtimes.get(task, 0)
+            for task, count in self.arrival_counts.items()
+        )))
+
+    def record(self, workers):
+        # counting idle workers is only worth it as often as metrics are sent
+        if time.time() - self.last_record < settings.SUBSYSTEM_METRICS_INTERVAL:
+            return
+        self.last_record = time.time()
+        idle = len([w for w in workers if w.idle])
+        self.worker_count.labels(group=self.group, state='idle').set(idle)
+        self.worker_count.labels(group=self.group, state='busy').set(len(workers) - idle)
+        self.metrics.send()
+
+
+def default_max_workers():
+    '''
+    The most workers the dispatcher of this node runs, unless told otherwise
+    '''
+    settings_absmem = getattr(settings, 'SYSTEM_TASK_ABS_MEM', None)
+    if settings_absmem is not None:
+        total_memory_gb = int(settings_absmem)
+    else:
+        total_memory_gb = (psutil.virtual_memory().total >> 30) + 1  # noqa: round up
+    # 5 workers per GB of total memory
+    return (total_memory_gb * 5)
+
+
 class AutoscalePool(WorkerPool):
     '''
     An extended pool implementation that automatically scales workers up and
     down based on demand
+
+    By default, a worker is forked when a message is written while every
+    worker is busy, and idle workers beyond min_workers are stopped on each
+    cluster node heartbeat.
+
+    With DISPATCHER_PREDICTIVE_AUTOSCALE, the pool instead forks workers
+    ahead of demand, as many at once as it needs: it keeps
+    DISPATCHER_WARM_WORKERS idle workers ready beyond those that the recent
+    demand calls for, and forks one more for every message that has waited
+    longer than DISPATCHER_MAX_QUEUE_WAIT for a worker.  Workers are only
+    stopped once they've been idle for DISPATCHER_SCALE_DOWN_DELAY, so that
+    a burst of messages doesn't fork and stop workers over and over.
+
+    A pool with a `group` is one of the worker groups of a RoutedPool, which
+    cleans up all of its groups at once.
     '''
 
     pool_cls = StatefulPoolWorker
 
+    # how often (in seconds) write() looks for idle workers to stop
+    scale_down_interval = 5
+
     def __init__(self, *args, **kwargs):
         self.max_workers = kwargs.pop('max_workers', None)
+        self.group = kwargs.pop('group', None)
+        metrics = kwargs.pop('metrics', None)
         super(AutoscalePool, self).__init__(*args, **kwargs)
+        if self.group is not None:
+            self.name = '{}:{}'.format(self.name, self.group)
+        self.demand = Demand(group=self.group, metrics=metrics)
+        self.last_scale_down = time.time()
 
         if self.max_workers is None:
-            settings_absmem = getattr(settings, 'SYSTEM_TASK_ABS_MEM', None)
-            if settings_absmem is not None:
-                total_memory_gb = int(settings_absmem)
-            else:
-                total_memory_gb = (psutil.virtual_memory().total >> 30) + 1  # noqa: round up
-            # 5 workers per GB of total memory
-            self.max_workers = (total_memory_gb * 5)
+            self.max_workers = default_max_workers()
 
         # max workers can't be less than min_workers
         self.max_workers = max(self.min_workers, self.max_workers)
 
     def debug(self, *args, **kwargs):
-        self.cleanup()
-        return super(AutoscalePool, self).debug(*args, **kwargs)
+        if self.group is None:
+            self.cleanup()
+        tmpl = Template(
+            '{% if waits %}'
+            'queue wait by task:\n'
+            '{% for task, stats in waits.items() %}'
+            '.  {{ task }} finished={{ stats["count"] }}'
+            ' avg={{ "%.3f" % stats["avg"] }}s max={{ "%.3f" % stats["max"] }}s'
+            '{% if task in runtimes %} runtime={{ "%.3f" % runtimes[task] }}s{% endif %}'
+            '\n'
+            '{% endfor %}'
+            '{% endif %}'
+        )
+        return super(AutoscalePool, self).debug(*args, **kwargs) + tmpl.render(
+            waits=self.demand.waits, runtimes=self.demand.runtimes
+        )
+
+    @property
+    def predictive(self):
+        return settings.DISPATCHER_PREDICTIVE_AUTOSCALE
 
     @property
     def should_grow(self):
@@ -355,7 +555,51 @@ class AutoscalePool(WorkerPool):
 
     @property
     def debug_meta(self):
-        return 'min={} max={}'.format(self.min_workers, self.max_workers)
+        meta = 'min={} max={}'.format(self.min_workers, self.max_workers)
+        if self.predictive:
+            meta += ' warm={} rate={:.2f}/s needed={}'.format(
+                settings.DISPATCHER_WARM_WORKERS, self.demand.rate(), self.demand.workers_needed()
+            )
+        return meta
+
+    def workers_wanted(self, now, incoming=0):
+        busy = len([w for w in self.workers if w.busy]) + incoming
+        wanted = max(busy, self.demand.workers_needed(now)) + settings.DISPATCHER_WARM_WORKERS
+        return min(max(wanted, self.min_workers), self.max_workers)
+
+    def scale_up(self):
+        '''
+        Fork all of the workers that the pool is short of at once
+        '''
+        now = time.time()
+        wanted = self.workers_wanted(now, incoming=1)
+        # messages stuck behind others in a worker's queue mean that
+        # messages are arriving faster than expected
+        wanted += len([
+            wait for w in self.workers for wait in w.waiting(now)
+            if wait > settings.DISPATCHER_MAX_QUEUE_WAIT
+        ])
+        for _ in range(min(wanted, self.max_workers) - len(self.workers)):
+            self.up()
+
+    def scale_down(self):
+        '''
+        Stop the workers that have been idle for longer than
+        DISPATCHER_SCALE_DOWN_DELAY, and that the pool doesn't need
+        '''
+        now = time.time()
+        self.last_scale_down = now
+        excess = len(self.workers) - self.workers_wanted(now)
+        idle = sorted(
+            [w for w in self.workers if w.alive and w.idle and w.idle_since is not None],
+            key=lambda w: w.idle_since
+        )
+        for w in idle[:max(excess, 0)]:
+            if now - w.idle_since < settings.DISPATCHER_SCALE_DOWN_DELAY:
+                break
+            logger.warn('scaling down worker pid:{}'.format(w.pid))
+            w.quit()
+            self.workers.remove(w)
 
     def cleanup(self):
         """
@@ -366,7 +610,8 @@ class AutoscalePool(WorkerPool):
             were handling.
         2.  Clean up unnecessary, idle workers.
         3.  Check to see if the database says this node is running any tasks
-            that aren't actually running.  If so, reap them.
+            that aren't actually running.  If so, reap them (unless this pool
+            is a worker group, whose RoutedPool does this for every group).
 
         IMPORTANT: this function is one of the few places in the dispatcher
         (aside from setting lookups) where we talk to the database.  As such,
@@ -391,7 +636,7 @@ class AutoscalePool(WorkerPool):
                             logger.exception('failed to reap job UUID {}'.format(w.current_task['uuid']))
                 orphaned.extend(w.orphaned_tasks)
                 self.workers.remove(w)
-            elif w.idle and len(self.workers) > self.min_workers:
+            elif w.idle and len(self.workers) > self.min_workers and not self.predictive:
                 # the process has an empty queue (it's idle) and we have
                 # more processes in the pool than we need (> min)
                 # send this process a message so it will exit gracefully
@@ -427,13 +672,22 @@ class AutoscalePool(WorkerPool):
             idx = random.choice(range(len(self.workers)))
             self.write(idx, m)
 
+        if self.predictive:
+            self.scale_down()
+        self.demand.record(self.workers)
+
         # if the database says a job is running on this node, but it's *not*,
         # then reap it
+        if self.group is None:
+            reaper.reap(excluded_uuids=self.running_uuids)
+
+    @property
+    def running_uuids(self):
         running_uuids = []
         for worker in self.workers:
             worker.calculate_managed_tasks()
             running_uuids.extend(list(worker.managed_tasks.keys()))
-        reaper.reap(excluded_uuids=running_uuids)
+        return running_uuids
 
     def up(self):
         if self.full:
@@ -442,15 +696,23 @@ class AutoscalePool(WorkerPool):
             idx = random.choice(range(len(self.workers)))
             return idx, self.workers[idx]
         else:
-            return super(AutoscalePool, self).up()
+            idx, worker = super(AutoscalePool, self).up()
+            worker.demand = self.demand
+            return idx, worker
 
     def write(self, preferred_queue, body):
         try:
             # when the cluster heartbeat occurs, clean up internally
-            if isinstance(body, dict) and 'cluster_node_heartbeat' in body['task']:
+            if self.group is None and is_heartbeat(body):
                 self.cleanup()
-            if self.should_grow:
+            self.demand.arrived(body)
+            if self.predictive:
+                self.scale_up()
+                if time.time() - self.last_scale_down > self.scale_down_interval:
+                    self.scale_down()
+            elif self.should_grow:
                 self.up()
+            self.demand.record(self.workers)
             # we don't care about "preferred queue" round robin distribution, just
             # find the first non-busy worker and claim it
             workers = self.workers[:]
@@ -467,3 +729,103 @@ class AutoscalePool(WorkerPool):
                 # connection
                 conn.close_if_unusable_or_obsolete()
             logger.exception('failed to write inbound message')
+
+
+class RoutedPool(object):
+    '''
+    A set of AutoscalePools, one for each worker group in
+    DISPATCHER_WORKER_GROUPS (plus the "default" group), each with its own
+    minimum and maximum number of workers.
+
+    Every group other than the default one must set its max_workers; unless
+    it's given one, the default group gets what's left of the node's
+    (memory-based) maximum, so that all of the groups together don't run
+    more workers than a single pool would.
+
+    Each message is written to the group that its task is routed to by
+    DISPATCHER_TASK_ROUTES, which maps task names (or fnmatch patterns of
+    them) to groups; messages for any other task (or for a group that
+    doesn't exist) are written to the default group.  In this way, short
+    tasks (like run_task_manager, or handle_work_success) can be kept from
+    queueing behind playbook runs in the same worker.
+
+    DISPATCHER_WORKER_GROUPS = {
+        'control': {'min_workers': 2, 'max_workers': 8},
+    }
+    DISPATCHER_TASK_ROUTES = {
+        'awx.main.scheduler.tasks.run_task_manager': 'control',
+        'awx.main.tasks.handle_work_*': 'control',
+    }
+    '''
+
+    def __init__(self, groups=None, routes=None, **kwargs):
+        if groups is None:
+            groups = settings.DISPATCHER_WORKER_GROUPS
+        self.routes = settings.DISPATCHER_TASK_ROUTES if routes is None else routes
+        # task -> the group it's routed to
+        self.routed = {}
+        metrics = SubsystemMetrics('dispatcher')
+        groups = collections.OrderedDict((group, options) for group, options in groups.items() if group != 'default')
+        for group, options in groups.items():
+            if options.get('max_workers') is None:
+                raise ImproperlyConfigured('DISPATCHER_WORKER_GROUPS["{}"] must set max_workers'.format(group))
+        if kwargs.get('max_workers') is None:
+            kwargs['max_workers'] = max(default_max_workers() - sum(options['max_workers'] for options in groups.values()), 0)
+        self.pools = collections.OrderedDict()
+        self.pools['default'] = AutoscalePool(group='default', metrics=metrics, **kwargs)
+        for group, options in groups.items():
+            self.pools[group] = AutoscalePool(group=group, metrics=metrics, **options)
+
+    def __len__(self):
+        return len(self.workers)
+
+    @property
+    def workers(self):
+        return [w for pool in self.pools.values() for w in pool.workers]
+
+    def init_workers(self, target, *target_args):
+        for pool in self.pools.values():
+            pool.init_workers(target, *target_args)
+
+    def route(self, body):
+        '''
+        Return the pool that a message should be written to
+        '''
+        task = body.get('task') if isinstance(body, dict) else None
+        if task not in self.routed:
+            group = self.routes.get(task)
+            if group is None and task:
+                for pattern, pattern_group in self.routes.items():
+                    if fnmatch.fnmatchcase(task, pattern):
+                        group = pattern_group
+                        break
+            self.routed[task] = group if group in self.pools else 'default'
+        return self.pools[self.routed[task]]
+
+    def cleanup(self):
+        for pool in self.pools.values():
+            pool.cleanup()
+        # reap the jobs that the database says are running on this node, but
+        # that aren't running in any group
+        reaper.reap(excluded_uuids=[
+            uuid for pool in self.pools.values() for uuid in pool.running_uuids
+        ])
+
+    def debug(self, *args, **kwargs):
+        self.cleanup()
+        return '\n'.join(pool.debug(*args, **kwargs) for pool in self.pools.values())
+
+    def write(self, preferred_queue, body):
+        if is_heartbeat(body):
+            try:
+                self.cleanup()
+            except Exception:
+                for conn in connections.all():
+                    conn.close_if_unusable_or_obsolete()
+                logger.exception('failed to clean up worker groups')
+        pool = self.route(body)
+        return pool.write(preferred_queue % max(len(pool), 1), body)
+
+    def stop(self, signum):
+        for pool in self.pools.values():
+            pool.stop(signum)
@@ -1,12 +1,20 @@
 import inspect
 import logging
+import os
 import sys
 import json
+import threading
+import time
 from uuid import uuid4
 
+import psycopg2
+import redis
+
 from django.conf import settings
 
-from . import pg_bus_conn
+from . import connect_pg_bus
+from .durable import DOORBELL, add_messages, is_durable
+from .envelope import payload_size, wrap_payload
 
 logger = logging.getLogger('awx.main.dispatch')
 
@@ -15,6 +23,160 @@ def serialize_task(f):
     return '.'.join([f.__module__, f.__name__])
 
 
+class Publisher(object):
+    """
+    A connection to the message bus that a process keeps open for publishing
+    dispatcher messages, instead of connecting anew for every message.
+
+    If the connection has been lost (e.g., because the database restarted),
+    it's reopened, and the publish retried once; the notifications of a
+    publish are delivered all together or not at all, so none are sent twice.
+    """
+
+    def __init__(self, parent=None):
+        from awx.main.analytics.subsystem_metrics import SubsystemMetrics  # circular import
+        self.pid = os.getpid()
+        self.pubsub = None
+        # the Publisher of the process this one was forked from; its
+        # connection must never be closed (or garbage collected) by this
+        # process, as that would close it for the parent, too
+        self.parent = parent
+        self.lock = threading.Lock()
+        self.metrics = SubsystemMetrics('dispatch_publisher')
+        self.publish_time = self.metrics.histogram(
+            'publish_seconds', 'Time spent publishing a batch of dispatcher messages',
+            buckets=(.001, .005, .01, .05, .1, .5, 1, 5, float('inf'))
+        )
+        self.messages = self.metrics.counter(
+            'messages', 'Number of dispatcher messages published'
+        )
+        self.connections = self.metrics.counter(
+            'connections', 'Number of connections opened to publish dispatcher messages'
+        )
+        self.errors = self.metrics.counter(
+            'errors', 'Number of failed attempts to publish dispatcher messages'
+        )
+        self.payload_size = self.metrics.histogram(
+            'payload_bytes', 'Size of the dispatcher messages published',
+            buckets=(256, 1024, 4096, 8000, 65536, 1048576, float('inf'))
+        )
+        self.spilled = self.metrics.counter(
+            'spilled', 'Number of dispatcher messages too large for pg_notify, which were stored in redis instead'
+        )
+        self.queue_usage = self.metrics.gauge(
+            'notify_queue_usage', 'Fraction of the database notification queue in use'
+        )
+        self.last_queue_check = 0
+
+    def connect(self):
+        if self.pubsub is None or self.pubsub.conn.closed:
+            self.pubsub = connect_pg_bus()
+            self.connections.inc()
+        return self.pubsub
+
+    def disconnect(self):
+        if self.pubsub is not None:
+            try:
+                self.pubsub.close()
+            except psycopg2.Error:
+                pass
+            self.pubsub = None
+
+    def notify(self, channel, payload):
+        self.notify_many([(channel, payload)])
+
+    def notify_many(self, notifications):
+        """
+        Send a list of (channel, payload) notifications
+        """
+        if not notifications:
+            return
+        count = len(notifications)
+        durable, notified = [], []
+        start = time.time()
+        try:
+            for channel, payload in notifications:
+                size = payload_size(payload)
+                self.payload_size.observe(size)
+                if is_durable(channel):
+                    durable.append((channel, payload))
+                    continue
+                if size > settings.DISPATCHER_NOTIFY_PAYLOAD_LIMIT:
+                    self.spilled.inc()
+                # wrapped once, so that a retry doesn't spill it again
+                notified.append((channel, wrap_payload(channel, payload)))
+            if durable:
+                # the messages are read from the streams of their queues;
+                # only a doorbell is notified for them
+                notified.extend((queue, DOORBELL) for queue in add_messages(durable))
+        except redis.RedisError:
+            self.errors.inc()
+            raise
+        notifications = notified
+        with self.lock:
+            try:
+                try:
+                    self.connect().notify_many(notifications)
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    logger.warning('lost the connection used to publish dispatcher messages, reconnecting')
+                    self.errors.inc()
+                    self.disconnect()
+                    self.connect().notify_many(notifications)
+            except psycopg2.Error:
+                self.errors.inc()
+                self.disconnect()
+                raise
+            finally:
+                self.publish_time.observe(time.time() - start)
+                self.metrics.send()
+            self.check_queue_usage()
+        self.messages.inc(count)
+
+    def check_queue_usage(self):
+        # notifications are queued until every session listening for them
+        # has read them; once the queue is full, publishing fails
+        if time.time() - self.last_queue_check < settings.SUBSYSTEM_METRICS_INTERVAL:
+            return
+        self.last_queue_check = time.time()
+        try:
+            usage = self.pubsub.queue_usage()
+        except psycopg2.Error:
+            logger.exception('could not determine the usage of the database notification queue')
+            self.disconnect()
+            return
+        self.queue_usage.set(usage)
+        if usage >= settings.DISPATCHER_NOTIFY_QUEUE_WARNING:
+            logger.warning('the database notification queue is {:.0%} full; a dispatcher may not be reading its messages'.format(usage))
+
+
+_publisher = None
+
+
+def get_publisher():
+    """
+    Return the Publisher of this process
+    """
+    global _publisher
+    if _publisher is None or _publisher.pid != os.getpid():
+        _publisher = Publisher(parent=_publisher)
+    return _publisher
+
+
+def publish_many(messages):
+    """
+    Publish a list of (message, queue) pairs, as returned by
+    `build_message`, in as few round trips as possible:
+
+    publish_many([
+        add.build_message([1, 1]),
+        Adder.build_message([2, 2], queue='slow-tasks'),
+    ])
+    """
+    if messages and not settings.IS_TESTING(sys.argv):
+        get_publisher().notify_many([(queue, json.dumps(obj)) for obj, queue in messages])
+    return messages
+
+
 class task:
     """
     Used to decorate a function or class so that it can be run asynchronously
@@ -66,6 +228,13 @@ class task:
 
             @classmethod
             def apply_async(cls, args=None, kwargs=None, queue=None, uuid=None, **kw):
+                obj, queue = cls.build_message(args, kwargs, queue=queue, uuid=uuid, **kw)
+                if not settings.IS_TESTING(sys.argv):
+                    get_publisher().notify(queue, json.dumps(obj))
+                return (obj, queue)
+
+            @classmethod
+            def build_message(cls, args=None, kwargs=None, queue=None, uuid=None, **kw):
                 task_id = uuid or str(uuid4())
                 args = args or []
                 kwargs = kwargs or {}
@@ -86,9 +255,6 @@ class task:
                 obj.update(**kw)
                 if callable(queue):
                     queue = queue()
-                if not settings.IS_TESTING(sys.argv):
-                    with pg_bus_conn() as conn:
-                        conn.notify(queue, json.dumps(obj))
                 return (obj, queue)
 
         # If the object we're wrapping *is* a class (e.g., RunJob), return
@@ -114,5 +280,6 @@ class task:
         # PublisherMixin we dynamically created above
         setattr(fn, 'name', cls.name)
         setattr(fn, 'apply_async', cls.apply_async)
+        setattr(fn, 'build_message', cls.build_message)
         setattr(fn, 'delay', cls.delay)
         return fn
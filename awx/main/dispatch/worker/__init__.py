@@ -1,3 +1,3 @@
 from .base import AWXConsumerRedis, AWXConsumerPG, BaseWorker  # noqa
-from .callback import CallbackBrokerWorker  # noqa
+from .callback import CallbackBrokerWorker, JobFinalizeWorker  # noqa
 from .task import TaskWorker  # noqa
@@ -17,6 +17,8 @@ from django.conf import settings
 
 from awx.main.dispatch.pool import WorkerPool
 from awx.main.dispatch import pg_bus_conn
+from awx.main.dispatch.durable import DOORBELL, DurableQueue, acknowledge, is_durable
+from awx.main.dispatch.envelope import unwrap_payload
 
 if 'run_callback_receiver' in sys.argv:
     logger = logging.getLogger('awx.main.commands.run_callback_receiver')
@@ -128,13 +130,25 @@ class AWXConsumerBase(object):
 
 
 class AWXConsumerRedis(AWXConsumerBase):
+
+    # how often (in seconds) to replace worker processes that have exited
+    supervise_interval = 5
+
+    def __init__(self, *args, **kwargs):
+        # other pools of workers, started by the caller, which this consumer
+        # supervises alongside its own
+        self.pools = kwargs.pop('pools', [])
+        super(AWXConsumerRedis, self).__init__(*args, **kwargs)
+
     def run(self, *args, **kwargs):
         super(AWXConsumerRedis, self).run(*args, **kwargs)
         self.worker.on_start()
 
         while True:
             logger.debug(f'{os.getpid()} is alive')
-            time.sleep(60)
+            for pool in [self.pool] + self.pools:
+                pool.supervise()
+            time.sleep(self.supervise_interval)
 
 
 class AWXConsumerPG(AWXConsumerBase):
@@ -143,6 +157,7 @@ class AWXConsumerPG(AWXConsumerBase):
 
         logger.warn(f"Running worker {self.name} listening to queues {self.queues}")
         init = False
+        durable_queues = [DurableQueue(queue) for queue in self.queues if is_durable(queue)]
 
         while True:
             try:
@@ -152,17 +167,41 @@ class AWXConsumerPG(AWXConsumerBase):
                     if init is False:
                         self.worker.on_start()
                         init = True
-                    for e in conn.events():
-                        self.process_task(json.loads(e.payload))
+                    # read what was published while we weren't listening
+                    self.read_durable_queues(durable_queues)
+                    for e in conn.events(yield_timeouts=bool(durable_queues)):
+                        if e is None or e.payload == DOORBELL:
+                            # on timeouts, too, in case a doorbell was missed
+                            self.read_durable_queues(durable_queues)
+                            continue
+                        payload = unwrap_payload(e.channel, e.payload)
+                        if payload is not None:
+                            self.process_task(json.loads(payload))
                     if self.should_stop:
                         return
             except psycopg2.InterfaceError:
                 logger.warn("Stale Postgres message bus connection, reconnecting")
                 continue
 
+    def read_durable_queues(self, durable_queues):
+        for queue in durable_queues:
+            try:
+                for body in queue.read():
+                    self.process_task(body)
+            except redis.RedisError:
+                logger.exception(f"could not read messages from the stream of {queue.queue}")
+
 
 class BaseWorker(object):
 
+    @classmethod
+    def forked_work_loop(cls, *args, **kwargs):
+        '''
+        A pool target which builds the worker in the process that runs it,
+        rather than inheriting one (and its connections) from the parent
+        '''
+        return cls().work_loop(*args, **kwargs)
+
     def read(self, queue):
         return queue.get(block=True, timeout=1)
 
@@ -183,16 +222,18 @@ class BaseWorker(object):
             except Exception as e:
                 logger.error("Exception on worker {}, restarting: ".format(idx) + str(e))
                 continue
+            started = time.time()
             try:
                 for conn in db.connections.all():
                     # If the database connection has a hiccup during the prior message, close it
                     # so we can establish a new connection
                     conn.close_if_unusable_or_obsolete()
+                acknowledge(body)
                 self.perform_work(body, *args)
             finally:
                 if 'uuid' in body:
                     uuid = body['uuid']
-                    finished.put(uuid)
+                    finished.put((uuid, started, time.time()))
         logger.warn('worker exiting gracefully pid:{}'.format(os.getpid()))
 
     def perform_work(self, body):
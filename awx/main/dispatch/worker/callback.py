@@ -1,4 +1,6 @@
 import cProfile
+import functools
+import io
 import json
 import logging
 import os
@@ -10,24 +12,227 @@ import traceback
 
 from django.conf import settings
 from django.utils.timezone import now as tz_now
-from django.db import DatabaseError, OperationalError, connection as django_connection
+from django.db import DatabaseError, DataError, IntegrityError, OperationalError, connection as django_connection
 from django.db.utils import InterfaceError, InternalError
 
 import psutil
 
 import redis
 
+from awx.main.analytics.subsystem_metrics import SubsystemMetrics
 from awx.main.consumers import emit_channel_notification
 from awx.main.models import (JobEvent, AdHocCommandEvent, ProjectUpdateEvent,
                              InventoryUpdateEvent, SystemJobEvent, UnifiedJob,
-                             Job)
+                             UnifiedJobStdoutChunk, Job, Inventory)
 from awx.main.tasks import handle_success_and_failure_notifications
-from awx.main.models.events import emit_event_detail
+from awx.main.models.events import emit_event_details
+from awx.main.utils import codec
 
 from .base import BaseWorker
 
 logger = logging.getLogger('awx.main.commands.run_callback_receiver')
 
+# errors caused by the contents of (at least one of) the events being saved,
+# rather than by the database connection; e.g., psycopg2 raises ValueError
+# for strings that contain NUL characters
+DATA_ERRORS = (IntegrityError, DataError, ValueError, TypeError)
+
+
+def _copy_value(value):
+    # in COPY's CSV format, an unquoted empty value is NULL, and a quoted one
+    # is an empty string; quoted values may span lines.  PostgreSQL can't
+    # store NUL characters in text, so they're dropped.
+    if value is None:
+        return ''
+    return '"{}"'.format(str(value).replace('\x00', '').replace('"', '""'))
+
+
+def copy_rows(fields, events, connection):
+    '''
+    Return the CSV that `COPY ... FROM STDIN WITH (FORMAT csv)` reads for
+    the given fields of each event
+    '''
+    buff = io.StringIO()
+    for e in events:
+        buff.write(','.join(
+            _copy_value(f.get_db_prep_save(getattr(e, f.attname), connection))
+            for f in fields
+        ))
+        buff.write('\n')
+    buff.seek(0)
+    return buff
+
+
+def copy_events(cls, events):
+    '''
+    Insert events using `COPY ... FROM STDIN`, which is considerably cheaper
+    for PostgreSQL to ingest than the multi-row INSERT that bulk_create()
+    generates.
+
+    COPY can't return the primary keys it generates, so IDs are allocated
+    from the table's sequence up front and assigned to each event (the
+    callback receiver needs them to emit websocket messages).
+    '''
+    fields = cls._meta.concrete_fields
+    table = cls._meta.db_table
+    with django_connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+            [table, len(events)]
+        )
+        for e, (pk,) in zip(events, cursor.fetchall()):
+            e.id = pk
+
+        try:
+            cursor.copy_expert(
+                'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+                    table, ', '.join(f.column for f in fields)
+                ),
+                copy_rows(fields, events, django_connection)
+            )
+        except Exception:
+            for e in events:
+                e.id = None
+            raise
+
+
+class JobFinalizeQueue(object):
+    '''
+    A redis-backed queue of jobs whose playbook_on_stats event has been saved
+    and which are waiting for their job-level side effects to be applied (see
+    JobEvent.finalize_job).
+
+    Entries are keyed by job ID, so enqueueing the same job more than once
+    before it's handled results in a single finalization.
+
+    The queue also collects the UUIDs of parent events whose children were
+    changed or failed (see add_parents) as events are saved, so that
+    finalization can propagate changed/failed to just those parents instead
+    of scanning every event for the job.
+
+    Jobs are popped (along with their payloads and parents) by a single Lua
+    script, and are kept in flight until the worker finalizing them calls
+    ack(); jobs which aren't acknowledged within JOB_FINALIZE_TIMEOUT
+    seconds (e.g., because their worker died, or lost its database
+    connection) are put back on the queue, so
+    every job is finalized at least once.
+    '''
+
+    QUEUE = 'awx_job_finalize_queue'
+    PAYLOADS = 'awx_job_finalize_payloads'
+    PARENTS = 'awx_job_finalize_{}_parents_{}'
+    PROCESSING = 'awx_job_finalize_processing'
+    INFLIGHT = 'awx_job_finalize_inflight'
+    # pushed to whenever a job is queued, so that idle workers can block
+    # until there's something to pop
+    WAKEUP = 'awx_job_finalize_wakeup'
+
+    # parent UUIDs recorded for jobs that never finish (e.g., because the
+    # job was canceled before its playbook_on_stats event) eventually expire
+    PARENTS_TTL = 60 * 60 * 24
+
+    POP_SCRIPT = '''
+        local queue, payloads, processing, inflight = KEYS[1], KEYS[2], KEYS[3], KEYS[4]
+        local now, deadline, count, parents = ARGV[1], ARGV[2], tonumber(ARGV[3]), ARGV[4]
+
+        -- requeue the jobs whose finalization was started, but never finished
+        for _, job in ipairs(redis.call('zrangebyscore', processing, '-inf', now)) do
+            local entry = redis.call('hget', inflight, job)
+            if entry then
+                entry = cjson.decode(entry)
+                redis.call('hsetnx', payloads, job, entry[1])
+                for i, status in ipairs({'changed', 'failed'}) do
+                    local key = string.format(parents, job, status)
+                    for _, uuid in ipairs(entry[i + 1]) do
+                        redis.call('sadd', key, uuid)
+                    end
+                end
+                redis.call('zadd', queue, 'NX', now, job)
+            end
+            redis.call('zrem', processing, job)
+            redis.call('hdel', inflight, job)
+        end
+
+        local results = {}
+        local popped = redis.call('zpopmin', queue, count)
+        for i = 1, #popped, 2 do
+            local job = popped[i]
+            local payload = redis.call('hget', payloads, job)
+            if payload then
+                local changed_key = string.format(parents, job, 'changed')
+                local failed_key = string.format(parents, job, 'failed')
+                local changed = redis.call('smembers', changed_key)
+                local failed = redis.call('smembers', failed_key)
+                redis.call('hdel', payloads, job)
+                redis.call('del', changed_key, failed_key)
+                redis.call('hset', inflight, job, cjson.encode({payload, changed, failed}))
+                redis.call('zadd', processing, deadline, job)
+                table.insert(results, {job, payload, changed, failed})
+            end
+        end
+        return results
+    '''
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.pop_script = conn.register_script(self.POP_SCRIPT)
+
+    def __len__(self):
+        return self.conn.zcard(self.QUEUE)
+
+    def put(self, event):
+        payload = codec.dumps({
+            'id': event.id,
+            'job_id': event.job_id,
+            'event_data': event.event_data,
+            'host_map': getattr(event, 'host_map', {}),
+            'queued': time.time(),
+        })
+        pipe = self.conn.pipeline()
+        pipe.hset(self.PAYLOADS, event.job_id, payload)
+        pipe.zadd(self.QUEUE, {event.job_id: time.time()}, nx=True)
+        pipe.lpush(self.WAKEUP, 1)
+        pipe.ltrim(self.WAKEUP, 0, settings.JOB_FINALIZE_WORKERS - 1)
+        pipe.execute()
+
+    def add_parents(self, job_id, changed=(), failed=()):
+        pipe = self.conn.pipeline(transaction=False)
+        for status, uuids in (('changed', changed), ('failed', failed)):
+            if uuids:
+                key = self.PARENTS.format(job_id, status)
+                pipe.sadd(key, *uuids)
+                pipe.expire(key, self.PARENTS_TTL)
+        pipe.execute()
+
+    def pop(self, batch_size):
+        now = time.time()
+        entries = self.pop_script(
+            keys=[self.QUEUE, self.PAYLOADS, self.PROCESSING, self.INFLIGHT],
+            args=[now, now + settings.JOB_FINALIZE_TIMEOUT, batch_size, self.PARENTS.replace('{}', '%s')]
+        )
+        results = []
+        for job_id, payload, changed, failed in entries:
+            payload = codec.loads(payload)
+            payload['changed_parents'] = [uuid.decode('utf-8') for uuid in changed]
+            payload['failed_parents'] = [uuid.decode('utf-8') for uuid in failed]
+            results.append(payload)
+        return results
+
+    def get(self, timeout, batch_size):
+        results = self.pop(batch_size)
+        if not results and self.conn.blpop(self.WAKEUP, timeout=timeout):
+            results = self.pop(batch_size)
+        return results
+
+    def ack(self, job_id):
+        '''
+        Mark a job popped by get() as finalized
+        '''
+        pipe = self.conn.pipeline()
+        pipe.zrem(self.PROCESSING, job_id)
+        pipe.hdel(self.INFLIGHT, job_id)
+        pipe.execute()
+
 
 class CallbackBrokerWorker(BaseWorker):
     '''
@@ -39,46 +244,105 @@ class CallbackBrokerWorker(BaseWorker):
     '''
 
     MAX_RETRIES = 2
+    # the shortest time (in seconds) to block waiting for messages, so that
+    # a buffer that can't be flushed doesn't turn reading into a busy loop
+    MIN_READ_TIMEOUT = 0.05
     last_stats = time.time()
     total = 0
+    last_total = 0
+    mps = 0
     last_event = ''
     prof = None
 
     def __init__(self):
         self.buff = {}
+        self.buff_started = {}
         self.pid = os.getpid()
         self.redis = redis.Redis.from_url(settings.BROKER_URL)
+        self.finalize_queue = JobFinalizeQueue(self.redis)
+        self.metrics = SubsystemMetrics('callback_receiver')
+        self.flush_size = self.metrics.histogram(
+            'flush_size', 'Number of events written to the database per flush',
+            labelnames=['event_class'],
+            buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000, float('inf'))
+        )
+        self.flush_time = self.metrics.histogram(
+            'flush_seconds', 'Time spent writing a batch of events to the database',
+            labelnames=['event_class'],
+            buckets=(.01, .05, .1, .25, .5, 1, 2.5, 5, 10, float('inf'))
+        )
+        self.event_latency = self.metrics.histogram(
+            'event_latency_seconds', 'Time between an event being emitted and being written to the database',
+            labelnames=['event_class'],
+            buckets=(.1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300, float('inf'))
+        )
+        self.messages_per_second = self.metrics.gauge(
+            'messages_per_second', 'Number of messages read from redis per second'
+        )
         for key in self.redis.keys('awx_callback_receiver_statistics_*'):
             self.redis.delete(key)
 
     def read(self, queue):
+        messages = []
         try:
-            res = self.redis.blpop(settings.CALLBACK_QUEUE, timeout=settings.JOB_EVENT_BUFFER_SECONDS)
+            res = self.redis.blpop(settings.CALLBACK_QUEUE, timeout=self.read_timeout())
             if res is None:
-                return {'event': 'FLUSH'}
-            self.total += 1
-            return json.loads(res[1])
+                return [{'event': 'FLUSH'}]
+            messages.append(res[1])
+            batch_size = settings.JOB_EVENT_READ_BATCH_SIZE
+            if batch_size > 1:
+                # drain up to batch_size - 1 more messages in a single round
+                # trip; the pipeline runs in a MULTI/EXEC transaction, so no
+                # other worker can read the same messages
+                pipe = self.redis.pipeline()
+                pipe.lrange(settings.CALLBACK_QUEUE, 0, batch_size - 2)
+                pipe.ltrim(settings.CALLBACK_QUEUE, batch_size - 1, -1)
+                messages.extend(pipe.execute()[0])
         except redis.exceptions.RedisError:
             logger.exception("encountered an error communicating with redis")
             time.sleep(1)
-        except (json.JSONDecodeError, KeyError):
-            logger.exception("failed to decode JSON message from redis")
         finally:
             self.record_statistics()
-        return {'event': 'FLUSH'}
+        self.total += len(messages)
+
+        bodies = []
+        for message in messages:
+            try:
+                bodies.append(codec.loads(message))
+            except (json.JSONDecodeError, KeyError):
+                logger.exception("failed to decode JSON message from redis")
+        return bodies or [{'event': 'FLUSH'}]
+
+    def read_timeout(self):
+        '''
+        Return how long to wait for a message before flushing: no longer
+        than until the oldest buffered event of any class is due to be
+        written (see JOB_EVENT_BUFFER_POLICY)
+        '''
+        timeout = settings.JOB_EVENT_BUFFER_SECONDS
+        now = time.time()
+        for cls in self.buff:
+            size, max_age = self.buffer_policy(cls)
+            timeout = min(timeout, self.buff_started.get(cls, now) + max_age - now)
+        return max(timeout, self.MIN_READ_TIMEOUT)
 
     def record_statistics(self):
         # buffer stat recording to once per (by default) 5s
-        if time.time() - self.last_stats > settings.JOB_EVENT_STATISTICS_INTERVAL:
+        now = time.time()
+        if now - self.last_stats > settings.JOB_EVENT_STATISTICS_INTERVAL:
+            self.mps = (self.total - self.last_total) / (now - self.last_stats)
+            self.last_total = self.total
+            self.messages_per_second.set(self.mps)
             try:
                 self.redis.set(f'awx_callback_receiver_statistics_{self.pid}', self.debug())
                 self.last_stats = time.time()
             except Exception:
                 logger.exception("encountered an error communicating with redis")
                 self.last_stats = time.time()
+        self.metrics.send()
 
     def debug(self):
-        return f'.  worker[pid:{self.pid}] sent={self.total} rss={self.mb}MB {self.last_event}'
+        return f'.  worker[pid:{self.pid}] sent={self.total} mps={self.mps:0.1f} rss={self.mb}MB {self.last_event}'
 
     @property
     def mb(self):
@@ -106,34 +370,116 @@ class CallbackBrokerWorker(BaseWorker):
             signal.signal(signal.SIGUSR1, self.toggle_profiling)
         return super(CallbackBrokerWorker, self).work_loop(*args, **kw)
 
+    def buffer_policy(self, cls):
+        '''
+        Return the (size, max_age) at which buffered events of the given
+        class should be written to the database
+        '''
+        policy = settings.JOB_EVENT_BUFFER_POLICY.get(cls.__name__, {})
+        return (
+            policy.get('size', settings.JOB_EVENT_BUFFER_SIZE),
+            policy.get('max_age', settings.JOB_EVENT_BUFFER_SECONDS),
+        )
+
+    def should_flush(self, cls, events):
+        size, max_age = self.buffer_policy(cls)
+        return (
+            len(events) >= size or
+            time.time() - self.buff_started.get(cls, 0) >= max_age
+        )
+
     def flush(self, force=False):
         now = tz_now()
-        if (
-            force or
-            any([len(events) >= 1000 for events in self.buff.values()])
-        ):
-            for cls, events in self.buff.items():
-                logger.debug(f'{cls.__name__}.objects.bulk_create({len(events)})')
-                for e in events:
-                    if not e.created:
-                        e.created = now
-                    e.modified = now
-                try:
-                    cls.objects.bulk_create(events)
-                except Exception:
-                    # if an exception occurs, we should re-attempt to save the
-                    # events one-by-one, because something in the list is
-                    # broken/stale
-                    for e in events:
-                        try:
-                            e.save()
-                        except Exception:
-                            logger.exception('Database Error Saving Job Event')
-                for e in events:
-                    emit_event_detail(e)
-            self.buff = {}
-
-    def perform_work(self, body):
+        for cls, events in list(self.buff.items()):
+            if not (force or self.should_flush(cls, events)):
+                continue
+            started = time.time()
+            # the time at which each event was emitted by ansible-runner
+            emitted = [e.created for e in events if e.created]
+            for e in events:
+                if not e.created:
+                    e.created = now
+                e.modified = now
+            saved = self.save_events(cls, events)
+            saved_at = tz_now()
+            self.flush_size.labels(cls.__name__).observe(len(events))
+            self.flush_time.labels(cls.__name__).observe(time.time() - started)
+            for created in emitted:
+                self.event_latency.labels(cls.__name__).observe(max((saved_at - created).total_seconds(), 0))
+            # events that couldn't be saved have no side effects
+            if cls is JobEvent:
+                self.record_parents(saved)
+            self.record_stdout(saved)
+            emit_event_details(saved)
+            for e in saved:
+                if isinstance(e, JobEvent) and e.event == 'playbook_on_stats':
+                    # host summaries, computed fields, and notifications
+                    # are expensive for large inventories; hand them off to
+                    # the job finalization workers so that events for
+                    # other jobs aren't stuck waiting behind them
+                    try:
+                        self.finalize_queue.put(e)
+                    except redis.exceptions.RedisError:
+                        logger.exception(f'could not enqueue finalization for job {e.job_id}, finalizing inline')
+                        e.finalize_job()
+            del self.buff[cls]
+            self.buff_started.pop(cls, None)
+
+    def save_events(self, cls, events):
+        '''
+        Save a batch of events, and return the ones that were saved.
+
+        If the batch can't be saved because of what's in it, it's split in
+        half, and each half retried, so that only the bad event(s) are
+        discarded; other errors (e.g., losing the database connection) are
+        raised.
+        '''
+        if settings.JOB_EVENT_INGEST_ENGINE == 'copy' and django_connection.vendor == 'postgresql':
+            logger.debug(f'copy_events({cls.__name__}, {len(events)})')
+            insert = functools.partial(copy_events, cls)
+        else:
+            logger.debug(f'{cls.__name__}.objects.bulk_create({len(events)})')
+            insert = cls.objects.bulk_create
+        try:
+            insert(events)
+        except DATA_ERRORS:
+            if len(events) == 1:
+                logger.exception('Database Error Saving Job Event')
+                return []
+            middle = len(events) // 2
+            return self.save_events(cls, events[:middle]) + self.save_events(cls, events[middle:])
+        return events
+
+    def record_stdout(self, events):
+        try:
+            UnifiedJobStdoutChunk.add_events(events)
+        except DatabaseError:
+            logger.exception('Database Error Saving Job Stdout')
+
+    def record_parents(self, events):
+        '''
+        Remember the parents of changed and failed job events so that
+        changed/failed can be propagated to them when the job is finalized
+        '''
+        parents = {}
+        for e in events:
+            if e.parent_uuid and (e.changed or e.failed):
+                changed, failed = parents.setdefault(e.job_id, (set(), set()))
+                if e.changed:
+                    changed.add(e.parent_uuid)
+                if e.failed:
+                    failed.add(e.parent_uuid)
+        for job_id, (changed, failed) in parents.items():
+            try:
+                self.finalize_queue.add_parents(job_id, changed=changed, failed=failed)
+            except redis.exceptions.RedisError:
+                logger.exception(f'could not record changed/failed parents for job {job_id}')
+
+    def perform_work(self, bodies):
+        for body in bodies:
+            self.process_message(body)
+
+    def process_message(self, body):
         try:
             flush = body.get('event') == 'FLUSH'
             if flush:
@@ -174,8 +520,8 @@ class CallbackBrokerWorker(BaseWorker):
 
                         if isinstance(uj, Job):
                             # *actual playbooks* send their success/failure
-                            # notifications in response to the playbook_on_stats
-                            # event handling code in main.models.events
+                            # notifications when their playbook_on_stats event
+                            # is handled by a JobFinalizeWorker
                             pass
                         elif hasattr(uj, 'send_notification_templates'):
                             handle_success_and_failure_notifications.apply_async([uj.id])
@@ -185,6 +531,7 @@ class CallbackBrokerWorker(BaseWorker):
 
                 event = cls.create_from_data(**body)
                 self.buff.setdefault(cls, []).append(event)
+                self.buff_started.setdefault(cls, time.time())
 
             retries = 0
             while retries <= self.MAX_RETRIES:
@@ -210,3 +557,111 @@ class CallbackBrokerWorker(BaseWorker):
             tb = traceback.format_exc()
             logger.error('Callback Task Processor Raised Exception: %r', exc)
             logger.error('Detail: {}'.format(tb))
+
+
+class JobFinalizeWorker(BaseWorker):
+    '''
+    A worker implementation that applies the job-level side effects of
+    playbook_on_stats events (host summaries, inventory computed fields,
+    notifications) outside of the callback receiver's event ingest path.
+
+    Jobs are read in batches from a JobFinalizeQueue; within a batch,
+    inventory computed fields are updated once per inventory rather than once
+    per job.
+    '''
+
+    def __init__(self):
+        self.redis = redis.Redis.from_url(settings.BROKER_URL)
+        self.finalize_queue = JobFinalizeQueue(self.redis)
+        self.metrics = SubsystemMetrics('callback_receiver')
+        self.queue_depth = self.metrics.gauge(
+            'finalize_queue_depth', 'Number of jobs waiting for finalization'
+        )
+        self.wait_time = self.metrics.histogram(
+            'finalize_wait_seconds', 'Time jobs spent waiting for finalization',
+            buckets=(.1, .5, 1, 5, 10, 30, 60, 300, float('inf'))
+        )
+        self.finalize_time = self.metrics.histogram(
+            'finalize_seconds', 'Time spent finalizing a job',
+            buckets=(.1, .5, 1, 5, 10, 30, 60, 300, float('inf'))
+        )
+
+    def read(self, queue):
+        try:
+            return self.finalize_queue.get(timeout=settings.JOB_EVENT_BUFFER_SECONDS,
+                                           batch_size=settings.JOB_FINALIZE_BATCH_SIZE)
+        except redis.exceptions.RedisError:
+            logger.exception("encountered an error communicating with redis")
+            time.sleep(1)
+        except json.JSONDecodeError:
+            logger.exception("failed to decode JSON message from redis")
+        finally:
+            self.record_statistics()
+        return []
+
+    def record_statistics(self):
+        try:
+            self.queue_depth.set(len(self.finalize_queue))
+        except redis.exceptions.RedisError:
+            pass
+        self.metrics.send()
+
+    def perform_work(self, payloads):
+        # job id -> the inventory whose computed fields its finalization
+        # changed, for every job that doesn't need to be finalized again
+        finalized = {}
+        for payload in payloads:
+            self.wait_time.observe(max(time.time() - payload['queued'], 0))
+            start = time.time()
+            try:
+                event = JobEvent(
+                    id=payload['id'],
+                    job_id=payload['job_id'],
+                    event='playbook_on_stats',
+                    event_data=payload['event_data'],
+                )
+                event.host_map = payload['host_map']
+                event.finalize_job(
+                    update_inventory_computed_fields=False,
+                    changed_parents=payload['changed_parents'],
+                    failed_parents=payload['failed_parents'],
+                )
+                finalized[payload['job_id']] = event.job.inventory_id
+            except DatabaseError:
+                # e.g., the connection was lost; the job stays in flight, and
+                # is finalized again once JOB_FINALIZE_TIMEOUT has passed
+                logger.exception('Database error finalizing job {}, it will be retried'.format(payload.get('job_id')))
+                django_connection.close_if_unusable_or_obsolete()
+            except Exception:
+                # finalizing it again wouldn't go any differently
+                logger.exception('Worker failed to finalize job {}'.format(payload.get('job_id')))
+                finalized[payload['job_id']] = None
+            finally:
+                self.finalize_time.observe(time.time() - start)
+
+        # computed fields are updated before the jobs are acknowledged, so
+        # that if they can't be (or the worker dies first), the jobs are
+        # finalized, and their inventories updated, again
+        failed_inventory_ids = set()
+        inventory_ids = set(finalized.values()) - {None}
+        try:
+            inventories = list(Inventory.objects.filter(pk__in=inventory_ids))
+        except DatabaseError:
+            logger.exception('Database error loading inventories {}'.format(sorted(inventory_ids)))
+            django_connection.close_if_unusable_or_obsolete()
+            failed_inventory_ids, inventories = inventory_ids, []
+        for inventory in inventories:
+            try:
+                inventory.update_computed_fields()
+            except DatabaseError:
+                logger.exception('Computed fields database error updating inventory {}'.format(inventory.pk))
+                django_connection.close_if_unusable_or_obsolete()
+                failed_inventory_ids.add(inventory.pk)
+
+        for job_id, inventory_id in finalized.items():
+            if inventory_id in failed_inventory_ids:
+                continue
+            try:
+                self.finalize_queue.ack(job_id)
+            except redis.exceptions.RedisError:
+                logger.exception('could not acknowledge finalization of job {}'.format(job_id))
@@ -1025,6 +1025,13 @@ class OrderedManyToManyDescriptor(ManyToManyDescriptor):
                         '%s__position' % self.through._meta.model_name
                     )
 
+                def get_prefetch_queryset(self, instances, queryset=None):
+                    # prefetch_related() doesn't go through get_queryset()
+                    result = super(OrderedManyRelatedManager, self).get_prefetch_queryset(instances, queryset)
+                    return (result[0].order_by(
+                        '%s__position' % self.through._meta.model_name
+                    ),) + result[1:]
+
             return OrderedManyRelatedManager
 
         return add_custom_queryset_to_many_related_manager(
@@ -4,6 +4,7 @@
 from django.db import transaction
 from django.core.management.base import BaseCommand, CommandError
 
+from awx.main.dispatch.durable import remove_queue
 from awx.main.models import Instance
 from awx.main.utils.pglock import advisory_lock
 
@@ -32,6 +33,7 @@ class Command(BaseCommand):
             instance = Instance.objects.filter(hostname=hostname)
             if instance.exists():
                 instance.delete()
+                remove_queue(hostname)
                 print("Instance Removed")
                 print('Successfully deprovisioned {}'.format(hostname))
                 print('(changed: True)')
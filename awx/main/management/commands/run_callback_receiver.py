@@ -5,7 +5,8 @@ from django.conf import settings
 from django.core.management.base import BaseCommand
 
 from awx.main.dispatch.control import Control
-from awx.main.dispatch.worker import AWXConsumerRedis, CallbackBrokerWorker
+from awx.main.dispatch.pool import WorkerPool
+from awx.main.dispatch.worker import AWXConsumerRedis, CallbackBrokerWorker, JobFinalizeWorker
 
 
 class Command(BaseCommand):
@@ -26,10 +27,17 @@ class Command(BaseCommand):
             return
         consumer = None
         try:
+            # playbook_on_stats side effects (host summaries, computed fields,
+            # notifications) are handled by a dedicated set of processes so
+            # they don't hold up event ingestion; the consumer replaces any
+            # of them that exit
+            finalize_pool = WorkerPool(min_workers=settings.JOB_FINALIZE_WORKERS)
+            finalize_pool.init_workers(JobFinalizeWorker.forked_work_loop)
             consumer = AWXConsumerRedis(
                 'callback_receiver',
                 CallbackBrokerWorker(),
                 queues=[getattr(settings, 'CALLBACK_QUEUE', '')],
+                pools=[finalize_pool],
             )
             consumer.run()
         except KeyboardInterrupt:
@@ -9,7 +9,8 @@ from django.db import connection as django_connection
 
 from awx.main.dispatch import get_local_queuename, reaper
 from awx.main.dispatch.control import Control
-from awx.main.dispatch.pool import AutoscalePool
+from awx.main.dispatch.durable import queued_uuids
+from awx.main.dispatch.pool import AutoscalePool, RoutedPool
 from awx.main.dispatch.worker import AWXConsumerPG, TaskWorker
 from awx.main.dispatch import periodic
 
@@ -52,16 +53,22 @@ class Command(BaseCommand):
         # (like the node heartbeat)
         periodic.run_continuously()
 
-        reaper.reap()
+        queues = ['tower_broadcast_all', get_local_queuename()]
+        # jobs whose messages are still queued will be started once they're
+        # read; don't reap them
+        reaper.reap(excluded_uuids=queued_uuids(queues))
         consumer = None
 
         try:
-            queues = ['tower_broadcast_all', get_local_queuename()]
+            if settings.DISPATCHER_WORKER_GROUPS:
+                pool = RoutedPool(min_workers=4)
+            else:
+                pool = AutoscalePool(min_workers=4)
             consumer = AWXConsumerPG(
                 'dispatcher',
                 TaskWorker(),
                 queues,
-                AutoscalePool(min_workers=4)
+                pool
             )
             consumer.run()
         except KeyboardInterrupt:
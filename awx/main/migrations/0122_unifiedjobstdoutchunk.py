@@ -0,0 +1,34 @@
+# Generated by Django 2.2.16 on 2020-10-14 15:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0121_delete_toweranalyticsstate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UnifiedJobStdoutChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chunk', models.PositiveIntegerField(editable=False)),
+                ('start_line', models.PositiveIntegerField(default=0, editable=False)),
+                ('end_line', models.PositiveIntegerField(default=0, editable=False)),
+                ('size', models.PositiveIntegerField(default=0, editable=False, help_text='The number of characters of stdout in this chunk.')),
+                ('complete', models.BooleanField(default=False, editable=False, help_text='Whether this chunk has been compacted, and the chunks of its job hold the stdout of every event.')),
+                ('data', models.BinaryField(editable=False)),
+                ('unified_job', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='stdout_chunks', to='main.UnifiedJob')),
+            ],
+            options={
+                'index_together': {('unified_job', 'chunk')},
+            },
+        ),
+        migrations.AddIndex(
+            model_name='unifiedjobstdoutchunk',
+            index=models.Index(condition=models.Q(complete=False), fields=['unified_job'], name='main_stdoutchunk_incomplete'),
+        ),
+    ]
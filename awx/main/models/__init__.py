@@ -12,7 +12,7 @@ from awx.main.models.base import (  # noqa
     CLOUD_INVENTORY_SOURCES, VERBOSITY_CHOICES
 )
 from awx.main.models.unified_jobs import (  # noqa
-    UnifiedJob, UnifiedJobTemplate, StdoutMaxBytesExceeded
+    UnifiedJob, UnifiedJobTemplate, UnifiedJobStdoutChunk, StdoutMaxBytesExceeded
 )
 from awx.main.models.organization import (  # noqa
     Organization, Profile, Team, UserSessionMembership
@@ -65,12 +65,16 @@ MINIMAL_EVENTS = set([
 ])
 
 
-def emit_event_detail(event):
+def event_detail_payload(event):
+    '''
+    Return the (group, payload) that describes `event` to websocket clients,
+    or None if it shouldn't be emitted
+    '''
     if (
         settings.UI_LIVE_UPDATES_ENABLED is False and
         event.event not in MINIMAL_EVENTS
     ):
-        return
+        return None
     cls = event.__class__
     relation = {
         JobEvent: 'job_id',
@@ -86,7 +90,7 @@ def emit_event_detail(event):
         url = '/api/v2/ad_hoc_command_events/{}'.format(event.id)
     group = camelcase_to_underscore(cls.__name__) + 's'
     timestamp = event.created.isoformat()
-    consumers.emit_channel_notification(
+    return (
         '-'.join([group, str(getattr(event, relation))]),
         {
             'id': event.id,
@@ -113,6 +117,25 @@ def emit_event_detail(event):
     )
 
 
+def emit_event_detail(event):
+    detail = event_detail_payload(event)
+    if detail is not None:
+        consumers.emit_channel_notification(*detail)
+
+
+def emit_event_details(events):
+    '''
+    Emit many events using one channel layer message per group (i.e., per
+    job) rather than one per event
+    '''
+    groups = {}
+    for event in events:
+        detail = event_detail_payload(event)
+        if detail is not None:
+            group, payload = detail
+            groups.setdefault(group, []).append(payload)
+    for group, payloads in groups.items():
+        consumers.emit_channel_notification_batch(group, payloads)
 
 
 class BasePlaybookEvent(CreatedModifiedModel):
@@ -349,39 +372,6 @@ class BasePlaybookEvent(CreatedModifiedModel):
             except (AttributeError, TypeError):
                 pass
 
-            if isinstance(self, JobEvent):
-                try:
-                    job = self.job
-                except ObjectDoesNotExist:
-                    job = None
-                if job:
-                    hostnames = self._hostnames()
-                    self._update_host_summary_from_stats(set(hostnames))
-                    if job.inventory:
-                        try:
-                            job.inventory.update_computed_fields()
-                        except DatabaseError:
-                            logger.exception('Computed fields database error saving event {}'.format(self.pk))
-
-                    # find parent links and progagate changed=T and failed=T
-                    changed = job.job_events.filter(changed=True).exclude(parent_uuid=None).only('parent_uuid').values_list('parent_uuid', flat=True).distinct()  # noqa
-                    failed = job.job_events.filter(failed=True).exclude(parent_uuid=None).only('parent_uuid').values_list('parent_uuid', flat=True).distinct()  # noqa
-
-                    JobEvent.objects.filter(
-                        job_id=self.job_id, uuid__in=changed
-                    ).update(changed=True)
-                    JobEvent.objects.filter(
-                        job_id=self.job_id, uuid__in=failed
-                    ).update(failed=True)
-
-                    # send success/failure notifications when we've finished handling the playbook_on_stats event
-                    from awx.main.tasks import handle_success_and_failure_notifications  # circular import
-
-                    def _send_notifications():
-                        handle_success_and_failure_notifications.apply_async([job.id])
-                    connection.on_commit(_send_notifications)
-
-
         for field in ('playbook', 'play', 'task', 'role'):
             value = force_text(event_data.get(field, '')).strip()
             if value != getattr(self, field):
@@ -448,6 +438,10 @@ class JobEvent(BasePlaybookEvent):
     '''
 
     VALID_KEYS = BasePlaybookEvent.VALID_KEYS + ['job_id', 'workflow_job_id']
+    JOB_REFERENCE = 'job_id'
+
+    # the maximum number of parent UUIDs per changed/failed propagation UPDATE
+    PARENT_UPDATE_BATCH_SIZE = 1000
 
     class Meta:
         app_label = 'main'
@@ -501,6 +495,55 @@ class JobEvent(BasePlaybookEvent):
             pass
         return hostnames
 
+    def finalize_job(self, update_inventory_computed_fields=True, changed_parents=None, failed_parents=None):
+        '''
+        Apply the job-level side effects of a playbook_on_stats event: host
+        summaries, Host.last_job linkage, inventory computed fields, changed /
+        failed parent propagation, and success/failure notifications.
+
+        The callback receiver does *not* call this inline when it saves the
+        stats event; it defers it to a pool of job finalization workers (see
+        awx.main.dispatch.worker.callback.JobFinalizeWorker).
+
+        `changed_parents` and `failed_parents` are the UUIDs of events which
+        have changed/failed children; the callback receiver collects these as
+        it saves events.  If they're not provided, they're discovered by
+        scanning all of the job's events.
+        '''
+        try:
+            job = self.job
+        except ObjectDoesNotExist:
+            job = None
+        if not job:
+            return
+
+        hostnames = self._hostnames()
+        self._update_host_summary_from_stats(set(hostnames))
+        if update_inventory_computed_fields and job.inventory:
+            try:
+                job.inventory.update_computed_fields()
+            except DatabaseError:
+                logger.exception('Computed fields database error saving event {}'.format(self.pk))
+
+        # find parent links and progagate changed=T and failed=T
+        for field, uuids in (('changed', changed_parents), ('failed', failed_parents)):
+            if uuids is None:
+                uuids = job.job_events.filter(**{field: True}).exclude(parent_uuid=None).only('parent_uuid').values_list('parent_uuid', flat=True).distinct()  # noqa
+                JobEvent.objects.filter(job_id=self.job_id, uuid__in=uuids).update(**{field: True})
+                continue
+            uuids = list(uuids)
+            for i in range(0, len(uuids), self.PARENT_UPDATE_BATCH_SIZE):
+                JobEvent.objects.filter(
+                    job_id=self.job_id, uuid__in=uuids[i:i + self.PARENT_UPDATE_BATCH_SIZE]
+                ).update(**{field: True})
+
+        # send success/failure notifications when we've finished handling the playbook_on_stats event
+        from awx.main.tasks import handle_success_and_failure_notifications  # circular import
+
+        def _send_notifications():
+            handle_success_and_failure_notifications.apply_async([job.id])
+        connection.on_commit(_send_notifications)
+
     def _update_host_summary_from_stats(self, hostnames):
         with ignore_inventory_computed_fields():
             try:
@@ -518,8 +561,12 @@ class JobEvent(BasePlaybookEvent):
             ).only('id')
             existing_host_ids = set(h.id for h in all_hosts)
 
+            # a job may be finalized more than once (e.g., if the worker
+            # finalizing it dies part way through)
+            summarized = set(JobHostSummary.objects.filter(job_id=job.id).values_list('host_name', flat=True))
+
             summaries = dict()
-            for host in hostnames:
+            for host in hostnames - summarized:
                 host_id = self.host_map.get(host, None)
                 if host_id not in existing_host_ids:
                     host_id = None
@@ -568,6 +615,7 @@ class JobEvent(BasePlaybookEvent):
 class ProjectUpdateEvent(BasePlaybookEvent):
 
     VALID_KEYS = BasePlaybookEvent.VALID_KEYS + ['project_update_id', 'workflow_job_id']
+    JOB_REFERENCE = 'project_update_id'
 
     class Meta:
         app_label = 'main'
@@ -691,6 +739,7 @@ class AdHocCommandEvent(BaseCommandEvent):
     VALID_KEYS = BaseCommandEvent.VALID_KEYS + [
         'ad_hoc_command_id', 'event', 'host_name', 'host_id', 'workflow_job_id'
     ]
+    JOB_REFERENCE = 'ad_hoc_command_id'
 
     class Meta:
         app_label = 'main'
@@ -784,6 +833,7 @@ class AdHocCommandEvent(BaseCommandEvent):
 class InventoryUpdateEvent(BaseCommandEvent):
 
     VALID_KEYS = BaseCommandEvent.VALID_KEYS + ['inventory_update_id', 'workflow_job_id']
+    JOB_REFERENCE = 'inventory_update_id'
 
     class Meta:
         app_label = 'main'
@@ -818,6 +868,7 @@ class InventoryUpdateEvent(BaseCommandEvent):
 class SystemJobEvent(BaseCommandEvent):
 
     VALID_KEYS = BaseCommandEvent.VALID_KEYS + ['system_job_id']
+    JOB_REFERENCE = 'system_job_id'
 
     class Meta:
         app_label = 'main'
@@ -4,19 +4,17 @@
 # Python
 from io import StringIO
 import datetime
-import codecs
+import functools
 import json
 import logging
-import os
 import re
 import socket
-import subprocess
-import tempfile
+import zlib
 from collections import OrderedDict
 
 # Django
 from django.conf import settings
-from django.db import models, connection
+from django.db import models, connection, transaction
 from django.core.exceptions import NON_FIELD_ERRORS
 from django.utils.translation import ugettext_lazy as _
 from django.utils.timezone import now
@@ -49,10 +47,10 @@ from awx.main.utils import (
 )
 from awx.main.constants import ACTIVE_STATES, CAN_CANCEL
 from awx.main.redact import UriCleaner, REPLACE_STR
-from awx.main.consumers import emit_channel_notification
+from awx.main.consumers import emit_channel_notification, emit_channel_notification_batch
 from awx.main.fields import JSONField, AskForField, OrderedManyToManyField
 
-__all__ = ['UnifiedJobTemplate', 'UnifiedJob', 'StdoutMaxBytesExceeded']
+__all__ = ['UnifiedJobTemplate', 'UnifiedJob', 'UnifiedJobStdoutChunk', 'StdoutMaxBytesExceeded']
 
 logger = logging.getLogger('awx.main.models.unified_jobs')
 
@@ -526,6 +524,69 @@ class StdoutMaxBytesExceeded(Exception):
         self.supported = supported
 
 
+def _stdout_lines(stdout, start_line=0, end_line=0):
+    '''
+    Yield the lines of an event's stdout, unescaping line endings
+
+    The callback plugin strips the final line ending from each event's
+    stdout, and records the number of lines it spans as [start_line,
+    end_line); as with COPY ... TO STDOUT (which terminates every row with a
+    newline), a line ending at the very end of stdout is followed by a blank
+    line, and exactly that many lines are yielded.  For events that don't
+    record the lines they span, a trailing line ending doesn't add a blank
+    line.
+    '''
+    lines = stdout.replace('\r\n', '\n').split('\n')
+    if end_line > start_line:
+        lines = lines[:end_line - start_line]
+    elif lines[-1] == '':
+        lines.pop()
+    for line in lines:
+        yield line + '\n'
+
+
+class StdoutLineReader(object):
+    '''
+    A minimal read-only file-like object over an iterable of lines, which
+    are only produced as they're read
+    '''
+
+    def __init__(self, lines):
+        self._lines = iter(lines)
+        self._buff = ''
+
+    def readline(self, size=-1):
+        if not self._buff:
+            self._buff = next(self._lines, '')
+        if size is not None and 0 <= size < len(self._buff):
+            line, self._buff = self._buff[:size], self._buff[size:]
+        else:
+            line, self._buff = self._buff, ''
+        return line
+
+    def readlines(self):
+        return list(self)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return ''.join(self)
+        data = []
+        remaining = size
+        while remaining > 0:
+            line = self.readline(remaining)
+            if not line:
+                break
+            data.append(line)
+            remaining -= len(line)
+        return ''.join(data)
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def close(self):
+        pass
+
+
 class UnifiedJob(PolymorphicModel, PasswordFieldsModel, CommonModelNameNotUnique,
                  UnifiedJobTypeStringMixin, TaskManagerUnifiedJobMixin):
     '''
@@ -814,6 +875,7 @@ class UnifiedJob(PolymorphicModel, PasswordFieldsModel, CommonModelNameNotUnique
 
         # Get status before save...
         status_before = self.status or 'new'
+        created = not self.pk
 
         # If this job already exists in the database, retrieve a copy of
         # the job in its prior state.
@@ -875,6 +937,11 @@ class UnifiedJob(PolymorphicModel, PasswordFieldsModel, CommonModelNameNotUnique
         if self.status != status_before:
             self._update_parent_instance()
 
+        # Let the task manager know this job may need to be (re)scheduled.
+        if created or self.status != status_before:
+            from awx.main.scheduler.state import record_transition  # circular import
+            record_transition(self)
+
         # Done.
         return result
 
@@ -1015,28 +1082,26 @@ class UnifiedJob(PolymorphicModel, PasswordFieldsModel, CommonModelNameNotUnique
         `settings.STDOUT_MAX_BYTES_DISPLAY`, a StdoutMaxBytesExceeded exception
         will be raised.
         """
+        if not enforce_max_bytes:
+            # If enforce_max_bytes = False, that means they're downloading
+            # the entire file; read it incrementally rather than buffering it
+            # all in memory (or on disk)
+            return StdoutLineReader(self.result_stdout_raw_lines())
+
         max_supported = settings.STDOUT_MAX_BYTES_DISPLAY
 
-        if enforce_max_bytes:
-            # If enforce_max_bytes is True, we're not grabbing the whole file,
-            # just the first <settings.STDOUT_MAX_BYTES_DISPLAY> bytes;
-            # in this scenario, it's probably safe to use a StringIO.
-            fd = StringIO()
-        else:
-            # If enforce_max_bytes = False, that means they're downloading
-            # the entire file.  To avoid ballooning memory, let's write the
-            # stdout content to a temporary disk location
-            if not os.path.exists(settings.JOBOUTPUT_ROOT):
-                os.makedirs(settings.JOBOUTPUT_ROOT)
-            fd = tempfile.NamedTemporaryFile(
-                mode='w',
-                prefix='{}-{}-'.format(self.model_to_str(), self.pk),
-                suffix='.out',
-                dir=settings.JOBOUTPUT_ROOT,
-                encoding='utf-8'
-            )
-            from awx.main.tasks import purge_old_stdout_files  # circular import
-            purge_old_stdout_files.apply_async()
+        if self.has_complete_stdout_chunks:
+            # stdout recorded by the callback receiver as events were saved
+            # can be read incrementally, straight from the database
+            total = self.stdout_chunks.aggregate(total=models.Sum('size'))['total'] or 0
+            if total > max_supported:
+                raise StdoutMaxBytesExceeded(total, max_supported)
+            return StdoutLineReader(self.stdout_chunk_lines())
+
+        # We're not grabbing the whole file, just the first
+        # <settings.STDOUT_MAX_BYTES_DISPLAY> bytes; in this scenario, it's
+        # probably safe to use a StringIO.
+        fd = StringIO()
 
         # Before the addition of event-based stdout, older versions of
         # awx stored stdout as raw text blobs in a certain database column
@@ -1045,16 +1110,12 @@ class UnifiedJob(PolymorphicModel, PasswordFieldsModel, CommonModelNameNotUnique
         # it and use if it exists
         legacy_stdout_text = self.result_stdout_text
         if legacy_stdout_text:
-            if enforce_max_bytes and len(legacy_stdout_text) > max_supported:
+            if len(legacy_stdout_text) > max_supported:
                 raise StdoutMaxBytesExceeded(len(legacy_stdout_text), max_supported)
             fd.write(legacy_stdout_text)
-            if hasattr(fd, 'name'):
-                fd.flush()
-                return codecs.open(fd.name, 'r', encoding='utf-8')
-            else:
-                # we just wrote to this StringIO, so rewind it
-                fd.seek(0)
-                return fd
+            # we just wrote to this StringIO, so rewind it
+            fd.seek(0)
+            return fd
         else:
             # Note: the code in this block _intentionally_ does not use the
             # Django ORM because of the potential size (many MB+) of
@@ -1066,15 +1127,14 @@ class UnifiedJob(PolymorphicModel, PasswordFieldsModel, CommonModelNameNotUnique
 
             with connection.cursor() as cursor:
 
-                if enforce_max_bytes:
-                    # detect the length of all stdout for this UnifiedJob, and
-                    # if it exceeds settings.STDOUT_MAX_BYTES_DISPLAY bytes,
-                    # don't bother actually fetching the data
-                    total = self.get_event_queryset().aggregate(
-                        total=models.Sum(models.Func(models.F('stdout'), function='LENGTH'))
-                    )['total'] or 0
-                    if total > max_supported:
-                        raise StdoutMaxBytesExceeded(total, max_supported)
+                # detect the length of all stdout for this UnifiedJob, and
+                # if it exceeds settings.STDOUT_MAX_BYTES_DISPLAY bytes,
+                # don't bother actually fetching the data
+                total = self.get_event_queryset().aggregate(
+                    total=models.Sum(models.Func(models.F('stdout'), function='LENGTH'))
+                )['total'] or 0
+                if total > max_supported:
+                    raise StdoutMaxBytesExceeded(total, max_supported)
 
                 # psycopg2's copy_expert writes bytes, but callers of this
                 # function assume a str-based fd will be returned; decode
@@ -1091,17 +1151,51 @@ class UnifiedJob(PolymorphicModel, PasswordFieldsModel, CommonModelNameNotUnique
                     fd
                 )
 
-                if hasattr(fd, 'name'):
-                    # If we're dealing with a physical file, use `sed` to clean
-                    # up escaped line sequences
-                    fd.flush()
-                    subprocess.Popen("sed -i 's/\\\\r\\\\n/\\n/g' {}".format(fd.name), shell=True).wait()
-                    return codecs.open(fd.name, 'r', encoding='utf-8')
-                else:
-                    # If we're dealing with an in-memory string buffer, use
-                    # string.replace()
-                    fd = StringIO(fd.getvalue().replace('\\r\\n', '\n'))
-                    return fd
+                # clean up escaped line sequences
+                return StringIO(fd.getvalue().replace('\\r\\n', '\n'))
+
+    def result_stdout_raw_lines(self):
+        '''
+        Yield all stdout for the UnifiedJob, line by line, without holding more
+        than a batch of events' stdout in memory at once
+        '''
+        if self.has_complete_stdout_chunks:
+            yield from self.stdout_chunk_lines()
+            return
+
+        legacy_stdout_text = self.result_stdout_text
+        if legacy_stdout_text:
+            yield from StringIO(legacy_stdout_text)
+            return
+
+        # On PostgreSQL, .iterator() reads from a server-side cursor; as with
+        # copy_expert above, only the `stdout` column is fetched, and no
+        # model objects are constructed
+        events = self.get_event_queryset().exclude(stdout='').order_by('start_line')
+        for stdout, start, end in events.values_list('stdout', 'start_line', 'end_line').iterator(
+            chunk_size=settings.STDOUT_STREAM_BATCH_SIZE
+        ):
+            yield from _stdout_lines(stdout, start, end)
+
+    @property
+    def has_complete_stdout_chunks(self):
+        '''
+        Whether stdout can be served from UnifiedJobStdoutChunks; this is only
+        the case once they've been compacted, and are known to hold the
+        stdout of every event
+        '''
+        return set(self.stdout_chunks.values_list('complete', flat=True).distinct()) == {True}
+
+    def stdout_chunk_lines(self, start_line=0, end_line=None):
+        '''
+        Yield the lines of stdout in [start_line, end_line), reading only the
+        stdout chunks that overlap that range
+        '''
+        chunks = self.stdout_chunks.filter(end_line__gt=start_line)
+        if end_line is not None:
+            chunks = chunks.filter(start_line__lt=end_line)
+        for chunk in chunks.order_by('chunk').iterator():
+            yield from chunk.lines(start_line, end_line)
 
     def _escape_ascii(self, content):
         # Remove ANSI escape sequences used to embed event data.
@@ -1126,25 +1220,88 @@ class UnifiedJob(PolymorphicModel, PasswordFieldsModel, CommonModelNameNotUnique
     def result_stdout(self):
         return self._result_stdout_raw(escape_ascii=True)
 
+    @staticmethod
+    def _stdout_range(start_line, end_line, absolute_end):
+        start_actual = int(start_line)
+        if start_actual < 0:
+            start_actual = max(absolute_end + start_actual, 0)
+            end_actual = absolute_end
+        elif end_line is not None:
+            end_actual = min(int(end_line), absolute_end)
+        else:
+            end_actual = absolute_end
+        return start_actual, end_actual
+
+    def _stdout_chunks_limited(self, start_line=0, end_line=None):
+        absolute_end = self.stdout_chunks.aggregate(end=models.Max('end_line'))['end'] or 0
+        start_actual, end_actual = self._stdout_range(start_line, end_line, absolute_end)
+
+        max_supported = settings.STDOUT_MAX_BYTES_DISPLAY
+        total = self.stdout_chunks.filter(
+            end_line__gt=start_actual, start_line__lt=end_actual
+        ).aggregate(total=models.Sum('size'))['total'] or 0
+        if total > max_supported:
+            raise StdoutMaxBytesExceeded(total, max_supported)
+
+        content = ''.join(self.stdout_chunk_lines(start_actual, end_actual))
+        return content, start_actual, end_actual, absolute_end
+
+    def _stdout_events_limited(self, start_line=0, end_line=None):
+        events = self.get_event_queryset()
+        absolute_end = events.aggregate(end=models.Max('end_line'))['end'] or 0
+        if not absolute_end:
+            # these events don't record which lines of stdout they span
+            return None
+        start_actual, end_actual = self._stdout_range(start_line, end_line, absolute_end)
+
+        # (job, start_line) and (job, end_line) are both indexed, so only the
+        # events that overlap the requested lines are read
+        events = events.filter(
+            end_line__gt=start_actual, start_line__lt=end_actual
+        ).exclude(stdout='')
+
+        max_supported = settings.STDOUT_MAX_BYTES_DISPLAY
+        total = events.aggregate(
+            total=models.Sum(models.Func(models.F('stdout'), function='LENGTH'))
+        )['total'] or 0
+        if total > max_supported:
+            raise StdoutMaxBytesExceeded(total, max_supported)
+
+        content = StringIO()
+        for stdout, event_start, event_end in events.order_by('start_line').values_list('stdout', 'start_line', 'end_line'):
+            for lineno, line in enumerate(_stdout_lines(stdout, event_start, event_end), event_start):
+                if start_actual <= lineno < end_actual:
+                    content.write(line)
+        return content.getvalue(), start_actual, end_actual, absolute_end
+
     def _result_stdout_raw_limited(self, start_line=0, end_line=None, redact_sensitive=True, escape_ascii=False):
-        return_buffer = StringIO()
-        if end_line is not None:
-            end_line = int(end_line)
-        stdout_lines = self.result_stdout_raw_handle().readlines()
-        absolute_end = len(stdout_lines)
-        for line in stdout_lines[int(start_line):end_line]:
-            return_buffer.write(line)
-        if int(start_line) < 0:
-            start_actual = len(stdout_lines) + int(start_line)
-            end_actual = len(stdout_lines)
+        limited = None
+        if self.has_complete_stdout_chunks:
+            limited = self._stdout_chunks_limited(start_line, end_line)
+        elif not self.result_stdout_text:
+            limited = self._stdout_events_limited(start_line, end_line)
+
+        if limited is not None:
+            return_buffer, start_actual, end_actual, absolute_end = limited
         else:
-            start_actual = int(start_line)
+            return_buffer = StringIO()
             if end_line is not None:
-                end_actual = min(int(end_line), len(stdout_lines))
-            else:
+                end_line = int(end_line)
+            stdout_lines = self.result_stdout_raw_handle().readlines()
+            absolute_end = len(stdout_lines)
+            for line in stdout_lines[int(start_line):end_line]:
+                return_buffer.write(line)
+            if int(start_line) < 0:
+                start_actual = len(stdout_lines) + int(start_line)
                 end_actual = len(stdout_lines)
+            else:
+                start_actual = int(start_line)
+                if end_line is not None:
+                    end_actual = min(int(end_line), len(stdout_lines))
+                else:
+                    end_actual = len(stdout_lines)
+            return_buffer = return_buffer.getvalue()
 
-        return_buffer = return_buffer.getvalue()
         if redact_sensitive:
             return_buffer = UriCleaner.remove_sensitive(return_buffer)
         if escape_ascii:
@@ -1231,20 +1388,24 @@ class UnifiedJob(PolymorphicModel, PasswordFieldsModel, CommonModelNameNotUnique
                                        workflow_node_id=self.workflow_node_id))
         return websocket_data
 
+    def _websocket_status_data(self, status):
+        status_data = dict(unified_job_id=self.id, status=status)
+        if status == 'waiting':
+            if self.instance_group:
+                status_data['instance_group_name'] = self.instance_group.name
+            else:
+                status_data['instance_group_name'] = None
+        elif status in ['successful', 'failed', 'canceled'] and self.finished:
+            status_data['finished'] = datetime.datetime.strftime(self.finished, "%Y-%m-%dT%H:%M:%S.%fZ")
+        status_data.update(self.websocket_emit_data())
+        status_data['group_name'] = 'jobs'
+        if getattr(self, 'unified_job_template_id', None):
+            status_data['unified_job_template_id'] = self.unified_job_template_id
+        return status_data
+
     def _websocket_emit_status(self, status):
         try:
-            status_data = dict(unified_job_id=self.id, status=status)
-            if status == 'waiting':
-                if self.instance_group:
-                    status_data['instance_group_name'] = self.instance_group.name
-                else:
-                    status_data['instance_group_name'] = None
-            elif status in ['successful', 'failed', 'canceled'] and self.finished:
-                status_data['finished'] = datetime.datetime.strftime(self.finished, "%Y-%m-%dT%H:%M:%S.%fZ")
-            status_data.update(self.websocket_emit_data())
-            status_data['group_name'] = 'jobs'
-            if getattr(self, 'unified_job_template_id', None):
-                status_data['unified_job_template_id'] = self.unified_job_template_id
+            status_data = self._websocket_status_data(status)
             emit_channel_notification('jobs-status_changed', status_data)
 
             if self.spawned_by_workflow:
@@ -1259,6 +1420,41 @@ class UnifiedJob(PolymorphicModel, PasswordFieldsModel, CommonModelNameNotUnique
         if hasattr(self, 'update_webhook_status'):
             connection.on_commit(lambda: self.update_webhook_status(status))
 
+    @classmethod
+    def _websocket_emit_status_batch(cls, unified_jobs, status):
+        try:
+            payloads = []
+            workflow_payloads = OrderedDict()
+            for unified_job in unified_jobs:
+                status_data = unified_job._websocket_status_data(status)
+                payloads.append(status_data)
+                if unified_job.spawned_by_workflow:
+                    workflow_payloads.setdefault(unified_job.workflow_job_id, []).append(dict(
+                        status_data,
+                        group_name='workflow_events',
+                        workflow_job_template_id=unified_job.unified_job_template_id
+                    ))
+            emit_channel_notification_batch('jobs-status_changed', payloads)
+            for workflow_job_id, workflow_status_data in workflow_payloads.items():
+                emit_channel_notification_batch('workflow_events-' + str(workflow_job_id), workflow_status_data)
+        except IOError:  # includes socket errors
+            logger.exception('failed to emit channel msgs about status change of %d unified jobs', len(unified_jobs))
+
+    @classmethod
+    def websocket_emit_status_batch(cls, unified_jobs, status):
+        '''
+        Like websocket_emit_status, for many unified jobs at once; their status
+        is sent over the channel layer in a single message per group
+        '''
+        unified_jobs = list(unified_jobs)
+        if not unified_jobs:
+            return
+        connection.on_commit(lambda: cls._websocket_emit_status_batch(unified_jobs, status))
+        for unified_job in unified_jobs:
+            # only jobs launched by a webhook report their status back to it
+            if getattr(unified_job, 'webhook_credential_id', None):
+                connection.on_commit(functools.partial(unified_job.update_webhook_status, status))
+
     def notification_data(self):
         return dict(id=self.id,
                     name=self.name,
@@ -1478,3 +1674,160 @@ class UnifiedJob(PolymorphicModel, PasswordFieldsModel, CommonModelNameNotUnique
     @property
     def is_containerized(self):
         return False
+
+
+class UnifiedJobStdoutChunk(models.Model):
+    '''
+    A compressed slice of the stdout of a UnifiedJob, built by the callback
+    receiver as events are saved.
+
+    Chunk N holds the stdout of every event whose start_line falls in
+    [N * STDOUT_CHUNK_LINES, (N + 1) * STDOUT_CHUNK_LINES).  Because an event
+    may extend past the end of the chunk it starts in, `start_line` and
+    `end_line` record the range of lines the chunk actually covers, so that
+    any range of lines can be read by fetching just the chunks that overlap
+    it.
+
+    While a job runs, each batch of events saved by the callback receiver
+    appends a new row for every chunk it touches, without reading or locking
+    the rows already there.  Once the job has finished and all of its events
+    have been saved, `compact()` merges the rows of each chunk into one, and
+    marks them `complete` if they hold the stdout of every event.  Stdout is
+    only served from complete chunks; until then, it's read from the events.
+    '''
+
+    class Meta:
+        app_label = 'main'
+        index_together = [('unified_job', 'chunk')]
+        indexes = [
+            # the chunks that still have to be compacted (or discarded)
+            models.Index(fields=['unified_job'], name='main_stdoutchunk_incomplete', condition=models.Q(complete=False)),
+        ]
+
+    id = models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')
+    unified_job = models.ForeignKey(
+        'UnifiedJob',
+        related_name='stdout_chunks',
+        on_delete=models.CASCADE,
+        editable=False,
+    )
+    chunk = models.PositiveIntegerField(
+        editable=False,
+    )
+    start_line = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+    )
+    end_line = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+    )
+    size = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        help_text=_('The number of characters of stdout in this chunk.'),
+    )
+    complete = models.BooleanField(
+        default=False,
+        editable=False,
+        help_text=_('Whether this chunk has been compacted, and the chunks of its job hold the stdout of every event.'),
+    )
+    # zlib-compressed JSON list of [start_line, end_line, stdout], one for
+    # each event, ordered by start_line
+    data = models.BinaryField(
+        editable=False,
+    )
+
+    @property
+    def segments(self):
+        if not self.data:
+            return []
+        return json.loads(zlib.decompress(bytes(self.data)).decode('utf-8'))
+
+    @segments.setter
+    def segments(self, segments):
+        segments = sorted(segments)
+        self.data = zlib.compress(json.dumps(segments).encode('utf-8'))
+        self.start_line = segments[0][0]
+        self.end_line = max(segment[1] for segment in segments)
+        self.size = sum(len(segment[2]) for segment in segments)
+
+    def lines(self, start_line=0, end_line=None):
+        '''
+        Yield the lines of stdout in this chunk in [start_line, end_line)
+        '''
+        for segment_start, segment_end, stdout in self.segments:
+            # split into lines (and clamped to [segment_start, segment_end))
+            # the same way as stdout read from events
+            for lineno, line in enumerate(_stdout_lines(stdout, segment_start, segment_end), segment_start):
+                if lineno < start_line:
+                    continue
+                if end_line is not None and lineno >= end_line:
+                    return
+                yield line
+
+    @classmethod
+    def add_events(cls, events):
+        '''
+        Append the stdout of a batch of (saved) events to the chunks of the
+        jobs they belong to
+        '''
+        chunk_lines = settings.STDOUT_CHUNK_LINES
+        if not chunk_lines:
+            return
+        segments = {}
+        for e in events:
+            if not e.stdout:
+                continue
+            key = (getattr(e, e.JOB_REFERENCE), e.start_line // chunk_lines)
+            segments.setdefault(key, []).append([e.start_line, e.end_line, e.stdout])
+        rows = []
+        for (unified_job_id, chunk), new_segments in sorted(segments.items()):
+            # events for the same job are saved by several callback receiver
+            # workers at once; rather than merging into (and locking) the
+            # existing row for this chunk, every batch appends its own, and
+            # they're merged by compact() once the job has finished
+            obj = cls(unified_job_id=unified_job_id, chunk=chunk)
+            obj.segments = new_segments
+            rows.append(obj)
+        cls.objects.bulk_create(rows)
+
+    @classmethod
+    def compact(cls, unified_job):
+        '''
+        Merge the rows appended for each chunk of a finished job's stdout into
+        one, and mark them complete if they hold the stdout of every one of
+        the job's events.  If they don't (for example, if the job started
+        before chunks were recorded, or some stdout failed to save), the
+        chunks are discarded and the job's stdout is served from its events.
+
+        Returns True if the job's stdout can be served from its chunks.
+        '''
+        with transaction.atomic():
+            rows = list(cls.objects.select_for_update().filter(
+                unified_job_id=unified_job.pk, complete=False
+            ).order_by('chunk', 'id'))
+            if not rows:
+                return False
+            chunks = OrderedDict()
+            for row in rows:
+                for segment in row.segments:
+                    chunks.setdefault(row.chunk, {})[segment[0]] = segment
+            cls.objects.filter(pk__in=[row.pk for row in rows]).delete()
+
+            expected = unified_job.get_event_queryset().exclude(stdout='').count()
+            recorded = sum(len(segments) for segments in chunks.values())
+            if recorded != expected:
+                logger.warning('Stdout chunks of {} hold {} of {} events, serving stdout from events'.format(
+                    unified_job.log_format, recorded, expected
+                ))
+                cls.objects.filter(unified_job_id=unified_job.pk).delete()
+                return False
+
+            compacted = []
+            for chunk, segments in chunks.items():
+                obj = cls(unified_job_id=unified_job.pk, chunk=chunk, complete=True)
+                obj.segments = segments.values()
+                compacted.append(obj)
+            cls.objects.bulk_create(compacted)
+        return True
@@ -9,6 +9,9 @@ import redis
 # Django
 from django.conf import settings
 
+# AWX
+from awx.main.utils import codec
+
 
 __all__ = ['CallbackQueueDispatcher']
 
@@ -32,4 +35,4 @@ class CallbackQueueDispatcher(object):
         self.connection = redis.Redis.from_url(settings.BROKER_URL)
 
     def dispatch(self, obj):
-        self.connection.rpush(self.queue, json.dumps(obj, cls=AnsibleJSONEncoder))
+        self.connection.rpush(self.queue, codec.dumps(obj, cls=AnsibleJSONEncoder))
@@ -59,6 +59,23 @@ class UriCleaner(object):
 
         return redactedtext
 
+    @staticmethod
+    def remove_sensitive_from_data(data):
+        '''
+        Apply remove_sensitive() to every string in a structure of (JSON-like)
+        dicts and lists, without serializing it
+        '''
+        if isinstance(data, str):
+            return UriCleaner.remove_sensitive(data)
+        if isinstance(data, dict):
+            return dict(
+                (k, UriCleaner.remove_sensitive_from_data(v))
+                for k, v in data.items()
+            )
+        if isinstance(data, (list, tuple)):
+            return [UriCleaner.remove_sensitive_from_data(v) for v in data]
+        return data
+
 
 class PlainTextCleaner(object):
     REPLACE_STR = REPLACE_STR
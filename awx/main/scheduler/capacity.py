@@ -0,0 +1,86 @@
+import random
+
+
+class CapacitySnapshot(object):
+    '''
+    A point-in-time view of every instance group, its instances, and the
+    capacity consumed on each instance, built once per task manager cycle from
+    the tasks it has already loaded.
+
+    Instance.consumed_capacity, Instance.jobs_running, and the InstanceGroup
+    methods that choose an instance for a task query the database every time
+    they're called; the task manager uses this snapshot instead, and keeps it
+    current as it starts tasks.
+    '''
+
+    def __init__(self, instance_groups, tasks=()):
+        # instance_groups should prefetch `instances` (and select `credential`)
+        self.groups = list(instance_groups)
+        self.groups_by_id = {}
+        self.instances = {}
+        # group name -> [hostname, ...], ordered by hostname
+        self.group_instances = {}
+        for group in self.groups:
+            self.groups_by_id[group.id] = group
+            hostnames = []
+            for instance in sorted(group.instances.all(), key=lambda i: i.hostname):
+                self.instances.setdefault(instance.hostname, instance)
+                hostnames.append(instance.hostname)
+            self.group_instances[group.name] = hostnames
+
+        # hostname -> capacity consumed by tasks that are waiting or running there
+        self.consumed_capacity = dict.fromkeys(self.instances, 0)
+        # hostname -> number of tasks that are waiting or running there
+        self.jobs_running = dict.fromkeys(self.instances, 0)
+        for task in tasks:
+            self.consume_capacity(task)
+
+    def consume_capacity(self, task):
+        hostname = task.execution_node
+        if hostname in self.consumed_capacity:
+            self.consumed_capacity[hostname] += task.task_impact
+            self.jobs_running[hostname] += 1
+
+    def remaining_capacity(self, instance):
+        return instance.capacity - self.consumed_capacity[instance.hostname]
+
+    def get_instances(self, instance_group):
+        return [self.instances[hostname] for hostname in self.group_instances.get(instance_group.name, [])]
+
+    def get_online_instances(self, instance_group):
+        return [i for i in self.get_instances(instance_group) if i.capacity > 0 and i.enabled]
+
+    def fit_task_to_most_remaining_capacity_instance(self, task, instance_group):
+        instance_most_capacity = None
+        most_remaining_capacity = None
+        for i in self.get_online_instances(instance_group):
+            remaining_capacity = self.remaining_capacity(i)
+            if remaining_capacity >= task.task_impact and \
+                    (instance_most_capacity is None or
+                     remaining_capacity > most_remaining_capacity):
+                instance_most_capacity = i
+                most_remaining_capacity = remaining_capacity
+        return instance_most_capacity
+
+    def find_largest_idle_instance(self, instance_group):
+        largest_instance = None
+        for i in self.get_online_instances(instance_group):
+            if self.jobs_running[i.hostname] == 0:
+                if largest_instance is None:
+                    largest_instance = i
+                elif i.capacity > largest_instance.capacity:
+                    largest_instance = i
+        return largest_instance
+
+    def get_controller(self, instance_group):
+        return self.groups_by_id.get(instance_group.controller_id)
+
+    def choose_controller_node(self, instance_group, online=True):
+        controller = self.get_controller(instance_group)
+        if controller is None:
+            raise IndexError('{} has no controller'.format(instance_group.name))
+        if online:
+            instances = self.get_online_instances(controller)
+        else:
+            instances = self.get_instances(controller)
+        return random.choice([i.hostname for i in instances])
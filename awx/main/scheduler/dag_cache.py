@@ -0,0 +1,142 @@
+# Python
+import logging
+
+# Django
+from django.conf import settings
+
+import redis
+
+# AWX
+from awx.main.models import UnifiedJob
+from awx.main.scheduler.dag_workflow import WorkflowDAG
+
+
+logger = logging.getLogger('awx.main.scheduler')
+
+# workflow job id -> version of its nodes, incremented by every task manager
+# cycle that changes them
+VERSIONS_KEY = 'awx_task_manager_workflow_versions'
+
+FINISHED_STATUSES = ('successful', 'failed', 'error', 'canceled')
+
+
+class WorkflowDAGCache(object):
+    '''
+    The WorkflowDAGs of running workflow jobs, kept between task manager
+    cycles by the process that runs them.
+
+    The nodes and edges of a workflow job never change once it has been
+    created, so each graph is built only once. Nodes only gain jobs and
+    do_not_run flags through the task manager itself, which updates the
+    cached nodes as it goes; all that needs to be reloaded on each cycle is
+    the status of the jobs that haven't finished yet, which are indexed by
+    job id so that each status change updates just the node that spawned the
+    job.
+
+    The task manager runs in whichever dispatcher worker (on whichever node)
+    picks it up, so every cycle that changes the nodes of a workflow job
+    bumps that workflow's version in Redis.  A graph is only discarded (and
+    rebuilt) if its workflow's nodes were changed by another process since
+    it was cached; cycles run elsewhere that leave it alone don't affect it.
+    '''
+
+    def __init__(self):
+        self.redis = redis.Redis.from_url(settings.BROKER_URL)
+        self.invalidate()
+
+    def invalidate(self):
+        # workflow job id -> WorkflowDAG
+        self.dags = {}
+        # workflow job id -> version of its nodes when last seen or changed
+        self.versions = {}
+        # id of an unfinished job -> (workflow job id, node that spawned it)
+        self.job_nodes = {}
+
+    def sync(self, workflow_jobs):
+        '''
+        Prepare the cache for a new task manager cycle, in which
+        `workflow_jobs` are running
+        '''
+        running = [workflow_job.id for workflow_job in workflow_jobs]
+        finished = [pk for pk in self.dags if pk not in set(running)]
+        for workflow_job_id in finished:
+            self.evict(workflow_job_id)
+        try:
+            if finished:
+                self.redis.hdel(VERSIONS_KEY, *finished)
+            versions = self.redis.hmget(VERSIONS_KEY, running) if running else []
+        except redis.RedisError:
+            logger.exception('could not read workflow versions, rebuilding workflow graphs')
+            self.invalidate()
+            return
+        for workflow_job_id, version in zip(running, versions):
+            version = int(version or 0)
+            if workflow_job_id in self.dags and self.versions.get(workflow_job_id) != version:
+                # another process changed this workflow's nodes
+                self.evict(workflow_job_id)
+            self.versions[workflow_job_id] = version
+        self.refresh()
+
+    def refresh(self):
+        if not self.job_nodes:
+            return
+        found = set()
+        for pk, status in UnifiedJob.objects.filter(id__in=list(self.job_nodes)).values_list('id', 'status'):
+            found.add(pk)
+            workflow_job_id, node = self.job_nodes[pk]
+            node.job.status = status
+            if status in FINISHED_STATUSES:
+                del self.job_nodes[pk]
+        for pk in set(self.job_nodes) - found:
+            # the job was deleted out from under its workflow
+            self.evict(self.job_nodes[pk][0])
+
+    def evict(self, workflow_job_id):
+        self.versions.pop(workflow_job_id, None)
+        dag = self.dags.pop(workflow_job_id, None)
+        if dag is None:
+            return
+        for node in dag.nodes:
+            self.job_nodes.pop(node['node_object'].job_id, None)
+
+    def get_dag(self, workflow_job):
+        dag = self.dags.get(workflow_job.id)
+        if dag is None:
+            dag = self.dags[workflow_job.id] = WorkflowDAG(workflow_job)
+            for node in dag.nodes:
+                self.add_job(workflow_job, node['node_object'])
+        return dag
+
+    def add_job(self, workflow_job, node):
+        '''
+        Start tracking the status of the job spawned by `node`
+        '''
+        if workflow_job.id in self.dags and node.job_id and node.job.status not in FINISHED_STATUSES:
+            self.job_nodes[node.job_id] = (workflow_job.id, node)
+
+    def changed(self, workflow_job):
+        '''
+        Note that this process changed the nodes of `workflow_job`, so that
+        other processes which have cached its graph rebuild it.  If this
+        can't be recorded, the error propagates, and the cycle (along with
+        the change) is rolled back.
+        '''
+        version = self.redis.hincrby(VERSIONS_KEY, workflow_job.id)
+        if workflow_job.id in self.dags and self.versions.get(workflow_job.id) == version - 1:
+            self.versions[workflow_job.id] = version
+        else:
+            # someone else changed it in the meantime
+            self.evict(workflow_job.id)
+
+
+_cache = None
+
+
+def get_workflow_dag_cache():
+    '''
+    Return the workflow graphs kept by this process
+    '''
+    global _cache
+    if _cache is None:
+        _cache = WorkflowDAGCache()
+    return _cache
@@ -33,7 +33,7 @@ class WorkflowDAG(SimpleDAG):
             filters = {
                 'from_workflowjobnode__workflow_job_id': workflow_job_or_jt.id
             }
-            workflow_nodes = workflow_job_or_jt.workflow_job_nodes
+            workflow_nodes = workflow_job_or_jt.workflow_job_nodes.select_related('job')
             success_nodes = WorkflowJobNode.success_nodes.through.objects.filter(**filters).values_list(*vals)
             failure_nodes = WorkflowJobNode.failure_nodes.through.objects.filter(**filters).values_list(*vals)
             always_nodes = WorkflowJobNode.always_nodes.through.objects.filter(**filters).values_list(*vals)
@@ -129,8 +129,12 @@ class WorkflowDAG(SimpleDAG):
             if not job:
                 continue
             elif job.can_cancel:
-                cancel_finished = False
-                job.cancel()
+                # the job may have been loaded by an earlier task manager
+                # cycle (see WorkflowDAGCache), so act on its current state
+                job.refresh_from_db()
+                if job.can_cancel:
+                    cancel_finished = False
+                    job.cancel()
         return cancel_finished
 
     def is_workflow_done(self):
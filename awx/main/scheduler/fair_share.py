@@ -0,0 +1,74 @@
+from collections import Counter, deque
+import heapq
+
+from django.conf import settings
+
+
+def get_share(task):
+    '''
+    The (organization, instance group) whose capacity a task uses (or, for a
+    pending task, will most likely use)
+    '''
+    if task.status == 'pending':
+        instance_groups = task.preferred_instance_groups
+        instance_group = instance_groups[0] if instance_groups else None
+    else:
+        instance_group = task.instance_group
+    return (task.organization_id, instance_group.name if instance_group else None)
+
+
+def get_priority(task):
+    return settings.TASK_MANAGER_TEMPLATE_PRIORITY.get(task.unified_job_template_id, 0)
+
+
+class FairShareQueue(object):
+    '''
+    Pending tasks, ordered so that no one organization can monopolize an
+    instance group by launching many tasks at once.
+
+    Tasks are grouped into one queue per share (organization and instance
+    group), ordered by the priority of their template
+    (TASK_MANAGER_TEMPLATE_PRIORITY), then by creation. A heap holds the next
+    task of each share, keyed by its priority, then by the number of tasks
+    its share is already running; so each task taken is the highest priority
+    task of the share using the least of its instance group.
+
+    Iterating yields each task once. Tasks that are blocked or that don't
+    fit aren't revisited; the next task of the same share takes their place.
+    '''
+
+    def __init__(self, pending_tasks, usage=None):
+        # share -> number of tasks it has waiting or running; shared between
+        # queues so that tasks started from one are counted by the next
+        self.usage = Counter() if usage is None else usage
+        self.queues = dict()
+        for task in pending_tasks:
+            self.queues.setdefault(get_share(task), []).append(task)
+        self.heap = []
+        for share, tasks in self.queues.items():
+            tasks.sort(key=lambda task: (-get_priority(task), task.created, task.id))
+            self.queues[share] = deque(tasks)
+            self.push(share)
+
+    @classmethod
+    def get_usage(cls, running_tasks):
+        return Counter(get_share(task) for task in running_tasks)
+
+    def push(self, share):
+        queue = self.queues[share]
+        if queue:
+            task = queue[0]
+            heapq.heappush(self.heap, (-get_priority(task), self.usage[share], task.created, task.id, share))
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def __iter__(self):
+        while self.heap:
+            share = heapq.heappop(self.heap)[-1]
+            task = self.queues[share].popleft()
+            yield task
+            # the task was started (or failed to start) while we yielded it
+            if task.status != 'pending':
+                self.usage[share] += 1
+            self.push(share)
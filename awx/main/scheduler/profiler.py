@@ -0,0 +1,154 @@
+# Python
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import logging
+import time
+
+# Django
+from django.conf import settings
+from django.db import connection
+from django.utils.timezone import now as tz_now
+
+import redis
+
+# AWX
+from awx.main.analytics.subsystem_metrics import SubsystemMetrics
+
+
+logger = logging.getLogger('awx.main.scheduler')
+
+# the most recent TASK_MANAGER_CYCLE_HISTORY cycles, newest first
+CYCLES_KEY = 'awx_task_manager_cycles'
+
+# what became of the pending tasks considered during a cycle
+OUTCOMES = ('blocked', 'started', 'skipped_capacity')
+
+
+class CycleMetrics(object):
+    '''
+    Task manager metrics, like all subsystem metrics, are kept (and
+    reported) per process: each dispatcher worker that runs a cycle reports
+    its own series, which are only sent when it runs one.  Cycles run in
+    whichever worker picks them up, so the series are kept for
+    TASK_MANAGER_METRICS_EXPIRE seconds rather than a few metrics intervals.
+    '''
+
+    def __init__(self):
+        self.metrics = SubsystemMetrics('task_manager', expire=settings.TASK_MANAGER_METRICS_EXPIRE)
+        self.cycle_time = self.metrics.histogram(
+            'cycle_seconds', 'Time spent in a task manager cycle',
+            buckets=(.1, .5, 1, 5, 10, 30, 60, 120, 300, float('inf'))
+        )
+        self.phase_time = self.metrics.histogram(
+            'phase_seconds', 'Time spent in each phase of a task manager cycle',
+            labelnames=['phase'],
+            buckets=(.01, .05, .1, .5, 1, 5, 10, 30, 60, 120, 300, float('inf'))
+        )
+        self.phase_queries = self.metrics.histogram(
+            'phase_queries', 'Number of database queries made in each phase of a task manager cycle',
+            labelnames=['phase'],
+            buckets=(1, 10, 100, 1000, 10000, 100000, float('inf'))
+        )
+        self.tasks = self.metrics.counter(
+            'tasks', 'Number of pending tasks blocked, started, or skipped for lack of capacity',
+            labelnames=['outcome']
+        )
+
+
+_metrics = None
+
+
+def get_metrics():
+    global _metrics
+    if _metrics is None:
+        _metrics = CycleMetrics()
+    return _metrics
+
+
+class CycleProfile(object):
+    '''
+    The wall time and number of database queries spent in each phase of a
+    single task manager cycle, and what became of the pending tasks it
+    considered.
+
+    When the cycle finishes, these are recorded as metrics (in
+    /api/v2/metrics/) and added to a short history of recent cycles (in
+    /api/v2/task_manager/cycles/).
+    '''
+
+    def __init__(self, shard=None):
+        self.shard = shard
+        self.started = tz_now()
+        self.start_time = time.time()
+        # phase name -> {'seconds': ..., 'queries': ...}
+        self.phases = OrderedDict()
+        self.tasks = dict.fromkeys(OUTCOMES, 0)
+
+    @contextmanager
+    def phase(self, name):
+        # phases may be entered more than once per cycle (their totals are
+        # summed), but must not be nested
+        totals = self.phases.setdefault(name, {'seconds': 0, 'queries': 0})
+
+        def count_queries(execute, sql, params, many, context):
+            totals['queries'] += 1
+            return execute(sql, params, many, context)
+
+        start = time.time()
+        try:
+            with connection.execute_wrapper(count_queries):
+                yield
+        finally:
+            totals['seconds'] += time.time() - start
+
+    def count(self, outcome):
+        self.tasks[outcome] += 1
+
+    def as_dict(self):
+        return OrderedDict([
+            ('started', self.started.isoformat()),
+            ('node', settings.CLUSTER_HOST_ID),
+            ('shard', self.shard),
+            ('seconds', time.time() - self.start_time),
+            ('queries', sum(p['queries'] for p in self.phases.values())),
+            ('phases', self.phases),
+            ('tasks', self.tasks),
+        ])
+
+    def finish(self):
+        cycle = self.as_dict()
+        logger.debug('Task manager cycle took {:.3f}s: {}'.format(cycle['seconds'], ', '.join(
+            '{} {:.3f}s/{} queries'.format(name, p['seconds'], p['queries'])
+            for name, p in self.phases.items()
+        )))
+
+        metrics = get_metrics()
+        metrics.cycle_time.observe(cycle['seconds'])
+        for name, p in self.phases.items():
+            metrics.phase_time.labels(phase=name).observe(p['seconds'])
+            metrics.phase_queries.labels(phase=name).observe(p['queries'])
+        for outcome, n in self.tasks.items():
+            metrics.tasks.labels(outcome=outcome).inc(n)
+        # cycles run several seconds apart, so there's no need to wait for
+        # SUBSYSTEM_METRICS_INTERVAL to pass
+        metrics.metrics.send(force=True)
+
+        try:
+            conn = redis.Redis.from_url(settings.BROKER_URL)
+            pipe = conn.pipeline()
+            pipe.lpush(CYCLES_KEY, json.dumps(cycle))
+            pipe.ltrim(CYCLES_KEY, 0, settings.TASK_MANAGER_CYCLE_HISTORY - 1)
+            pipe.execute()
+        except redis.RedisError:
+            logger.exception('could not record task manager cycle history')
+        return cycle
+
+
+def get_cycle_history():
+    '''
+    Return the most recent task manager cycles recorded by any node, newest
+    first
+    '''
+    conn = redis.Redis.from_url(settings.BROKER_URL)
+    return [json.loads(cycle) for cycle in conn.lrange(CYCLES_KEY, 0, -1)]
@@ -0,0 +1,205 @@
+# Python
+import json
+import logging
+import time
+import zlib
+
+# Django
+from django.conf import settings
+
+import redis
+
+
+logger = logging.getLogger('awx.main.scheduler')
+
+LEDGER_KEY_PREFIX = 'awx_task_manager_ledger'
+
+# incremented by every reservation, and every cycle that commits or rolls back
+LEDGER_SEQUENCE_KEY = 'awx_task_manager_ledger_sequence'
+
+# the dispatcher reaps task managers that run for longer than this
+LEDGER_TIMEOUT = 60 * 5
+
+
+def get_shard(task, count):
+    '''
+    Tasks are sharded by the template they were launched from, so that jobs
+    of the same template (which may block one another) are always scheduled
+    by the same shard.  Ad hoc commands have no template, and are sharded by
+    their own id.
+    '''
+    return (task.unified_job_template_id or task.id) % count
+
+
+def shard_order(count):
+    '''
+    The order in which this node should try to schedule each shard; every
+    node starts with a different shard, so that as long as there are at
+    least as many nodes as shards, each shard is usually scheduled by the
+    same node, and all of them are scheduled concurrently
+    '''
+    start = zlib.crc32(settings.CLUSTER_HOST_ID.encode('utf-8')) % count
+    return [(start + i) % count for i in range(count)]
+
+
+class CapacityLedger(object):
+    '''
+    The tasks that each shard of the task manager has started, which other
+    shards can't see in the database until the cycle that started them
+    commits.
+
+    Each entry reserves the capacity of a task on its instance group and
+    execution node.  At the start of its cycle (before it loads any tasks
+    from the database) a shard takes a snapshot of the entries of the others
+    that haven't committed yet; it consumes their capacity, and treats their
+    tasks as running when deciding what is blocked.
+
+    Reservations are made with an optimistic check-and-reserve: every
+    reservation (and every commit) increments a shared sequence, which a
+    shard WATCHes while it adds an entry of its own.  If anything was
+    reserved since the shard last looked, the entries it hasn't accounted
+    for are handed back to it instead, and it has to decide again whether
+    (and where) the task can start; so no two shards can both take the last
+    of an instance group's capacity, or start tasks that block one another.
+
+    When a cycle commits, its entries are marked with the sequence at which
+    they became visible in the database, and kept for LEDGER_TIMEOUT, so that
+    shards whose snapshot predates the commit keep counting them; when it
+    rolls back (or the process scheduling the shard dies, and the next cycle
+    of the shard finds them), they're removed.
+    '''
+
+    def __init__(self, shard, shards=None):
+        self.shard = shard
+        self.shards = shards or settings.TASK_MANAGER_SHARDS
+        self.redis = redis.Redis.from_url(settings.BROKER_URL)
+        # the sequence as of this shard's snapshot, and as of the last time
+        # it looked at the entries of the others
+        self.snapshot_sequence = self.sequence = 0
+        # the tasks of other shards already accounted for this cycle
+        self.seen = set()
+
+    @staticmethod
+    def key_for(shard):
+        return '{}:{}'.format(LEDGER_KEY_PREFIX, shard)
+
+    @property
+    def key(self):
+        return self.key_for(self.shard)
+
+    @property
+    def other_keys(self):
+        return [self.key_for(shard) for shard in range(self.shards) if shard != self.shard]
+
+    def unseen(self, entries):
+        '''
+        Return the entries (from HGETALL of each of the other shards) that
+        this shard hasn't accounted for, by task id
+        '''
+        reservations = {}
+        for entries_of_shard in entries:
+            for pk, entry in entries_of_shard.items():
+                pk, entry = int(pk), json.loads(entry)
+                if pk in self.seen:
+                    continue
+                committed = entry.pop('committed', None)
+                entry.pop('committed_at', None)
+                if committed is not None and committed <= self.snapshot_sequence:
+                    # committed before the snapshot, so the tasks loaded
+                    # from the database afterwards include it
+                    continue
+                self.seen.add(pk)
+                reservations[pk] = entry
+        return reservations
+
+    def snapshot(self):
+        '''
+        Start a new cycle: discard whatever an earlier cycle of this shard
+        that never finished left behind, and return the tasks other shards
+        have started, but not committed, by task id.  Must be called before
+        any tasks are loaded from the database.
+        '''
+        self.seen = set()
+        try:
+            self.release(committed=False)
+            pipe = self.redis.pipeline()
+            pipe.get(LEDGER_SEQUENCE_KEY)
+            for key in self.other_keys:
+                pipe.hgetall(key)
+            results = pipe.execute()
+        except redis.RedisError:
+            logger.exception('could not read the task manager capacity ledger')
+            # count everything that turns up when reserving
+            self.snapshot_sequence, self.sequence = 0, -1
+            return {}
+        self.snapshot_sequence = self.sequence = int(results[0] or 0)
+        return self.unseen(results[1:])
+
+    def reserve(self, task, instance_group, execution_node):
+        '''
+        Reserve the capacity of `task` on `instance_group` and
+        `execution_node`, provided nothing has been reserved by another shard
+        since this one last looked.
+
+        Returns None if the reservation was made; otherwise, returns the
+        reservations (by task id) this shard hasn't accounted for yet, and
+        the task has to be reconsidered in light of them.
+        '''
+        entry = json.dumps({
+            'instance_group': instance_group,
+            'execution_node': execution_node,
+            'task_impact': task.task_impact,
+        })
+        with self.redis.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(LEDGER_SEQUENCE_KEY)
+                    sequence = int(pipe.get(LEDGER_SEQUENCE_KEY) or 0)
+                    if sequence != self.sequence:
+                        reservations = self.unseen([pipe.hgetall(key) for key in self.other_keys])
+                        self.sequence = sequence
+                        if reservations:
+                            return reservations
+                    pipe.multi()
+                    pipe.incr(LEDGER_SEQUENCE_KEY)
+                    pipe.hset(self.key, task.id, entry)
+                    pipe.expire(self.key, LEDGER_TIMEOUT)
+                    self.sequence = pipe.execute()[0]
+                    return None
+                except redis.WatchError:
+                    continue
+
+    def release(self, committed):
+        '''
+        End a cycle of this shard: mark the entries it made as committed (or
+        remove them, if it rolled back), and remove committed entries that no
+        other shard's cycle can still need.
+        '''
+        now = time.time()
+        with self.redis.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(LEDGER_SEQUENCE_KEY, self.key)
+                    sequence = int(pipe.get(LEDGER_SEQUENCE_KEY) or 0) + 1
+                    updates, expired = {}, []
+                    for pk, entry in pipe.hgetall(self.key).items():
+                        entry = json.loads(entry)
+                        if 'committed' in entry:
+                            if entry['committed_at'] < now - LEDGER_TIMEOUT:
+                                expired.append(pk)
+                        elif committed:
+                            entry.update(committed=sequence, committed_at=now)
+                            updates[pk] = json.dumps(entry)
+                        else:
+                            expired.append(pk)
+                    pipe.multi()
+                    pipe.incr(LEDGER_SEQUENCE_KEY)
+                    if expired:
+                        pipe.hdel(self.key, *expired)
+                    if updates:
+                        pipe.hmset(self.key, updates)
+                        pipe.expire(self.key, LEDGER_TIMEOUT)
+                    pipe.execute()
+                    return
+                except redis.WatchError:
+                    continue
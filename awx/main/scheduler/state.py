@@ -0,0 +1,138 @@
+# Python
+import logging
+import time
+
+# Django
+from django.conf import settings
+from django.db import connection
+
+import redis
+
+
+logger = logging.getLogger('awx.main.scheduler')
+
+# UnifiedJob pk -> time of its most recent state transition
+TRANSITIONS_KEY = 'awx_task_manager_transitions'
+
+# state transitions are stamped with the clock of the node that recorded
+# them; look back this many seconds further than strictly necessary so that
+# modest clock skew between nodes doesn't cause any to be missed
+CLOCK_SKEW = 5
+
+
+def record_transition(unified_job):
+    '''
+    Note that a unified job was created or changed status, so that a task
+    manager running in incremental mode reloads it on its next cycle.
+    '''
+    record_transitions([unified_job])
+
+
+def record_transitions(unified_jobs):
+    if not settings.TASK_MANAGER_INCREMENTAL:
+        return
+    pks = [unified_job.pk for unified_job in unified_jobs]
+    if not pks:
+        return
+
+    def _record():
+        stamp = time.time()
+        try:
+            redis.Redis.from_url(settings.BROKER_URL).zadd(TRANSITIONS_KEY, dict((pk, stamp) for pk in pks))
+        except redis.RedisError:
+            # the next reconciliation will pick these changes up
+            logger.exception('could not record state transitions for unified jobs {}'.format(pks))
+
+    # the task manager can't see the changes until they're committed
+    connection.on_commit(_record)
+
+
+class SchedulerState(object):
+    '''
+    The set of pending, waiting, and running tasks, kept between task manager
+    cycles (in incremental mode) so that each cycle only reloads the tasks
+    that changed state since the last one, rather than all of them.
+
+    Every TASK_MANAGER_RECONCILE_INTERVAL seconds (or if anything goes wrong),
+    all tasks are reloaded from the database instead.
+
+    Each dispatcher worker that runs the task manager keeps its own state,
+    but the transitions are shared, so a cycle reloads everything that
+    changed since that process's last cycle, no matter which process (or
+    node) made the change.  Changes to a task that don't change its status
+    must be recorded as transitions too, or other processes won't see them.
+    '''
+
+    def __init__(self):
+        self.redis = redis.Redis.from_url(settings.BROKER_URL)
+        self.invalidate()
+
+    def invalidate(self):
+        self.tasks = None
+        self.synced = 0
+        self.reconciled = 0
+
+    def get_tasks(self, task_manager):
+        now = time.time()
+        if self.tasks is None or now - self.reconciled > settings.TASK_MANAGER_RECONCILE_INTERVAL:
+            return self.reconcile(task_manager, now)
+
+        try:
+            changed = set(
+                int(pk) for pk in
+                self.redis.zrangebyscore(TRANSITIONS_KEY, self.synced - CLOCK_SKEW, '+inf')
+            )
+        except redis.RedisError:
+            logger.exception('could not read task state transitions, reloading all tasks')
+            return self.reconcile(task_manager, now)
+
+        # tasks that are waiting on a task that changed state need their
+        # (prefetched) dependencies reloaded, too
+        for task in self.tasks.values():
+            if any(dependency.id in changed for dependency in task.dependent_jobs.all()):
+                changed.add(task.id)
+        for pk in changed:
+            self.tasks.pop(pk, None)
+        if changed:
+            for task in task_manager.get_tasks(pks=changed):
+                self.tasks[task.id] = task
+        logger.debug('Reloaded {} of {} tasks that changed state.'.format(len(changed), len(self.tasks)))
+
+        self.synced = now
+        return self.sorted_tasks()
+
+    def reconcile(self, task_manager, now):
+        self.tasks = dict((task.id, task) for task in task_manager.get_tasks())
+        self.synced = self.reconciled = now
+        logger.debug('Reconciled {} tasks with the database.'.format(len(self.tasks)))
+        try:
+            # transitions older than this will never be read
+            horizon = now - settings.TASK_MANAGER_RECONCILE_INTERVAL - CLOCK_SKEW
+            self.redis.zremrangebyscore(TRANSITIONS_KEY, '-inf', horizon)
+        except redis.RedisError:
+            logger.exception('could not trim task state transitions')
+        return self.sorted_tasks()
+
+    def sorted_tasks(self):
+        # drop anything that finished (or failed to start) during a prior cycle
+        for pk, task in list(self.tasks.items()):
+            if task.status not in ('pending', 'waiting', 'running'):
+                del self.tasks[pk]
+        return sorted(self.tasks.values(), key=lambda task: (task.created, task.id))
+
+
+_state = None
+
+
+def get_scheduler_state():
+    '''
+    Return the scheduler state kept by this process, if the task manager is
+    running in incremental mode.
+    '''
+    global _state
+    if not settings.TASK_MANAGER_INCREMENTAL:
+        _state = None
+        return None
+    if _state is None:
+        _state = SchedulerState()
+    return _state
@@ -6,15 +6,20 @@ from datetime import timedelta
 import logging
 import uuid
 import json
-import random
+
+import redis
 
 # Django
+from django.contrib.contenttypes.models import ContentType
 from django.db import transaction, connection
+from django.db.models import IntegerField, OuterRef, Q, Subquery, Value, prefetch_related_objects
+from django.db.models.functions import Coalesce, Mod
 from django.utils.translation import ugettext_lazy as _, gettext_noop
 from django.utils.timezone import now as tz_now
 from django.conf import settings
 
 # AWX
+from awx.main.dispatch.publish import publish_many
 from awx.main.dispatch.reaper import reap_job
 from awx.main.models import (
     AdHocCommand,
@@ -28,10 +33,16 @@ from awx.main.models import (
     SystemJob,
     UnifiedJob,
     WorkflowApproval,
+    UnifiedJobTemplate,
     WorkflowJob,
     WorkflowJobTemplate
 )
+from awx.main.scheduler.capacity import CapacitySnapshot
 from awx.main.scheduler.dag_workflow import WorkflowDAG
+from awx.main.scheduler.fair_share import FairShareQueue
+from awx.main.scheduler.profiler import CycleProfile
+from awx.main.scheduler.shards import CapacityLedger, get_shard
+from awx.main.scheduler.state import record_transitions
 from awx.main.utils.pglock import advisory_lock
 from awx.main.utils import get_type_for_model, task_manager_bulk_reschedule, schedule_task_manager
 from awx.main.signals import disable_activity_stream
@@ -44,51 +55,135 @@ logger = logging.getLogger('awx.main.scheduler')
 
 class TaskManager():
 
-    def __init__(self):
+    # The relations that scheduling reads from each type of task (in
+    # task_impact, preferred_instance_groups, get_jobs_fail_chain, and
+    # generate_dependencies); get_tasks() prefetches them for all tasks of a
+    # type at once, instead of loading them task by task
+    TASK_RELATIONS = {
+        Job: ('project', 'project_update', 'inventory__instance_groups',
+              'job_template__instance_groups', 'organization__instance_groups'),
+        ProjectUpdate: ('unified_job_template__instance_groups', 'organization__instance_groups'),
+        InventoryUpdate: ('inventory_source__inventory__instance_groups',
+                          'inventory_source__inventory__organization__instance_groups'),
+        SystemJob: (),
+        AdHocCommand: ('inventory__instance_groups', 'inventory__organization__instance_groups'),
+        WorkflowJob: (),
+    }
+
+    # The fields of a task that start_task() changes
+    SUBMIT_FIELDS = ('status', 'instance_group', 'execution_node', 'controller_node', 'celery_task_id', 'modified')
+
+    def __init__(self, state=None, dag_cache=None, shard=None):
         self.graph = dict()
+        # the tasks started this cycle, which submit_tasks() saves and
+        # dispatches all at once
+        self.tasks_to_submit = []
+        # when TASK_MANAGER_SHARDS > 1, the shard of pending tasks this task
+        # manager schedules, and the capacity reserved by the other shards
+        self.shard = shard
+        self.ledger = CapacityLedger(shard) if shard is not None else None
+        self.reservations = {}
+        self.running_task_ids = set()
+        # in incremental mode, the tasks kept from prior cycles by this process
+        self.state = state
+        # the graphs of running workflow jobs kept from prior cycles
+        self.dag_cache = dag_cache
+        # the time and queries spent in each phase of this cycle
+        self.profile = CycleProfile(shard=shard)
         # start task limit indicates how many pending jobs can be started on this
         # .schedule() run. Starting jobs is expensive, and there is code in place to reap
         # the task manager after 5 minutes. At scale, the task manager can easily take more than
         # 5 minutes to start pending jobs. If this limit is reached, pending jobs
         # will no longer be started and will be started on the next task manager cycle.
         self.start_task_limit = settings.START_TASK_LIMIT
+        # in fair share mode, the number of tasks each (organization,
+        # instance group) has waiting or running
+        self.fair_share_usage = None
+        # what's waiting and running across the cluster, by the resources
+        # (projects, inventories, templates) that keep other tasks waiting
+        self.dependency_graph = DependencyGraph(None)
+        # task id -> whether all of the jobs it depends on have finished
+        self.dependencies_finished = dict()
         for rampart_group in InstanceGroup.objects.prefetch_related('instances'):
-            self.graph[rampart_group.name] = dict(graph=DependencyGraph(rampart_group.name),
-                                                  capacity_total=rampart_group.capacity,
+            self.graph[rampart_group.name] = dict(capacity_total=rampart_group.capacity,
                                                   consumed_capacity=0)
 
     def is_job_blocked(self, task):
         # TODO: I'm not happy with this, I think blocking behavior should be decided outside of the dependency graph
         #       in the old task manager this was handled as a method on each task object outside of the graph and
         #       probably has the side effect of cutting down *a lot* of the logic from this task manager class
-        for g in self.graph:
-            if self.graph[g]['graph'].is_job_blocked(task):
-                return True
+        if self.dependency_graph.is_job_blocked(task):
+            return True
 
-        if not task.dependent_jobs_finished():
+        dependencies_finished = self.dependencies_finished.get(task.id)
+        if dependencies_finished is None:
+            dependencies_finished = task.dependent_jobs_finished()
+        if not dependencies_finished:
             return True
 
         return False
 
-    def get_tasks(self, status_list=('pending', 'waiting', 'running')):
-        jobs = [j for j in Job.objects.filter(status__in=status_list).prefetch_related('instance_group')]
-        inventory_updates_qs = InventoryUpdate.objects.filter(
-            status__in=status_list).exclude(source='file').prefetch_related('inventory_source', 'instance_group')
-        inventory_updates = [i for i in inventory_updates_qs]
-        # Notice the job_type='check': we want to prevent implicit project updates from blocking our jobs.
-        project_updates = [p for p in ProjectUpdate.objects.filter(status__in=status_list, job_type='check').prefetch_related('instance_group')]
-        system_jobs = [s for s in SystemJob.objects.filter(status__in=status_list).prefetch_related('instance_group')]
-        ad_hoc_commands = [a for a in AdHocCommand.objects.filter(status__in=status_list).prefetch_related('instance_group')]
-        workflow_jobs = [w for w in WorkflowJob.objects.filter(status__in=status_list)]
-        all_tasks = sorted(jobs + project_updates + inventory_updates + system_jobs + ad_hoc_commands + workflow_jobs,
-                           key=lambda task: task.created)
+    def preload_dependencies(self, tasks):
+        # only jobs wait for the tasks they depend on (see
+        # TaskManagerJobMixin.dependent_jobs_finished); find all of those
+        # with dependencies that haven't finished at once
+        job_ids = [task.id for task in tasks if type(task) is Job and task.id not in self.dependencies_finished]
+        if not job_ids:
+            return
+        waiting = set(UnifiedJob.dependent_jobs.through.objects.filter(
+            from_unifiedjob_id__in=job_ids,
+            to_unifiedjob__status__in=['pending', 'waiting', 'running'],
+        ).values_list('from_unifiedjob_id', flat=True))
+        for pk in job_ids:
+            self.dependencies_finished[pk] = pk not in waiting
+
+    def get_tasks(self, status_list=('pending', 'waiting', 'running'), pks=None):
+        # Every type of task is loaded by one (polymorphic) query, already
+        # sorted by the database, rather than a query per type merged and
+        # sorted here.  File-based inventory updates aren't scheduled, and we
+        # exclude job_type='run' project updates because we want to prevent
+        # implicit project updates from blocking our jobs.
+        ctypes = ContentType.objects.get_for_models(*self.TASK_RELATIONS).values()
+        qs = UnifiedJob.objects.filter(
+            status__in=status_list,
+            polymorphic_ctype__in=ctypes
+        ).exclude(
+            inventoryupdate__source='file'
+        ).exclude(
+            projectupdate__job_type='run'
+        )
+        if pks is not None:
+            qs = qs.filter(pk__in=pks)
+        elif self.shard is not None:
+            # every shard needs to know what's running, but only schedules
+            # its own pending tasks
+            qs = qs.annotate(
+                shard=Mod(Coalesce('unified_job_template_id', 'id'), Value(settings.TASK_MANAGER_SHARDS),
+                          output_field=IntegerField())
+            ).filter(~Q(status='pending') | Q(shard=self.shard))
+        all_tasks = list(qs.order_by('created', 'id'))
+
+        tasks_by_type = {}
+        for task in all_tasks:
+            tasks_by_type.setdefault(type(task), []).append(task)
+        for cls, tasks in tasks_by_type.items():
+            prefetch_related_objects(tasks, 'instance_group', 'dependent_jobs', *self.TASK_RELATIONS[cls])
         return all_tasks
 
     def get_running_workflow_jobs(self):
         graph_workflow_jobs = [wf for wf in
-                               WorkflowJob.objects.filter(status='running')]
+                               WorkflowJob.objects.filter(status='running')
+                               if self.owns(wf)]
         return graph_workflow_jobs
 
+    def owns(self, task):
+        return self.shard is None or get_shard(task, settings.TASK_MANAGER_SHARDS) == self.shard
+
+    def get_workflow_dag(self, workflow_job):
+        if self.dag_cache is not None:
+            return self.dag_cache.get_dag(workflow_job)
+        return WorkflowDAG(workflow_job)
+
     def get_inventory_source_tasks(self, all_sorted_tasks):
         inventory_ids = set()
         for task in all_sorted_tasks:
@@ -101,7 +196,7 @@ class TaskManager():
             if workflow_job.cancel_flag:
                 logger.debug('Not spawning jobs for %s because it is pending cancelation.', workflow_job.log_format)
                 continue
-            dag = WorkflowDAG(workflow_job)
+            dag = self.get_workflow_dag(workflow_job)
             spawn_nodes = dag.bfs_nodes_to_run()
             if spawn_nodes:
                 logger.debug('Spawning jobs for %s', workflow_job.log_format)
@@ -114,6 +209,9 @@ class TaskManager():
                 job = spawn_node.unified_job_template.create_unified_job(**kv)
                 spawn_node.job = job
                 spawn_node.save()
+                if self.dag_cache is not None:
+                    self.dag_cache.changed(workflow_job)
+                    self.dag_cache.add_job(workflow_job, spawn_node)
                 logger.debug('Spawned %s in %s for node %s', job.log_format, workflow_job.log_format, spawn_node.pk)
                 can_start = True
                 if isinstance(spawn_node.unified_job_template, WorkflowJobTemplate):
@@ -154,10 +252,15 @@ class TaskManager():
     def process_finished_workflow_jobs(self, workflow_jobs):
         result = []
         for workflow_job in workflow_jobs:
-            dag = WorkflowDAG(workflow_job)
+            dag = self.get_workflow_dag(workflow_job)
             status_changed = False
             if workflow_job.cancel_flag:
                 workflow_job.workflow_nodes.filter(do_not_run=False, job__isnull=True).update(do_not_run=True)
+                for n in dag.nodes:
+                    if not n['node_object'].job_id:
+                        n['node_object'].do_not_run = True
+                if self.dag_cache is not None:
+                    self.dag_cache.changed(workflow_job)
                 logger.debug('Canceling spawned jobs of %s due to cancel flag.', workflow_job.log_format)
                 cancel_finished = dag.cancel_node_jobs()
                 if cancel_finished:
@@ -170,6 +273,8 @@ class TaskManager():
                 workflow_nodes = dag.mark_dnr_nodes()
                 for n in workflow_nodes:
                     n.save(update_fields=['do_not_run'])
+                if workflow_nodes and self.dag_cache is not None:
+                    self.dag_cache.changed(workflow_job)
                 is_done = dag.is_workflow_done()
                 if not is_done:
                     continue
@@ -200,20 +305,13 @@ class TaskManager():
         if self.start_task_limit == 0:
             # schedule another run immediately after this task manager
             schedule_task_manager()
-        from awx.main.tasks import handle_work_error, handle_work_success
 
         dependent_tasks = dependent_tasks or []
 
-        task_actual = {
-            'type': get_type_for_model(type(task)),
-            'id': task.id,
-        }
-        dependencies = [{'type': get_type_for_model(type(t)), 'id': t.id} for t in dependent_tasks]
-
         controller_node = None
         if task.supports_isolation() and rampart_group.controller_id:
             try:
-                controller_node = rampart_group.choose_online_controller_node()
+                controller_node = self.capacity.choose_controller_node(rampart_group)
             except IndexError:
                 logger.debug("No controllers available in group {} to run {}".format(
                              rampart_group.name, task.log_format))
@@ -238,7 +336,7 @@ class TaskManager():
             elif not task.supports_isolation() and rampart_group.controller_id:
                 # non-Ansible jobs on isolated instances run on controller
                 task.instance_group = rampart_group.controller
-                task.execution_node = random.choice(list(rampart_group.controller.instances.all().values_list('hostname', flat=True)))
+                task.execution_node = self.capacity.choose_controller_node(rampart_group, online=False)
                 logger.debug('Submitting isolated {} to queue {} on node {}.'.format(
                              task.log_format, task.instance_group.name, task.execution_node))
             elif controller_node:
@@ -251,10 +349,10 @@ class TaskManager():
                 # find one real, non-containerized instance with capacity to
                 # act as the controller for k8s API interaction
                 match = None
-                for group in InstanceGroup.objects.all():
+                for group in self.capacity.groups:
                     if group.is_containerized or group.controller_id:
                         continue
-                    match = group.fit_task_to_most_remaining_capacity_instance(task)
+                    match = self.capacity.fit_task_to_most_remaining_capacity_instance(task, group)
                     if match:
                         break
                 task.instance_group = rampart_group
@@ -278,39 +376,80 @@ class TaskManager():
                     task.execution_node = instance.hostname
                 logger.debug('Submitting {} to <instance group, instance> <{},{}>.'.format(
                              task.log_format, task.instance_group_id, task.execution_node))
-            with disable_activity_stream():
-                task.celery_task_id = str(uuid.uuid4())
-                task.save()
+            task.celery_task_id = str(uuid.uuid4())
+            if type(task) is WorkflowJob:
+                with disable_activity_stream():
+                    task.save()
+            else:
+                # saved and dispatched along with the other tasks started
+                # this cycle, by submit_tasks()
+                self.tasks_to_submit.append((task, opts, dependent_tasks))
 
             if rampart_group is not None:
                 self.consume_capacity(task, rampart_group.name)
+                self.capacity.consume_capacity(task)
 
-        def post_commit():
-            if task.status != 'failed' and type(task) is not WorkflowJob:
-                task_cls = task._get_task_class()
-                task_cls.apply_async(
-                    [task.pk],
-                    opts,
-                    queue=task.get_queue_name(),
-                    uuid=task.celery_task_id,
-                    callbacks=[{
-                        'task': handle_work_success.name,
-                        'kwargs': {'task_actual': task_actual}
-                    }],
-                    errbacks=[{
-                        'task': handle_work_error.name,
-                        'args': [task.celery_task_id],
-                        'kwargs': {'subtasks': [task_actual] + dependencies}
-                    }],
-                )
+        if task.status == 'failed' or type(task) is WorkflowJob:
+            task.websocket_emit_status(task.status)  # adds to on_commit
 
-        task.websocket_emit_status(task.status)  # adds to on_commit
-        connection.on_commit(post_commit)
+    def submit_tasks(self):
+        '''
+        Save the tasks started this cycle; once the cycle commits, emit their
+        status and publish them to the dispatcher, all in batches
+        '''
+        tasks_to_submit, self.tasks_to_submit = self.tasks_to_submit, []
+        if not tasks_to_submit:
+            return
+        from awx.main.tasks import handle_work_error, handle_work_success
+
+        modified = tz_now()
+        tasks = []
+        templates = dict()
+        for task, opts, dependent_tasks in tasks_to_submit:
+            task.modified = modified
+            tasks.append(task)
+            # what UnifiedJob.save() does to the template of a task when the
+            # task changes status
+            if task.unified_job_template_id:
+                templates[task.unified_job_template_id] = UnifiedJobTemplate(
+                    id=task.unified_job_template_id,
+                    current_job_id=task.id,
+                    status=task.status,
+                    modified=modified,
+                )
+        UnifiedJob.objects.bulk_update(tasks, self.SUBMIT_FIELDS, batch_size=500)
+        UnifiedJobTemplate.objects.bulk_update(list(templates.values()), ['current_job', 'status', 'modified'], batch_size=500)
+        record_transitions(tasks)
+        UnifiedJob.websocket_emit_status_batch(tasks, 'waiting')
+
+        messages = []
+        for task, opts, dependent_tasks in tasks_to_submit:
+            task_actual = {
+                'type': get_type_for_model(type(task)),
+                'id': task.id,
+            }
+            dependencies = [{'type': get_type_for_model(type(t)), 'id': t.id} for t in dependent_tasks]
+            messages.append(task._get_task_class().build_message(
+                [task.pk],
+                opts,
+                queue=task.get_queue_name(),
+                uuid=task.celery_task_id,
+                callbacks=[{
+                    'task': handle_work_success.name,
+                    'kwargs': {'task_actual': task_actual}
+                }],
+                errbacks=[{
+                    'task': handle_work_error.name,
+                    'args': [task.celery_task_id],
+                    'kwargs': {'subtasks': [task_actual] + dependencies}
+                }],
+            ))
+        connection.on_commit(lambda: publish_many(messages))
 
     def process_running_tasks(self, running_tasks):
         for task in running_tasks:
             if task.instance_group:
-                self.graph[task.instance_group.name]['graph'].add_job(task)
+                self.dependency_graph.add_job(task)
 
     def create_project_update(self, task):
         project_task = Project.objects.get(id=task.project_id).create_project_update(
@@ -343,19 +482,37 @@ class TaskManager():
         # self.process_inventory_sources(inventory_sources)
         return inventory_task
 
-    def capture_chain_failure_dependencies(self, task, dependencies):
+    def capture_chain_failure_dependencies(self, chains):
+        # each chain is a task and the updates it depends on; every job in a
+        # chain depends on all of the others (dependent_jobs is symmetrical),
+        # so that if any of them fail, the rest fail with them
+        links = set()
+        for task, dependencies in chains:
+            chain = [task] + dependencies
+            for a in chain:
+                for b in chain:
+                    if a.id != b.id:
+                        links.add((a.id, b.id))
+        through = UnifiedJob.dependent_jobs.through
         with disable_activity_stream():
-            task.dependent_jobs.add(*dependencies)
-
-            for dep in dependencies:
-                # Add task + all deps except self
-                dep.dependent_jobs.add(*([task] + [d for d in dependencies if d != dep]))
-
-    def get_latest_inventory_update(self, inventory_source):
-        latest_inventory_update = InventoryUpdate.objects.filter(inventory_source=inventory_source).order_by("-created")
-        if not latest_inventory_update.exists():
-            return None
-        return latest_inventory_update.first()
+            through.objects.bulk_create([
+                through(from_unifiedjob_id=a, to_unifiedjob_id=b) for a, b in links
+            ], ignore_conflicts=True)
+        for task, dependencies in chains:
+            # discard the (empty) dependent_jobs prefetched by get_tasks()
+            getattr(task, '_prefetched_objects_cache', {}).pop('dependent_jobs', None)
+
+    def get_latest_inventory_updates(self, inventory_source_ids):
+        latest = InventoryUpdate.objects.filter(
+            inventory_source=OuterRef('pk')
+        ).order_by('-created').values('pk')[:1]
+        return dict(
+            (update.inventory_source_id, update) for update in InventoryUpdate.objects.filter(
+                pk__in=InventorySource.objects.filter(pk__in=inventory_source_ids).annotate(
+                    latest=Subquery(latest)
+                ).values('latest')
+            ).select_related('inventory_source')
+        )
 
     def should_update_inventory_source(self, job, latest_inventory_update):
         now = tz_now()
@@ -377,11 +534,17 @@ class TaskManager():
             return True
         return False
 
-    def get_latest_project_update(self, job):
-        latest_project_update = ProjectUpdate.objects.filter(project=job.project, job_type='check').order_by("-created")
-        if not latest_project_update.exists():
-            return None
-        return latest_project_update.first()
+    def get_latest_project_updates(self, project_ids):
+        latest = ProjectUpdate.objects.filter(
+            project=OuterRef('pk'), job_type='check'
+        ).order_by('-created').values('pk')[:1]
+        return dict(
+            (update.project_id, update) for update in ProjectUpdate.objects.filter(
+                pk__in=Project.objects.filter(pk__in=project_ids).annotate(
+                    latest=Subquery(latest)
+                ).values('latest')
+            ).select_related('project')
+        )
 
     def should_update_related_project(self, job, latest_project_update):
         now = tz_now()
@@ -418,98 +581,150 @@ class TaskManager():
 
     def generate_dependencies(self, undeped_tasks):
         created_dependencies = []
-        for task in undeped_tasks:
+        jobs = [task for task in undeped_tasks if type(task) is Job]
+
+        # TODO: Can remove task.project None check after scan-job-default-playbook is removed
+        project_ids = set(job.project_id for job in jobs if job.project is not None and job.project.scm_update_on_launch is True)
+        inventory_sources = dict()
+        for inventory_source in self.all_inventory_sources:
+            if inventory_source.update_on_launch:
+                inventory_sources.setdefault(inventory_source.inventory_id, []).append(inventory_source)
+        inventory_source_ids = set(
+            inventory_source.id for job in jobs for inventory_source in inventory_sources.get(job.inventory_id, [])
+        )
+        # the latest update of each project and inventory source, kept current
+        # as updates are created, so that jobs launched together share them
+        latest_project_updates = self.get_latest_project_updates(project_ids) if project_ids else {}
+        latest_inventory_updates = self.get_latest_inventory_updates(inventory_source_ids) if inventory_source_ids else {}
+
+        chains = []
+        for task in jobs:
             dependencies = []
-            if not type(task) is Job:
-                continue
-            # TODO: Can remove task.project None check after scan-job-default-playbook is removed
-            if task.project is not None and task.project.scm_update_on_launch is True:
-                latest_project_update = self.get_latest_project_update(task)
+            if task.project_id in project_ids:
+                latest_project_update = latest_project_updates.get(task.project_id)
                 if self.should_update_related_project(task, latest_project_update):
                     project_task = self.create_project_update(task)
                     created_dependencies.append(project_task)
                     dependencies.append(project_task)
+                    latest_project_updates[task.project_id] = project_task
                 else:
                     dependencies.append(latest_project_update)
 
             # Inventory created 2 seconds behind job
-            try:
-                start_args = json.loads(decrypt_field(task, field_name="start_args"))
-            except ValueError:
-                start_args = dict()
-            for inventory_source in [invsrc for invsrc in self.all_inventory_sources if invsrc.inventory == task.inventory]:
-                if "inventory_sources_already_updated" in start_args and inventory_source.id in start_args['inventory_sources_already_updated']:
-                    continue
-                if not inventory_source.update_on_launch:
-                    continue
-                latest_inventory_update = self.get_latest_inventory_update(inventory_source)
-                if self.should_update_inventory_source(task, latest_inventory_update):
-                    inventory_task = self.create_inventory_update(task, inventory_source)
-                    created_dependencies.append(inventory_task)
-                    dependencies.append(inventory_task)
-                else:
-                    dependencies.append(latest_inventory_update)
+            if task.inventory_id in inventory_sources:
+                try:
+                    start_args = json.loads(decrypt_field(task, field_name="start_args"))
+                except ValueError:
+                    start_args = dict()
+                for inventory_source in inventory_sources[task.inventory_id]:
+                    if "inventory_sources_already_updated" in start_args and inventory_source.id in start_args['inventory_sources_already_updated']:
+                        continue
+                    latest_inventory_update = latest_inventory_updates.get(inventory_source.id)
+                    if self.should_update_inventory_source(task, latest_inventory_update):
+                        inventory_task = self.create_inventory_update(task, inventory_source)
+                        created_dependencies.append(inventory_task)
+                        dependencies.append(inventory_task)
+                        latest_inventory_updates[inventory_source.id] = inventory_task
+                    else:
+                        dependencies.append(latest_inventory_update)
 
             if len(dependencies) > 0:
-                self.capture_chain_failure_dependencies(task, dependencies)
+                chains.append((task, dependencies))
+
+        if chains:
+            self.capture_chain_failure_dependencies(chains)
 
         UnifiedJob.objects.filter(pk__in = [task.pk for task in undeped_tasks]).update(dependencies_processed=True)
+        for task in undeped_tasks:
+            task.dependencies_processed = True
+        # these tasks changed without changing status; the task manager may run
+        # in a different process next time, so make sure it reloads them
+        record_transitions(undeped_tasks)
         return created_dependencies
 
     def process_pending_tasks(self, pending_tasks):
         running_workflow_templates = set([wf.unified_job_template_id for wf in self.get_running_workflow_jobs()])
+        self.preload_dependencies(pending_tasks)
+        if settings.TASK_MANAGER_FAIR_SHARE:
+            pending_tasks = FairShareQueue(pending_tasks, self.fair_share_usage)
         for task in pending_tasks:
             if self.start_task_limit <= 0:
                 break
-            if self.is_job_blocked(task):
-                logger.debug("{} is blocked from running".format(task.log_format))
-                continue
-            preferred_instance_groups = task.preferred_instance_groups
-            found_acceptable_queue = False
-            idle_instance_that_fits = None
-            if isinstance(task, WorkflowJob):
-                if task.unified_job_template_id in running_workflow_templates:
-                    if not task.allow_simultaneous:
-                        logger.debug("{} is blocked from running, workflow already running".format(task.log_format))
-                        continue
-                else:
-                    running_workflow_templates.add(task.unified_job_template_id)
-                self.start_task(task, None, task.get_jobs_fail_chain(), None)
+            outcome = None
+            while outcome is None:
+                # when sharded, other shards may have started tasks this one
+                # hadn't accounted for; if so, decide again
+                outcome = self.process_pending_task(task, running_workflow_templates)
+            self.profile.count(outcome)
+
+    def process_pending_task(self, task, running_workflow_templates):
+        if self.is_job_blocked(task):
+            logger.debug("{} is blocked from running".format(task.log_format))
+            return 'blocked'
+        preferred_instance_groups = task.preferred_instance_groups
+        idle_instance_that_fits = None
+        if isinstance(task, WorkflowJob):
+            if task.unified_job_template_id in running_workflow_templates:
+                if not task.allow_simultaneous:
+                    logger.debug("{} is blocked from running, workflow already running".format(task.log_format))
+                    return 'blocked'
+            else:
+                running_workflow_templates.add(task.unified_job_template_id)
+            self.start_task(task, None, task.get_jobs_fail_chain(), None)
+            return 'started'
+        for rampart_group in preferred_instance_groups:
+            if task.can_run_containerized and rampart_group.is_containerized:
+                if not self.reserve_capacity(task, rampart_group, None):
+                    return None
+                self.dependency_graph.add_job(task)
+                self.start_task(task, rampart_group, task.get_jobs_fail_chain(), None)
+                return 'started'
+
+            if idle_instance_that_fits is None:
+                idle_instance_that_fits = self.capacity.find_largest_idle_instance(rampart_group)
+            remaining_capacity = self.get_remaining_capacity(rampart_group.name)
+            if not rampart_group.is_containerized and self.get_remaining_capacity(rampart_group.name) <= 0:
+                logger.debug("Skipping group {}, remaining_capacity {} <= 0".format(
+                             rampart_group.name, remaining_capacity))
                 continue
-            for rampart_group in preferred_instance_groups:
-                if task.can_run_containerized and rampart_group.is_containerized:
-                    self.graph[rampart_group.name]['graph'].add_job(task)
-                    self.start_task(task, rampart_group, task.get_jobs_fail_chain(), None)
-                    found_acceptable_queue = True
-                    break
-
-                if idle_instance_that_fits is None:
-                    idle_instance_that_fits = rampart_group.find_largest_idle_instance()
-                remaining_capacity = self.get_remaining_capacity(rampart_group.name)
-                if not rampart_group.is_containerized and self.get_remaining_capacity(rampart_group.name) <= 0:
-                    logger.debug("Skipping group {}, remaining_capacity {} <= 0".format(
-                                 rampart_group.name, remaining_capacity))
-                    continue
 
-                execution_instance = rampart_group.fit_task_to_most_remaining_capacity_instance(task)
-                if execution_instance:
+            execution_instance = self.capacity.fit_task_to_most_remaining_capacity_instance(task, rampart_group)
+            if execution_instance:
+                logger.debug("Starting {} in group {} instance {} (remaining_capacity={})".format(
+                             task.log_format, rampart_group.name, execution_instance.hostname, remaining_capacity))
+            elif not execution_instance and idle_instance_that_fits:
+                if not rampart_group.is_containerized:
+                    execution_instance = idle_instance_that_fits
                     logger.debug("Starting {} in group {} instance {} (remaining_capacity={})".format(
                                  task.log_format, rampart_group.name, execution_instance.hostname, remaining_capacity))
-                elif not execution_instance and idle_instance_that_fits:
-                    if not rampart_group.is_containerized:
-                        execution_instance = idle_instance_that_fits
-                        logger.debug("Starting {} in group {} instance {} (remaining_capacity={})".format(
-                                     task.log_format, rampart_group.name, execution_instance.hostname, remaining_capacity))
-                if execution_instance or rampart_group.is_containerized:
-                    self.graph[rampart_group.name]['graph'].add_job(task)
-                    self.start_task(task, rampart_group, task.get_jobs_fail_chain(), execution_instance)
-                    found_acceptable_queue = True
-                    break
-                else:
-                    logger.debug("No instance available in group {} to run job {} w/ capacity requirement {}".format(
-                                 rampart_group.name, task.log_format, task.task_impact))
-            if not found_acceptable_queue:
-                logger.debug("{} couldn't be scheduled on graph, waiting for next cycle".format(task.log_format))
+            if execution_instance or rampart_group.is_containerized:
+                if not self.reserve_capacity(task, rampart_group, execution_instance):
+                    return None
+                self.dependency_graph.add_job(task)
+                self.start_task(task, rampart_group, task.get_jobs_fail_chain(), execution_instance)
+                return 'started'
+            else:
+                logger.debug("No instance available in group {} to run job {} w/ capacity requirement {}".format(
+                             rampart_group.name, task.log_format, task.task_impact))
+        logger.debug("{} couldn't be scheduled on graph, waiting for next cycle".format(task.log_format))
+        return 'skipped_capacity'
+
+    def reserve_capacity(self, task, rampart_group, instance):
+        '''
+        When sharded, reserve the capacity `task` is about to consume in the
+        capacity ledger, as long as no other shard has started a task this
+        one hasn't accounted for; if one has, account for it, and return
+        False so that the task is reconsidered.  If the ledger can't be
+        reached, the error aborts the cycle (and nothing it started starts).
+        '''
+        if self.ledger is None:
+            return True
+        reservations = self.ledger.reserve(task, rampart_group.name, instance.hostname if instance else None)
+        if reservations:
+            logger.debug('Other shards started {} tasks, reconsidering {}'.format(len(reservations), task.log_format))
+            self.consume_reserved_capacity(reservations)
+            return False
+        return True
 
     def timeout_approval_node(self):
         workflow_approvals = WorkflowApproval.objects.filter(status='pending')
@@ -545,7 +760,33 @@ class TaskManager():
                 reap_job(j, 'failed')
 
     def calculate_capacity_consumed(self, tasks):
-        self.graph = InstanceGroup.objects.capacity_values(tasks=tasks, graph=self.graph)
+        self.capacity = CapacitySnapshot(
+            InstanceGroup.objects.select_related('credential').prefetch_related('instances'),
+            tasks
+        )
+        self.graph = InstanceGroup.objects.capacity_values(qs=self.capacity.groups, tasks=tasks, graph=self.graph)
+        if self.ledger is not None:
+            self.running_task_ids = set(task.id for task in tasks)
+            self.consume_reserved_capacity(self.reservations)
+
+    def consume_reserved_capacity(self, reservations):
+        # tasks that other shards have started, but hadn't committed when
+        # this shard loaded its tasks
+        reservations = dict(
+            (pk, reservation) for pk, reservation in reservations.items()
+            if pk not in self.running_task_ids
+        )
+        if not reservations:
+            return
+        for task in self.get_tasks(pks=list(reservations)):
+            reservation = reservations[task.id]
+            self.running_task_ids.add(task.id)
+            task.status = 'waiting'
+            task.execution_node = reservation['execution_node']
+            self.capacity.consume_capacity(task)
+            self.dependency_graph.add_job(task)
+            if reservation['instance_group'] in self.graph:
+                self.consume_capacity(task, reservation['instance_group'])
 
     def consume_capacity(self, task, instance_group):
         logger.debug('{} consumed {} capacity units from {} with prior total of {}'.format(
@@ -559,19 +800,34 @@ class TaskManager():
     def process_tasks(self, all_sorted_tasks):
         running_tasks = [t for t in all_sorted_tasks if t.status in ['waiting', 'running']]
 
-        self.calculate_capacity_consumed(running_tasks)
+        with self.profile.phase('process_running_tasks'):
+            self.calculate_capacity_consumed(running_tasks)
 
-        self.process_running_tasks(running_tasks)
+            self.process_running_tasks(running_tasks)
+            if settings.TASK_MANAGER_FAIR_SHARE:
+                self.fair_share_usage = FairShareQueue.get_usage(running_tasks)
 
         pending_tasks = [t for t in all_sorted_tasks if t.status == 'pending']
         undeped_tasks = [t for t in pending_tasks if not t.dependencies_processed]
-        dependencies = self.generate_dependencies(undeped_tasks)
-        self.process_pending_tasks(dependencies)
-        self.process_pending_tasks(pending_tasks)
+        with self.profile.phase('generate_dependencies'):
+            dependencies = self.generate_dependencies(undeped_tasks)
+        with self.profile.phase('process_pending_tasks'):
+            self.process_pending_tasks(dependencies)
+            self.process_pending_tasks(pending_tasks)
+        with self.profile.phase('submit_tasks'):
+            self.submit_tasks()
 
     def _schedule(self):
         finished_wfjs = []
-        all_sorted_tasks = self.get_tasks()
+        with self.profile.phase('get_tasks'):
+            if self.ledger is not None:
+                # what the other shards have started, but not committed; this
+                # has to be read before the tasks are
+                self.reservations = self.ledger.snapshot()
+            if self.state is not None:
+                all_sorted_tasks = self.state.get_tasks(self)
+            else:
+                all_sorted_tasks = self.get_tasks()
         if len(all_sorted_tasks) > 0:
             # TODO: Deal with
             # latest_project_updates = self.get_latest_project_update_tasks(all_sorted_tasks)
@@ -580,10 +836,14 @@ class TaskManager():
             # latest_inventory_updates = self.get_latest_inventory_update_tasks(all_sorted_tasks)
             # self.process_latest_inventory_updates(latest_inventory_updates)
 
-            self.all_inventory_sources = self.get_inventory_source_tasks(all_sorted_tasks)
+            with self.profile.phase('get_tasks'):
+                self.all_inventory_sources = self.get_inventory_source_tasks(all_sorted_tasks)
 
-            running_workflow_tasks = self.get_running_workflow_jobs()
-            finished_wfjs = self.process_finished_workflow_jobs(running_workflow_tasks)
+            with self.profile.phase('process_finished_workflow_jobs'):
+                running_workflow_tasks = self.get_running_workflow_jobs()
+                if self.dag_cache is not None:
+                    self.dag_cache.sync(running_workflow_tasks)
+                finished_wfjs = self.process_finished_workflow_jobs(running_workflow_tasks)
 
             previously_running_workflow_tasks = running_workflow_tasks
             running_workflow_tasks = []
@@ -593,22 +853,51 @@ class TaskManager():
                 else:
                     logger.debug('Removed %s from job spawning consideration.', workflow_job.log_format)
 
-            self.spawn_workflow_graph_jobs(running_workflow_tasks)
+            with self.profile.phase('spawn_workflow_graph_jobs'):
+                self.spawn_workflow_graph_jobs(running_workflow_tasks)
 
-            self.timeout_approval_node()
-            self.reap_jobs_from_orphaned_instances()
+            # when sharded, the first shard takes care of these
+            if self.shard in (None, 0):
+                with self.profile.phase('timeout_approval_node'):
+                    self.timeout_approval_node()
+                with self.profile.phase('reap_jobs_from_orphaned_instances'):
+                    self.reap_jobs_from_orphaned_instances()
 
             self.process_tasks(all_sorted_tasks)
         return finished_wfjs
 
     def schedule(self):
         # Lock
-        with advisory_lock('task_manager_lock', wait=False) as acquired:
-            with transaction.atomic():
-                if acquired is False:
-                    logger.debug("Not running scheduler, another task holds lock")
-                    return
-                logger.debug("Starting Scheduler")
-                with task_manager_bulk_reschedule():
-                    self._schedule()
-                logger.debug("Finishing Scheduler")
+        lock_name = 'task_manager_lock'
+        if self.shard is not None:
+            lock_name = 'task_manager_lock_{}'.format(self.shard)
+        with advisory_lock(lock_name, wait=False) as acquired:
+            committed = False
+            try:
+                with transaction.atomic():
+                    if acquired is False:
+                        logger.debug("Not running scheduler, another task holds lock")
+                        return
+                    logger.debug("Starting Scheduler")
+                    try:
+                        with task_manager_bulk_reschedule():
+                            self._schedule()
+                    except Exception:
+                        # any changes made to the tasks kept between cycles are
+                        # being rolled back
+                        if self.state is not None:
+                            self.state.invalidate()
+                        if self.dag_cache is not None:
+                            self.dag_cache.invalidate()
+                        raise
+                    self.profile.finish()
+                    logger.debug("Finishing Scheduler")
+                committed = True
+            finally:
+                # the tasks started by this shard have been committed (and
+                # are visible to the other shards), or rolled back
+                if acquired is not False and self.ledger is not None:
+                    try:
+                        self.ledger.release(committed)
+                    except redis.RedisError:
+                        logger.exception('could not release the task manager capacity ledger')
@@ -2,8 +2,14 @@
 # Python
 import logging
 
+# Django
+from django.conf import settings
+
 # AWX
 from awx.main.scheduler import TaskManager
+from awx.main.scheduler.dag_cache import get_workflow_dag_cache
+from awx.main.scheduler.shards import shard_order
+from awx.main.scheduler.state import get_scheduler_state
 from awx.main.dispatch.publish import task
 from awx.main.dispatch import get_local_queuename
 
@@ -13,4 +19,11 @@ logger = logging.getLogger('awx.main.scheduler')
 @task(queue=get_local_queuename)
 def run_task_manager():
     logger.debug("Running Tower task manager.")
-    TaskManager().schedule()
+    if settings.TASK_MANAGER_SHARDS > 1:
+        for shard in shard_order(settings.TASK_MANAGER_SHARDS):
+            try:
+                TaskManager(shard=shard).schedule()
+            except Exception:
+                logger.exception('Failed to schedule task manager shard {}'.format(shard))
+        return
+    TaskManager(state=get_scheduler_state(), dag_cache=get_workflow_dag_cache()).schedule()
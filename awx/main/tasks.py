@@ -57,7 +57,7 @@ from awx.main.analytics import all_collectors, expensive_collectors
 from awx.main.redact import UriCleaner
 from awx.main.models import (
     Schedule, TowerScheduleState, Instance, InstanceGroup,
-    UnifiedJob, Notification,
+    UnifiedJob, UnifiedJobStdoutChunk, Notification,
     Inventory, InventorySource, SmartInventoryMembership,
     Job, AdHocCommand, ProjectUpdate, InventoryUpdate, SystemJob,
     JobEvent, ProjectUpdateEvent, InventoryUpdateEvent, AdHocCommandEvent, SystemJobEvent,
@@ -69,6 +69,7 @@ from awx.main.queue import CallbackQueueDispatcher
 from awx.main.isolated import manager as isolated_manager
 from awx.main.dispatch.publish import task
 from awx.main.dispatch import get_local_queuename, reaper
+from awx.main.dispatch.durable import remove_queue
 from awx.main.utils import (update_scm_url,
                             ignore_inventory_computed_fields,
                             ignore_inventory_group_removal, extract_ansible_vars, schedule_task_manager,
@@ -419,13 +420,42 @@ def gather_analytics():
                 _gather_and_ship(subset, since=since, until=gather_time)
 
 
+@task(queue=get_local_queuename)
+def compact_stdout_chunks():
+    with advisory_lock('compact_stdout_chunks_lock', wait=False) as acquired:
+        if acquired is False:
+            logger.debug("Not running stdout chunk compaction, another task holds lock")
+            return
+        expired = now() - timedelta(seconds=settings.STDOUT_CHUNK_COMPACT_TIMEOUT)
+        job_ids = UnifiedJobStdoutChunk.objects.filter(complete=False).exclude(
+            unified_job__status__in=ACTIVE_STATES
+        ).values_list('unified_job_id', flat=True).distinct()
+        for uj in UnifiedJob.objects.filter(pk__in=list(job_ids)).iterator():
+            try:
+                if uj.event_processing_finished:
+                    UnifiedJobStdoutChunk.compact(uj)
+                elif (uj.finished or uj.modified) < expired:
+                    # some of this job's events were never saved (or it never
+                    # ran, e.g., because it was canceled before it started);
+                    # its stdout is served from the events that were
+                    logger.warning('Discarding stdout chunks of {}, event processing did not finish'.format(uj.log_format))
+                    UnifiedJobStdoutChunk.objects.filter(unified_job_id=uj.pk).delete()
+            except DatabaseError:
+                logger.exception('Database error compacting stdout chunks of {}'.format(uj.log_format))
+
+
 @task(queue=get_local_queuename)
 def purge_old_stdout_files():
+    # stdout is no longer spooled to JOBOUTPUT_ROOT, but the files spooled
+    # by earlier versions still expire
+    if not os.path.isdir(settings.JOBOUTPUT_ROOT):
+        return
     nowtime = time.time()
     for f in os.listdir(settings.JOBOUTPUT_ROOT):
-        if os.path.getctime(os.path.join(settings.JOBOUTPUT_ROOT,f)) < nowtime - settings.LOCAL_STDOUT_EXPIRE_TIME:
-            os.unlink(os.path.join(settings.JOBOUTPUT_ROOT,f))
-            logger.debug("Removing {}".format(os.path.join(settings.JOBOUTPUT_ROOT,f)))
+        path = os.path.join(settings.JOBOUTPUT_ROOT, f)
+        if os.path.isfile(path) and os.path.getctime(path) < nowtime - settings.LOCAL_STDOUT_EXPIRE_TIME:
+            os.unlink(path)
+            logger.debug("Removing {}".format(path))
 
 
 @task(queue=get_local_queuename)
@@ -491,6 +521,7 @@ def cluster_node_heartbeat():
             elif settings.AWX_AUTO_DEPROVISION_INSTANCES:
                 deprovision_hostname = other_inst.hostname
                 other_inst.delete()
+                remove_queue(deprovision_hostname)
                 logger.info("Host {} Automatically Deprovisioned.".format(deprovision_hostname))
         except DatabaseError as e:
             if 'did not affect any rows' in str(e):
@@ -1252,13 +1283,8 @@ class BaseTask(object):
             # with regex, but project updates don't have many events,
             # so it *should* have a negligible performance impact
             task = event_data.get('event_data', {}).get('task_action')
-            try:
-                if task in ('git', 'hg', 'svn'):
-                    event_data_json = json.dumps(event_data)
-                    event_data_json = UriCleaner.remove_sensitive(event_data_json)
-                    event_data = json.loads(event_data_json)
-            except json.JSONDecodeError:
-                pass
+            if task in ('git', 'hg', 'svn'):
+                event_data = UriCleaner.remove_sensitive_from_data(event_data)
 
         event_data.setdefault(self.event_data_key, self.instance.id)
         self.dispatcher.dispatch(event_data)
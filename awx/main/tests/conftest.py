@@ -129,6 +129,107 @@ def mock_cache():
     return MockCache()
 
 
+@pytest.fixture
+def mock_redis():
+    '''
+    An in-memory stand-in for the strings, hashes, and WATCH/MULTI/EXEC
+    transactions of redis
+    '''
+    import redis
+
+    def _bytes(value):
+        return value if isinstance(value, bytes) else str(value).encode('utf-8')
+
+    class MockPipeline(object):
+
+        def __init__(self, conn):
+            self.conn = conn
+            self.reset()
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            self.reset()
+
+        def reset(self):
+            self.watching = {}
+            self.queue = []
+
+        def watch(self, *keys):
+            # commands run immediately until multi()
+            self.watching = dict((key, self.conn.versions.get(key, 0)) for key in keys)
+            self.queue = None
+
+        def multi(self):
+            self.queue = []
+
+        def __getattr__(self, name):
+            method = getattr(self.conn, name)
+
+            def command(*args):
+                if self.queue is None:
+                    return method(*args)
+                self.queue.append((method, args))
+                return self
+            return command
+
+        def execute(self):
+            queue, watching = self.queue or [], self.watching
+            self.reset()
+            if any(self.conn.versions.get(key, 0) != version for key, version in watching.items()):
+                raise redis.WatchError()
+            return [method(*args) for method, args in queue]
+
+    class MockRedis(object):
+
+        def __init__(self):
+            self.data = {}
+            # key -> number of times it was written, for WATCH
+            self.versions = {}
+
+        def _written(self, key):
+            self.versions[key] = self.versions.get(key, 0) + 1
+
+        def pipeline(self):
+            return MockPipeline(self)
+
+        def get(self, key):
+            value = self.data.get(key)
+            return None if value is None else _bytes(value)
+
+        def incr(self, key):
+            self.data[key] = int(self.data.get(key, 0)) + 1
+            self._written(key)
+            return self.data[key]
+
+        def delete(self, *keys):
+            for key in keys:
+                if self.data.pop(key, None) is not None:
+                    self._written(key)
+
+        def expire(self, key, seconds):
+            return key in self.data
+
+        def hgetall(self, key):
+            return dict(self.data.get(key, {}))
+
+        def hset(self, key, field, value):
+            self.data.setdefault(key, {})[_bytes(field)] = _bytes(value)
+            self._written(key)
+
+        def hmset(self, key, mapping):
+            for field, value in mapping.items():
+                self.hset(key, field, value)
+
+        def hdel(self, key, *fields):
+            for field in fields:
+                self.data.get(key, {}).pop(_bytes(field), None)
+            self._written(key)
+
+    return MockRedis()
+
+
 def pytest_runtest_teardown(item, nextitem):
     # clear Django cache at the end of every test ran
     # NOTE: this should not be memcache (as it is deprecated), nor should it be redis.
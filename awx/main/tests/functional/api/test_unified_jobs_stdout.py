@@ -13,7 +13,8 @@ from awx.api.versioning import reverse
 from awx.main.models import (Job, JobEvent, AdHocCommand, AdHocCommandEvent,
                              Project, ProjectUpdate, ProjectUpdateEvent,
                              InventoryUpdate, InventorySource,
-                             InventoryUpdateEvent, SystemJob, SystemJobEvent)
+                             InventoryUpdateEvent, SystemJob, SystemJobEvent,
+                             UnifiedJobStdoutChunk)
 
 
 def _mk_project_update():
@@ -179,8 +180,9 @@ def test_max_bytes_display(sqlite_copy_expert, Parent, Child, relation, view, fm
         )
     )
 
+    # each event's stdout is newline-terminated
     response = get(url + '?format={}_download'.format(fmt), user=admin, expect=200)
-    assert smart_str(response.content) == large_stdout
+    assert smart_str(response.content) == large_stdout + '\n'
 
 
 @pytest.mark.django_db
@@ -252,6 +254,67 @@ def test_text_with_unicode_stdout(sqlite_copy_expert, Parent, Child, relation,
     assert smart_str(response.content).splitlines() == ['オ%d' % i for i in range(3)]
 
 
+@pytest.mark.django_db
+@pytest.mark.parametrize('fmt', ['txt_download', 'ansi_download'])
+def test_stdout_download_streamed_from_events(get, admin, fmt):
+    job = Job()
+    job.save()
+    for i in range(3):
+        JobEvent(job=job, stdout='Testing {}\r\nLine {}'.format(i, i), start_line=i * 2).save()
+    JobEvent(job=job, stdout='', start_line=6).save()
+    url = reverse('api:job_stdout', kwargs={'pk': job.pk}) + '?format=' + fmt
+
+    response = get(url, user=admin, expect=200)
+    assert response['Content-Disposition'].startswith('attachment; filename="job_{}'.format(job.pk))
+    assert smart_str(response.content) == ''.join(
+        'Testing {}\nLine {}\n'.format(i, i) for i in range(3)
+    )
+
+
+@pytest.mark.django_db
+def test_stdout_download_keeps_trailing_blank_lines(get, admin):
+    # as with COPY ... TO STDOUT, an event's stdout spans the lines it
+    # records, including a blank line after a final line ending
+    job = Job()
+    job.save()
+    JobEvent(job=job, stdout='Testing\r\n', start_line=0, end_line=2).save()
+    JobEvent(job=job, stdout='Done', start_line=2, end_line=3).save()
+    url = reverse('api:job_stdout', kwargs={'pk': job.pk}) + '?format=txt_download'
+
+    response = get(url, user=admin, expect=200)
+    assert smart_str(response.content) == 'Testing\n\nDone\n'
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('Parent, Child, relation, view', [
+    [Job, JobEvent, 'job', 'api:job_stdout'],
+    [AdHocCommand, AdHocCommandEvent, 'ad_hoc_command', 'api:ad_hoc_command_stdout'],
+    [_mk_project_update, ProjectUpdateEvent, 'project_update', 'api:project_update_stdout'],
+    [_mk_inventory_update, InventoryUpdateEvent, 'inventory_update', 'api:inventory_update_stdout'],
+])
+def test_stdout_line_range_from_events(Parent, Child, relation, view, get, admin):
+    # events that record the lines they span are read without falling back
+    # to copy_expert (which sqlite doesn't support)
+    job = Parent()
+    job.save()
+    for i in range(10):
+        Child(**{
+            relation: job,
+            'stdout': 'Testing {}\r\nDone {}'.format(i, i),
+            'start_line': i * 2,
+            'end_line': i * 2 + 2
+        }).save()
+    url = reverse(view, kwargs={'pk': job.pk})
+
+    response = get(url + '?format=json&start_line=5&end_line=9', user=admin, expect=200)
+    assert response.data['range'] == {'start': 5, 'end': 9, 'absolute_end': 20}
+    assert smart_str(response.data['content']).splitlines() == ['Done 2', 'Testing 3', 'Done 3', 'Testing 4']
+
+    response = get(url + '?format=json&start_line=-3', user=admin, expect=200)
+    assert response.data['range'] == {'start': 17, 'end': 20, 'absolute_end': 20}
+    assert smart_str(response.data['content']).splitlines() == ['Done 8', 'Testing 9', 'Done 9']
+
+
 @pytest.mark.django_db
 def test_unicode_with_base64_ansi(sqlite_copy_expert, get, admin):
     job = Job()
@@ -266,3 +329,111 @@ def test_unicode_with_base64_ansi(sqlite_copy_expert, get, admin):
     response = get(url, user=admin, expect=200)
     content = base64.b64decode(json.loads(smart_str(response.content))['content'])
     assert smart_str(content).splitlines() == ['オ%d' % i for i in range(3)]
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('Parent, Child, relation, view', [
+    [Job, JobEvent, 'job', 'api:job_stdout'],
+    [AdHocCommand, AdHocCommandEvent, 'ad_hoc_command', 'api:ad_hoc_command_stdout'],
+    [_mk_project_update, ProjectUpdateEvent, 'project_update', 'api:project_update_stdout'],
+    [_mk_inventory_update, InventoryUpdateEvent, 'inventory_update', 'api:inventory_update_stdout'],
+])
+def test_stdout_from_chunks(Parent, Child, relation, view, get, admin, settings):
+    # stdout chunks are read without falling back to copy_expert (which
+    # sqlite doesn't support)
+    settings.STDOUT_CHUNK_LINES = 3
+    job = Parent()
+    job.save()
+    events = []
+    for i in range(10):
+        event = Child(**{relation: job, 'stdout': 'Testing {}'.format(i), 'start_line': i, 'end_line': i + 1})
+        event.save()
+        events.append(event)
+    UnifiedJobStdoutChunk.add_events(events[:5])
+    UnifiedJobStdoutChunk.add_events(events[5:])
+    assert UnifiedJobStdoutChunk.objects.filter(unified_job_id=job.pk).count() == 5
+    assert UnifiedJobStdoutChunk.compact(job) is True
+    assert UnifiedJobStdoutChunk.objects.filter(unified_job_id=job.pk, complete=True).count() == 4
+    url = reverse(view, kwargs={'pk': job.pk})
+
+    for fmt in ('txt', 'txt_download'):
+        response = get(url + '?format={}'.format(fmt), user=admin, expect=200)
+        assert smart_str(response.content).splitlines() == ['Testing %d' % i for i in range(10)]
+
+    response = get(url + '?format=html&start_line=5&end_line=8', user=admin, expect=200)
+    assert re.findall('Testing [0-9]+', smart_str(response.content)) == ['Testing %d' % i for i in range(5, 8)]
+
+    response = get(url + '?format=json&start_line=-2', user=admin, expect=200)
+    assert response.data['range'] == {'start': 8, 'end': 10, 'absolute_end': 10}
+    assert smart_str(response.data['content']).splitlines() == ['Testing 8', 'Testing 9']
+
+
+@pytest.mark.django_db
+def test_stdout_chunks_out_of_order(settings):
+    settings.STDOUT_CHUNK_LINES = 2
+    job = Job()
+    job.save()
+    events = [
+        JobEvent(job=job, stdout='a\r\nb\r\nc', start_line=0, end_line=3),
+        JobEvent(job=job, stdout='d', start_line=3, end_line=4),
+        JobEvent(job=job, stdout='', start_line=4, end_line=4),
+        JobEvent(job=job, stdout='e\r\nf', start_line=4, end_line=6),
+    ]
+    for event in events:
+        event.save()
+    # events for a job are saved by several callback receiver workers, and
+    # don't necessarily arrive in order
+    UnifiedJobStdoutChunk.add_events(events[2:])
+    UnifiedJobStdoutChunk.add_events(events[:2])
+    assert UnifiedJobStdoutChunk.compact(job) is True
+    assert ''.join(job.stdout_chunk_lines()) == 'a\nb\nc\nd\ne\nf\n'
+    assert ''.join(job.stdout_chunk_lines(2, 5)) == 'c\nd\ne\n'
+
+
+@pytest.mark.django_db
+def test_stdout_chunks_match_events(settings):
+    settings.STDOUT_CHUNK_LINES = 2
+    job = Job()
+    job.save()
+    events = [
+        JobEvent(job=job, stdout='a', start_line=0, end_line=1),
+        JobEvent(job=job, stdout='', start_line=1, end_line=1),
+        JobEvent(job=job, stdout='b\r\nc', start_line=1, end_line=3),
+        # stdout that ends with a line ending is followed by a blank line
+        JobEvent(job=job, stdout='d\r\n', start_line=3, end_line=5),
+        JobEvent(job=job, stdout='e\r\n\r\nf', start_line=5, end_line=8),
+    ]
+    for event in events:
+        event.save()
+    from_events = ''.join(job.result_stdout_raw_lines())
+    ranges = [(start, end) for start in range(-3, 9) for end in (None, 2, 5, 8)]
+    limited = dict((r, job._result_stdout_raw_limited(*r)) for r in ranges)
+
+    UnifiedJobStdoutChunk.add_events(events)
+    assert UnifiedJobStdoutChunk.compact(job) is True
+    assert job.has_complete_stdout_chunks
+    assert from_events == 'a\nb\nc\nd\n\ne\n\nf\n'
+    assert ''.join(job.result_stdout_raw_lines()) == from_events
+    for r in ranges:
+        assert job._result_stdout_raw_limited(*r) == limited[r], r
+
+
+@pytest.mark.django_db
+def test_incomplete_stdout_chunks(settings):
+    settings.STDOUT_CHUNK_LINES = 2
+    job = Job()
+    job.save()
+    events = []
+    for i in range(4):
+        event = JobEvent(job=job, stdout='Testing {}'.format(i), start_line=i, end_line=i + 1)
+        event.save()
+        events.append(event)
+    # until they're compacted, stdout isn't served from chunks
+    UnifiedJobStdoutChunk.add_events(events[1:])
+    assert not job.has_complete_stdout_chunks
+
+    # the stdout of the first event was never recorded (say, because the
+    # job started before an upgrade), so the chunks are discarded
+    assert UnifiedJobStdoutChunk.compact(job) is False
+    assert not UnifiedJobStdoutChunk.objects.filter(unified_job_id=job.pk).exists()
+    assert ''.join(job.result_stdout_raw_lines()).splitlines() == ['Testing %d' % i for i in range(4)]
@@ -8,7 +8,7 @@ from unittest.mock import PropertyMock
 
 # Django
 from django.urls import resolve
-from django.http import Http404
+from django.http import Http404, HttpResponse
 from django.core.handlers.exception import response_for_exception
 from django.contrib.auth.models import User
 from django.core.serializers.json import DjangoJSONEncoder
@@ -648,6 +648,12 @@ def _request(verb):
             )
         if hasattr(response, 'render'):
             response.render()
+        if response.streaming:
+            # consume streamed content so that tests can inspect it as usual
+            streamed = HttpResponse(b''.join(response.streaming_content), status=response.status_code)
+            for header, value in response.items():
+                streamed[header] = value
+            response = streamed
         __SWAGGER_REQUESTS__.setdefault(request.path, {})[
             (request.method.lower(), response.status_code)
         ] = (response.get('Content-Type', None), response.content, kwargs.get('data'))
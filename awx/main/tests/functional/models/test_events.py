@@ -1,9 +1,35 @@
+import csv
+import io
+import json
 from unittest import mock
+import time
+
 import pytest
 
+from django.db import DataError, OperationalError, connection
 from django.utils.timezone import now
 
-from awx.main.models import Job, JobEvent, Inventory, Host, JobHostSummary
+from awx.main.dispatch.worker import CallbackBrokerWorker, JobFinalizeWorker
+from awx.main.dispatch.worker.callback import JobFinalizeQueue, _copy_value, copy_events
+from awx.main.models import Job, JobEvent, Inventory, Host, JobHostSummary, ProjectUpdateEvent
+from awx.main.utils import codec
+
+
+@pytest.fixture
+def broker_redis(mocker):
+    conn = mocker.patch('redis.Redis.from_url').return_value
+    conn.keys.return_value = []
+    return conn
+
+
+@pytest.fixture
+def callback_worker(broker_redis):
+    return CallbackBrokerWorker()
+
+
+@pytest.fixture
+def finalize_worker(broker_redis):
+    return JobFinalizeWorker()
 
 
 @pytest.mark.django_db
@@ -25,11 +51,13 @@ def test_parent_changed(emit):
         }
     ).save()
     # the `playbook_on_stats` event is where we update the parent changed linkage
-    JobEvent.create_from_data(
+    stats = JobEvent.create_from_data(
         job_id=j.pk,
         parent_uuid='abc123',
         event='playbook_on_stats'
-    ).save()
+    )
+    stats.save()
+    stats.finalize_job()
     events = JobEvent.objects.filter(event__in=['playbook_on_task_start', 'runner_on_ok'])
     assert events.count() == 2
     for e in events.all():
@@ -54,17 +82,183 @@ def test_parent_failed(emit, event):
     ).save()
 
     # the `playbook_on_stats` event is where we update the parent failed linkage
-    JobEvent.create_from_data(
+    stats = JobEvent.create_from_data(
         job_id=j.pk,
         parent_uuid='abc123',
         event='playbook_on_stats'
-    ).save()
+    )
+    stats.save()
+    stats.finalize_job()
     events = JobEvent.objects.filter(event__in=['playbook_on_task_start', event])
     assert events.count() == 2
     for e in events.all():
         assert e.failed is True
 
 
+@pytest.mark.django_db
+@mock.patch('awx.main.models.events.emit_event_detail')
+def test_parent_changed_and_failed_from_tracked_parents(emit):
+    j = Job()
+    j.save()
+    for uuid in ('abc123', 'def456', 'ghi789'):
+        JobEvent.create_from_data(job_id=j.pk, uuid=uuid, event='playbook_on_task_start').save()
+    stats = JobEvent.create_from_data(job_id=j.pk, event='playbook_on_stats')
+    stats.save()
+
+    # when the callback receiver has tracked which parents have changed or
+    # failed children, only those parents are updated
+    stats.finalize_job(changed_parents=['abc123'], failed_parents=['def456'])
+    assert JobEvent.objects.get(uuid='abc123').changed is True
+    assert JobEvent.objects.get(uuid='abc123').failed is False
+    assert JobEvent.objects.get(uuid='def456').changed is False
+    assert JobEvent.objects.get(uuid='def456').failed is True
+    assert JobEvent.objects.get(uuid='ghi789').changed is False
+    assert JobEvent.objects.get(uuid='ghi789').failed is False
+
+
+def test_callback_receiver_records_changed_and_failed_parents(callback_worker, broker_redis):
+    callback_worker.record_parents([
+        JobEvent(job_id=1, uuid='a', parent_uuid='p1', changed=True),
+        JobEvent(job_id=1, uuid='b', parent_uuid='p2', failed=True),
+        JobEvent(job_id=1, uuid='c', parent_uuid='p3'),
+        JobEvent(job_id=2, uuid='d', parent_uuid='p4', changed=True, failed=True),
+    ])
+    broker_redis.pipeline.return_value.sadd.assert_has_calls([
+        mock.call('awx_job_finalize_1_parents_changed', 'p1'),
+        mock.call('awx_job_finalize_1_parents_failed', 'p2'),
+        mock.call('awx_job_finalize_2_parents_changed', 'p4'),
+        mock.call('awx_job_finalize_2_parents_failed', 'p4'),
+    ], any_order=True)
+
+
+def test_callback_receiver_bisects_failed_batches(callback_worker):
+    events = [JobEvent(job_id=1, uuid=str(i)) for i in range(10)]
+    bad = events[7]
+    saved = []
+
+    def bulk_create(batch):
+        if bad in batch:
+            raise DataError('broken event')
+        saved.extend(batch)
+
+    with mock.patch.object(JobEvent.objects, 'bulk_create', side_effect=bulk_create):
+        assert callback_worker.save_events(JobEvent, events) == [e for e in events if e is not bad]
+    assert saved == [e for e in events if e is not bad]
+
+
+def test_callback_receiver_raises_connection_errors(callback_worker):
+    # losing the database doesn't mean the events are bad; they're retried
+    # by process_message() rather than discarded
+    events = [JobEvent(job_id=1, uuid=str(i)) for i in range(10)]
+    with mock.patch.object(JobEvent.objects, 'bulk_create', side_effect=OperationalError('gone')) as bulk_create:
+        with pytest.raises(OperationalError):
+            callback_worker.save_events(JobEvent, events)
+    assert bulk_create.call_count == 1
+
+
+def test_callback_receiver_side_effects_of_saved_events(callback_worker, mocker):
+    events = [JobEvent(job_id=1, uuid=str(i), event='runner_on_ok') for i in range(4)]
+    events.append(JobEvent(job_id=1, uuid='stats', event='playbook_on_stats'))
+    bad = events[-1]
+
+    def bulk_create(batch):
+        if bad in batch:
+            raise DataError('broken event')
+
+    mocker.patch.object(JobEvent.objects, 'bulk_create', side_effect=bulk_create)
+    record_stdout = mocker.patch.object(callback_worker, 'record_stdout')
+    emit = mocker.patch('awx.main.dispatch.worker.callback.emit_event_details')
+    finalize = mocker.patch.object(callback_worker.finalize_queue, 'put')
+    callback_worker.buff = {JobEvent: events}
+    callback_worker.flush(force=True)
+
+    record_stdout.assert_called_once_with(events[:-1])
+    emit.assert_called_once_with(events[:-1])
+    finalize.assert_not_called()
+
+
+def test_copy_values():
+    assert _copy_value(None) == ''
+    assert _copy_value('') == '""'
+    assert _copy_value('say "hi"\r\nbye\x00') == '"say ""hi""\r\nbye"'
+
+
+def test_copy_events(mocker):
+    events = [
+        JobEvent(job_id=1, uuid='a', counter=1, stdout='one\r\ntwo "2", three\x00',
+                 event_data={'res': {'msg': 'a,"b"\n'}}),
+        JobEvent(job_id=1, uuid='b', counter=2),
+    ]
+    cursor = mocker.patch.object(connection, 'cursor').return_value.__enter__.return_value
+    cursor.fetchall.return_value = [(101,), (102,)]
+    copy_events(JobEvent, events)
+
+    # IDs are allocated from the table's sequence
+    sql, params = cursor.execute.call_args[0]
+    assert 'nextval' in sql
+    assert params == [JobEvent._meta.db_table, 2]
+    assert [e.id for e in events] == [101, 102]
+
+    sql, buff = cursor.copy_expert.call_args[0]
+    columns = sql[sql.index('(') + 1:sql.index(')')].split(', ')
+    rows = [dict(zip(columns, row)) for row in csv.reader(io.StringIO(buff.getvalue(), newline=''))]
+    assert len(rows) == 2
+    assert rows[0]['id'] == '101'
+    assert rows[0]['uuid'] == 'a'
+    assert rows[0]['stdout'] == 'one\r\ntwo "2", three'
+    assert json.loads(rows[0]['event_data']) == {'res': {'msg': 'a,"b"\n'}}
+    assert rows[1]['id'] == '102'
+    assert rows[1]['counter'] == '2'
+
+
+def test_callback_receiver_reads_in_batches(settings, callback_worker, broker_redis):
+    settings.JOB_EVENT_READ_BATCH_SIZE = 3
+    broker_redis.blpop.return_value = (settings.CALLBACK_QUEUE, b'{"counter": 1}')
+    pipe = broker_redis.pipeline.return_value
+    pipe.execute.return_value = [[b'{"counter": 2}', b'not-json'], True]
+
+    assert callback_worker.read(None) == [{'counter': 1}, {'counter': 2}]
+    pipe.lrange.assert_called_once_with(settings.CALLBACK_QUEUE, 0, 1)
+    pipe.ltrim.assert_called_once_with(settings.CALLBACK_QUEUE, 2, -1)
+
+    broker_redis.blpop.return_value = None
+    assert callback_worker.read(None) == [{'event': 'FLUSH'}]
+
+
+def test_callback_receiver_reads_until_buffers_are_due(settings, callback_worker, broker_redis):
+    settings.JOB_EVENT_BUFFER_SECONDS = 1
+    settings.JOB_EVENT_BUFFER_POLICY = {'ProjectUpdateEvent': {'max_age': 0.25}}
+    broker_redis.blpop.return_value = None
+    callback_worker.read(None)
+    assert broker_redis.blpop.call_args[1]['timeout'] == 1
+
+    callback_worker.buff = {ProjectUpdateEvent: [ProjectUpdateEvent()]}
+    callback_worker.buff_started = {ProjectUpdateEvent: time.time()}
+    callback_worker.read(None)
+    assert 0.2 < broker_redis.blpop.call_args[1]['timeout'] <= 0.25
+
+    # overdue buffers still block briefly, rather than spinning
+    callback_worker.buff_started[ProjectUpdateEvent] -= 5
+    callback_worker.read(None)
+    assert broker_redis.blpop.call_args[1]['timeout'] == CallbackBrokerWorker.MIN_READ_TIMEOUT
+
+
+def test_callback_receiver_buffer_policy(settings, callback_worker):
+    settings.JOB_EVENT_BUFFER_SIZE = 1000
+    settings.JOB_EVENT_BUFFER_SECONDS = 1
+    settings.JOB_EVENT_BUFFER_POLICY = {'ProjectUpdateEvent': {'size': 2, 'max_age': 60}}
+    worker = callback_worker
+    worker.buff_started = {JobEvent: time.time(), ProjectUpdateEvent: time.time() - 5}
+
+    assert worker.should_flush(JobEvent, [JobEvent()]) is False
+    assert worker.should_flush(JobEvent, [JobEvent()] * 1000) is True
+    worker.buff_started[JobEvent] -= 5
+    assert worker.should_flush(JobEvent, [JobEvent()]) is True
+
+    assert worker.should_flush(ProjectUpdateEvent, [ProjectUpdateEvent()]) is False
+    assert worker.should_flush(ProjectUpdateEvent, [ProjectUpdateEvent()] * 2) is True
+
+
 @pytest.mark.django_db
 def test_host_summary_generation():
     hostnames = [f'Host {i}' for i in range(100)]
@@ -77,7 +271,7 @@ def test_host_summary_generation():
     j = Job(inventory=inv)
     j.save()
     host_map = dict((host.name, host.id) for host in inv.hosts.all())
-    JobEvent.create_from_data(
+    stats = JobEvent.create_from_data(
         job_id=j.pk,
         parent_uuid='abc123',
         event='playbook_on_stats',
@@ -92,7 +286,9 @@ def test_host_summary_generation():
             'skipped': {},
         },
         host_map=host_map
-    ).save()
+    )
+    stats.save()
+    stats.finalize_job()
 
     assert j.job_host_summaries.count() == len(hostnames)
     assert sorted([s.host_name for s in j.job_host_summaries.all()]) == sorted(hostnames)
@@ -130,7 +326,7 @@ def test_host_summary_generation_with_deleted_hosts():
     for h in inv.hosts.all()[:5]:
         h.delete()
 
-    JobEvent.create_from_data(
+    stats = JobEvent.create_from_data(
         job_id=j.pk,
         parent_uuid='abc123',
         event='playbook_on_stats',
@@ -145,7 +341,9 @@ def test_host_summary_generation_with_deleted_hosts():
             'skipped': {},
         },
         host_map=host_map
-    ).save()
+    )
+    stats.save()
+    stats.finalize_job()
 
 
     ids = sorted([s.host_id or -1 for s in j.job_host_summaries.order_by('id').all()])
@@ -179,7 +377,7 @@ def test_host_summary_generation_with_limit():
     # by making the playbook_on_stats *only* include Host 1, we're emulating
     # the behavior of a `--limit=Host 1`
     matching_host = Host.objects.get(name='Host 1')
-    JobEvent.create_from_data(
+    stats = JobEvent.create_from_data(
         job_id=j.pk,
         parent_uuid='abc123',
         event='playbook_on_stats',
@@ -194,7 +392,9 @@ def test_host_summary_generation_with_limit():
             'skipped': {},
         },
         host_map=host_map
-    ).save()
+    )
+    stats.save()
+    stats.finalize_job()
 
     # since the playbook_on_stats only references one host,
     # there should *only* be on JobHostSummary record (and it should
@@ -208,3 +408,108 @@ def test_host_summary_generation_with_limit():
             # all other hosts in the inventory should remain untouched
             assert h.last_job_id is None
             assert h.last_job_host_summary_id is None
+
+
+def test_job_finalize_queue_get():
+    conn = mock.Mock()
+    conn.register_script.return_value.return_value = [
+        [b'1', codec.dumps({'id': 10, 'job_id': 1}), [b'p1'], []],
+    ]
+    queue = JobFinalizeQueue(conn)
+    assert queue.get(timeout=1, batch_size=10) == [
+        {'id': 10, 'job_id': 1, 'changed_parents': ['p1'], 'failed_parents': []}
+    ]
+    conn.blpop.assert_not_called()
+
+    # when nothing is queued, wait to be woken up, then try again
+    conn.register_script.return_value.return_value = []
+    conn.blpop.return_value = None
+    assert queue.get(timeout=1, batch_size=10) == []
+    conn.blpop.assert_called_once_with(JobFinalizeQueue.WAKEUP, timeout=1)
+
+
+@pytest.mark.django_db
+def test_host_summary_generation_is_idempotent():
+    inv = Inventory()
+    inv.save()
+    host = Host(name='Host 1', inventory=inv)
+    host.save()
+    j = Job(inventory=inv)
+    j.save()
+    stats = JobEvent.create_from_data(
+        job_id=j.pk,
+        event='playbook_on_stats',
+        event_data={'ok': {'Host 1': 1}},
+        host_map={'Host 1': host.id}
+    )
+    stats.save()
+    # a job is finalized again if its finalize worker dies part way through
+    stats.finalize_job()
+    stats.finalize_job()
+    assert JobHostSummary.objects.count() == 1
+
+
+@pytest.mark.django_db
+def test_host_summary_generation_is_deferred(finalize_worker, broker_redis):
+    # saving a playbook_on_stats event doesn't generate host summaries; that
+    # happens later, when the callback receiver finalizes the job
+    inv = Inventory()
+    inv.save()
+    host = Host(name='Host 1', inventory=inv)
+    host.save()
+    j = Job(inventory=inv)
+    j.save()
+    stats = JobEvent.create_from_data(
+        job_id=j.pk,
+        event='playbook_on_stats',
+        event_data={'ok': {'Host 1': 1}},
+        host_map={'Host 1': host.id}
+    )
+    stats.save()
+    assert JobHostSummary.objects.count() == 0
+
+    finalize_worker.perform_work([{
+        'id': stats.id,
+        'job_id': j.pk,
+        'event_data': stats.event_data,
+        'host_map': stats.host_map,
+        'changed_parents': [],
+        'failed_parents': [],
+        'queued': time.time(),
+    }])
+    assert JobHostSummary.objects.count() == 1
+    assert Host.objects.get(pk=host.pk).last_job_id == j.id
+    broker_redis.pipeline.return_value.zrem.assert_called_once_with(JobFinalizeQueue.PROCESSING, j.pk)
+
+
+def finalize_payload(job):
+    return {
+        'id': 1, 'job_id': job.pk, 'event_data': {}, 'host_map': {},
+        'changed_parents': [], 'failed_parents': [], 'queued': time.time(),
+    }
+
+
+@pytest.mark.django_db
+def test_job_finalization_is_retried_after_database_errors(finalize_worker, broker_redis, mocker):
+    inv = Inventory()
+    inv.save()
+    lost, finished = Job(inventory=inv), Job(inventory=inv)
+    lost.save()
+    finished.save()
+    mocker.patch.object(JobEvent, 'finalize_job', side_effect=[OperationalError(), None])
+    finalize_worker.perform_work([finalize_payload(lost), finalize_payload(finished)])
+    # the job left in flight is put back on the queue after JOB_FINALIZE_TIMEOUT
+    broker_redis.pipeline.return_value.zrem.assert_called_once_with(JobFinalizeQueue.PROCESSING, finished.pk)
+
+
+@pytest.mark.django_db
+def test_jobs_are_acknowledged_once_their_inventories_are_updated(finalize_worker, broker_redis, mocker):
+    inv = Inventory()
+    inv.save()
+    job = Job(inventory=inv)
+    job.save()
+    mocker.patch.object(JobEvent, 'finalize_job')
+    mocker.patch.object(Inventory, 'update_computed_fields', side_effect=OperationalError())
+    finalize_worker.perform_work([finalize_payload(job)])
+    assert not broker_redis.pipeline.return_value.zrem.called
+
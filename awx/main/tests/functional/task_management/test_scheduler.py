@@ -5,6 +5,7 @@ from datetime import timedelta
 
 from awx.main.scheduler import TaskManager
 from awx.main.scheduler.dependency_graph import DependencyGraph
+from awx.main.scheduler.shards import get_shard
 from awx.main.utils import encrypt_field
 from awx.main.models import WorkflowJobTemplate, JobTemplate, Job
 
@@ -35,7 +36,8 @@ class TestJobLifeCycle:
         """
         if expect_schedule and len(expect_schedule) > 1:
             raise RuntimeError('Task manager should reschedule itself one time, at most.')
-        with mock.patch('awx.main.models.unified_jobs.UnifiedJob.websocket_emit_status') as mock_channel:
+        with mock.patch('awx.main.models.unified_jobs.UnifiedJob.websocket_emit_status') as mock_channel, \
+                mock.patch('awx.main.models.unified_jobs.UnifiedJob.websocket_emit_status_batch') as mock_batch:
             with mock.patch('awx.main.utils.common._schedule_task_manager') as tm_sch:
                 # Job are ultimately submitted in on_commit hook, but this will not
                 # actually run, because it waits until outer transaction, which is the test
@@ -43,7 +45,13 @@ class TestJobLifeCycle:
                 with mock.patch('django.db.connection.on_commit') as mock_commit:
                     tm.schedule()
                     if expect_channel is not None:
-                        assert mock_channel.mock_calls == expect_channel
+                        # the jobs started in a cycle emit their status together
+                        batched = [
+                            mock.call(status)
+                            for (jobs, status), kwargs in mock_batch.call_args_list
+                            for job in jobs
+                        ]
+                        assert mock_channel.mock_calls + batched == expect_channel
                     if expect_schedule is not None:
                         assert tm_sch.mock_calls == expect_schedule
                     if expect_commit is not None:
@@ -329,6 +337,36 @@ def test_shared_dependencies_launch(default_instance_group, job_template_factory
     assert len(iu) == 1
 
 
+@pytest.mark.django_db
+def test_shared_dependencies_per_project(default_instance_group, job_template_factory):
+    jobs = {}
+    for i in (1, 2):
+        objects = job_template_factory('jt{}'.format(i), organization='org{}'.format(i), project='proj{}'.format(i),
+                                       inventory='inv{}'.format(i), credential='cred{}'.format(i),
+                                       jobs=['a', 'b', 'c'])
+        p = objects.project
+        p.scm_update_on_launch = True
+        p.scm_update_cache_timeout = 300
+        p.scm_type = "git"
+        p.scm_url = "http://github.com/ansible/ansible.git"
+        p.save()
+        for job in objects.jobs.values():
+            job.status = 'pending'
+            job.save()
+        jobs[p] = objects.jobs.values()
+
+    with mock.patch("awx.main.scheduler.TaskManager.start_task"):
+        TaskManager()._schedule()
+
+    for p, project_jobs in jobs.items():
+        # one update per project, which every job launched against it waits on
+        assert p.project_updates.count() == 1
+        pu = p.project_updates.first()
+        for job in project_jobs:
+            assert list(Job.objects.get(pk=job.pk).dependent_jobs.all()) == [pu]
+        assert set(pu.dependent_jobs.values_list('pk', flat=True)) == set(job.pk for job in project_jobs)
+
+
 @pytest.mark.django_db
 def test_job_not_blocking_project_update(default_instance_group, job_template_factory):
     objects = job_template_factory('jt', organization='org1', project='proj',
@@ -415,3 +453,160 @@ def test_generate_dependencies_only_once(job_template_factory):
         # the first positional arg, i.e. the first argument of
         # .generate_dependencies()
         assert tm.generate_dependencies.call_args[0][0] == []
+
+
+@pytest.mark.django_db
+def test_processed_dependencies_are_recorded_as_transitions(job_template_factory):
+    objects = job_template_factory('jt', organization='org1')
+    job = objects.job_template.create_job()
+    job.status = "pending"
+    job.save()
+
+    # other processes that keep tasks between cycles reload the job, which
+    # doesn't change status when its dependencies are processed
+    with mock.patch("awx.main.scheduler.TaskManager.start_task"):
+        with mock.patch("awx.main.scheduler.task_manager.record_transitions") as record_transitions:
+            TaskManager()._schedule()
+    assert [job.pk] in [[t.pk for t in call[0][0]] for call in record_transitions.call_args_list]
+
+
+@pytest.mark.django_db
+def test_get_tasks(job_template_factory, inventory_source_factory, instance_group_factory):
+    objects = job_template_factory('jt', organization='org1', project='proj',
+                                   inventory='inv', credential='cred')
+    ig1 = instance_group_factory('ig1')
+    ig2 = instance_group_factory('ig2')
+    objects.job_template.instance_groups.add(ig2)
+    objects.job_template.instance_groups.add(ig1)
+    job = objects.job_template.create_unified_job()
+    check = objects.project.create_project_update(_eager_fields=dict(job_type='check'))
+    run = objects.project.create_project_update(_eager_fields=dict(job_type='run'))
+    ec2 = inventory_source_factory('ec2', source='ec2').create_inventory_update()
+    file_update = inventory_source_factory('file').create_inventory_update()
+    for i, task in enumerate((ec2, check, job, run, file_update)):
+        task.status = 'pending'
+        task.created = task.created + timedelta(seconds=i)
+        task.save()
+
+    tasks = TaskManager().get_tasks()
+    # file inventory updates and job_type=run project updates aren't scheduled
+    assert tasks == [ec2, check, job]
+    # prefetched instance groups keep their order
+    assert tasks[2].preferred_instance_groups == [ig2, ig1]
+
+
+@pytest.mark.django_db
+def test_get_tasks_sharded(settings, job_template_factory):
+    settings.TASK_MANAGER_SHARDS = 2
+    jobs = []
+    for i in (1, 2):
+        objects = job_template_factory('jt{}'.format(i), organization='org{}'.format(i), project='proj{}'.format(i),
+                                       inventory='inv{}'.format(i), credential='cred{}'.format(i))
+        for status in ('pending', 'running'):
+            job = objects.job_template.create_unified_job()
+            job.status = status
+            job.save()
+            jobs.append(job)
+
+    for shard in (0, 1):
+        tasks = TaskManager(shard=shard).get_tasks()
+        # every shard sees what's running, but only its own pending tasks
+        assert set(t.id for t in tasks if t.status == 'running') == set(j.id for j in jobs if j.status == 'running')
+        assert [t.id for t in tasks if t.status == 'pending'] == [
+            j.id for j in jobs if j.status == 'pending' and j.unified_job_template_id % 2 == shard
+        ]
+
+
+@pytest.mark.django_db
+def test_reserved_tasks_of_other_shards_block(settings, default_instance_group, job_template_factory, inventory_source_factory):
+    objects = job_template_factory('jt', organization='org1', project='proj',
+                                   inventory='inv', credential='cred',
+                                   jobs=['job'])
+    job = objects.jobs['job']
+    job.status = 'pending'
+    job.save()
+    inv_source = inventory_source_factory('ec2')
+    inv_source.source = 'ec2'
+    objects.inventory.inventory_sources.add(inv_source)
+    inventory_update = inv_source.create_inventory_update()
+    inventory_update.status = 'pending'
+    inventory_update.save()
+    settings.TASK_MANAGER_SHARDS = next(n for n in range(2, 10) if get_shard(job, n) != get_shard(inventory_update, n))
+
+    # another shard started the inventory update after this one loaded its
+    # tasks, so it only finds out when it tries to start the job
+    with mock.patch('awx.main.scheduler.task_manager.CapacityLedger') as ledger_class:
+        ledger = ledger_class.return_value
+        ledger.snapshot.return_value = {}
+        ledger.reserve.return_value = {inventory_update.id: {
+            'instance_group': default_instance_group.name,
+            'execution_node': default_instance_group.instances.first().hostname,
+            'task_impact': inventory_update.task_impact,
+        }}
+        with mock.patch('awx.main.scheduler.TaskManager.start_task') as start_task:
+            tm = TaskManager(shard=get_shard(job, settings.TASK_MANAGER_SHARDS))
+            tm._schedule()
+    ledger.reserve.assert_called_once_with(job, default_instance_group.name, mock.ANY)
+    start_task.assert_not_called()
+    assert tm.is_job_blocked(job)
+
+
+@pytest.mark.django_db
+def test_preload_dependencies(job_template_factory, django_assert_num_queries):
+    objects = job_template_factory('jt', organization='org1', project='proj',
+                                   inventory='inv', credential='cred',
+                                   jobs=['waiting', 'ready', 'independent'])
+    for job in objects.jobs.values():
+        job.status = 'pending'
+        job.save()
+    running_update = objects.project.create_project_update()
+    running_update.status = 'running'
+    running_update.save()
+    finished_update = objects.project.create_project_update()
+    finished_update.status = 'successful'
+    finished_update.save()
+    objects.jobs['waiting'].dependent_jobs.add(running_update)
+    objects.jobs['ready'].dependent_jobs.add(finished_update)
+
+    tm = TaskManager()
+    jobs = list(objects.jobs.values())
+    with django_assert_num_queries(1):
+        tm.preload_dependencies(jobs)
+        assert [tm.is_job_blocked(job) for job in jobs] == [True, False, False]
+
+
+@pytest.mark.django_db
+def test_submit_tasks(default_instance_group, job_template_factory):
+    instance = default_instance_group.instances.all()[0]
+    objects = job_template_factory('jt', organization='org1', project='proj',
+                                   inventory='inv', credential='cred',
+                                   jobs=['a', 'b', 'c'])
+    jt = objects.job_template
+    jt.allow_simultaneous = True
+    jt.save()
+    for job in objects.jobs.values():
+        job.status = 'pending'
+        job.save()
+
+    with mock.patch('django.db.connection.on_commit', side_effect=lambda fn: fn()):
+        with mock.patch('awx.main.models.UnifiedJob.websocket_emit_status_batch') as emit:
+            with mock.patch('awx.main.scheduler.task_manager.publish_many') as publish:
+                TaskManager()._schedule()
+
+    jobs = list(Job.objects.filter(pk__in=[job.pk for job in objects.jobs.values()]))
+    for job in jobs:
+        assert job.status == 'waiting'
+        assert job.instance_group == default_instance_group
+        assert job.execution_node == instance.hostname
+    jt.refresh_from_db()
+    assert jt.status == 'waiting'
+    assert jt.current_job in jobs
+
+    # the jobs are announced and dispatched together
+    emitted, status = emit.call_args[0]
+    assert emit.call_count == 1 and status == 'waiting'
+    assert set(job.pk for job in emitted) == set(job.pk for job in jobs)
+    messages = publish.call_args[0][0]
+    assert publish.call_count == 1
+    assert sorted(message['uuid'] for message, queue in messages) == sorted(job.celery_task_id for job in jobs)
+    assert set(queue for message, queue in messages) == {instance.hostname}
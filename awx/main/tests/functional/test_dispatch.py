@@ -1,17 +1,22 @@
 import datetime
+import json
 import multiprocessing
 import random
 import signal
 import time
 from unittest import mock
 
+from django.core.exceptions import ImproperlyConfigured
 from django.utils.timezone import now as tz_now
+import psycopg2
 import pytest
 
 from awx.main.models import Job, WorkflowJob, Instance
-from awx.main.dispatch import reaper
-from awx.main.dispatch.pool import StatefulPoolWorker, WorkerPool, AutoscalePool
-from awx.main.dispatch.publish import task
+from awx.main.dispatch import PubSub, reaper
+from awx.main.dispatch.durable import DOORBELL, DurableQueue, acknowledge, is_durable, queued_uuids, remove_queue
+from awx.main.dispatch.envelope import unwrap_payload, wrap_payload
+from awx.main.dispatch.pool import Demand, StatefulPoolWorker, WorkerPool, AutoscalePool, RoutedPool
+from awx.main.dispatch.publish import Publisher, get_publisher, publish_many, task
 from awx.main.dispatch.worker import BaseWorker, TaskWorker
 
 
@@ -76,6 +81,12 @@ class SlowResultWriter(BaseWorker):
         super(SlowResultWriter, self).perform_work(body, result_queue)
 
 
+class SleepingWorker(BaseWorker):
+
+    def perform_work(self, body, *args):
+        time.sleep(3)
+
+
 @pytest.mark.usefixtures("disable_database_settings")
 class TestPoolWorker:
 
@@ -109,6 +120,18 @@ class TestPoolWorker:
         self.worker.calculate_managed_tasks()
         assert len(self.worker.managed_tasks) == 0
 
+    def test_finished_tasks_are_recorded(self):
+        self.worker.demand = Demand(window=10)
+        self.worker.put({'task': 'awx.main.tasks.abc123'})
+        started = time.time()
+        self.worker.finished.put((self.worker.queue.get()['uuid'], started, started + 2))
+        time.sleep(.5)
+        self.worker.calculate_managed_tasks()
+        assert len(self.worker.managed_tasks) == 0
+        assert self.worker.idle_since is not None
+        assert self.worker.demand.waits['abc123']['count'] == 1
+        assert self.worker.demand.runtimes['abc123'] == 2
+
     def test_current_task(self):
         self.worker.put({'task': 'abc123'})
         assert self.worker.current_task['task'] == 'abc123'
@@ -125,6 +148,35 @@ class TestPoolWorker:
         assert self.worker.idle is False
 
 
+class TestDemand:
+
+    def test_workers_needed(self):
+        demand = Demand(window=10)
+        now = time.time()
+        for i in range(20):
+            demand.arrived({'task': 'awx.main.tasks.slow'}, now=now)
+        demand.finished({'task': 'awx.main.tasks.slow'}, 0, 3)
+        # 2 messages per second, which each take 3 seconds
+        assert demand.rate(now=now) == 2
+        assert demand.workers_needed(now=now) == 6
+
+    def test_old_arrivals_expire(self):
+        demand = Demand(window=10)
+        now = time.time()
+        demand.arrived({'task': 'awx.main.tasks.slow'}, now=now - 20)
+        demand.finished({'task': 'awx.main.tasks.slow'}, 0, 3)
+        assert demand.rate(now=now) == 0
+        assert demand.workers_needed(now=now) == 0
+
+    def test_queue_wait(self):
+        demand = Demand(window=10)
+        demand.finished({'task': 'awx.main.tasks.slow'}, 4, 1)
+        demand.finished({'task': 'awx.main.tasks.slow'}, 2, 1)
+        assert demand.waits['slow']['count'] == 2
+        assert demand.waits['slow']['max'] == 4
+        assert 2 < demand.waits['slow']['avg'] < 4
+
+
 @pytest.mark.django_db
 class TestWorkerPool:
 
@@ -173,6 +225,17 @@ class TestWorkerPool:
         total_handled = sum([worker.messages_sent for worker in self.pool.workers])
         assert total_handled == 10
 
+    def test_supervise(self):
+        self.pool.init_workers(SimpleWorker().work_loop)
+        gone = self.pool.workers[0].pid
+        self.pool.workers[0].process.terminate()
+        time.sleep(1)  # wait a moment for sigterm
+
+        self.pool.supervise()
+        assert len(self.pool) == 3
+        assert gone not in [w.pid for w in self.pool.workers]
+        assert all(w.alive for w in self.pool.workers)
+
 
 @pytest.mark.django_db
 class TestAutoScaling:
@@ -272,6 +335,95 @@ class TestAutoScaling:
         self.pool.write(0, 'Hello, Worker')
         assert len(self.pool) == 2
 
+    def test_predictive_scale_up(self, settings):
+        settings.DISPATCHER_PREDICTIVE_AUTOSCALE = True
+        settings.DISPATCHER_WARM_WORKERS = 3
+        self.pool.init_workers(SlowResultWriter().work_loop, multiprocessing.Queue())
+        assert len(self.pool) == 2
+
+        # a single write forks every worker needed to keep 3 of them idle
+        self.pool.write(0, 'Hello, Worker')
+        assert len(self.pool) == 4
+        assert len([w for w in self.pool.workers if w.idle]) == 3
+
+    def test_predictive_scale_down(self, settings):
+        settings.DISPATCHER_PREDICTIVE_AUTOSCALE = True
+        settings.DISPATCHER_WARM_WORKERS = 1
+        settings.DISPATCHER_SCALE_DOWN_DELAY = 60
+        self.pool.init_workers(ResultWriter().work_loop, multiprocessing.Queue())
+        for i in range(8):
+            self.pool.up()
+        assert len(self.pool) == 10
+
+        # workers that haven't been idle for long enough are kept
+        self.pool.scale_down()
+        assert len(self.pool) == 10
+
+        for w in self.pool.workers:
+            w.idle_since -= 60
+        self.pool.scale_down()
+        assert len(self.pool) == 2
+
+
+class TestRoutedPool:
+
+    def setup_method(self, test_method):
+        self.pool = RoutedPool(
+            groups={'control': {'min_workers': 1, 'max_workers': 2}},
+            routes={
+                'awx.main.tasks.handle_work_*': 'control',
+                'awx.main.tasks.send_notifications': 'control',
+                'awx.main.tasks.gather_analytics': 'missing',
+            },
+            min_workers=2, max_workers=10
+        )
+
+    def teardown_method(self, test_method):
+        self.pool.stop(signal.SIGTERM)
+
+    def test_groups(self):
+        self.pool.init_workers(SimpleWorker().work_loop)
+        assert list(self.pool.pools.keys()) == ['default', 'control']
+        assert len(self.pool.pools['default']) == 2
+        assert len(self.pool.pools['control']) == 1
+        assert self.pool.pools['control'].max_workers == 2
+        assert len(self.pool) == 3
+
+    @pytest.mark.parametrize('task, group', [
+        ('awx.main.tasks.send_notifications', 'control'),
+        ('awx.main.tasks.handle_work_success', 'control'),
+        ('awx.main.tasks.RunJob', 'default'),
+        ('awx.main.tasks.gather_analytics', 'default'),  # no such group
+    ])
+    def test_route(self, task, group):
+        assert self.pool.route({'task': task}) is self.pool.pools[group]
+
+    def test_write(self):
+        self.pool.init_workers(SleepingWorker().work_loop)
+        for i in range(5):
+            self.pool.write(0, {'task': 'awx.main.tasks.RunJob'})
+        # control tasks aren't queued behind jobs
+        self.pool.write(0, {'task': 'awx.main.tasks.send_notifications'})
+        assert len(self.pool.pools['default']) == 5
+        assert len(self.pool.pools['control']) == 1
+        assert self.pool.pools['control'].workers[0].messages_sent == 1
+
+    def test_cleanup_reaps_once(self):
+        self.pool.init_workers(SimpleWorker().work_loop)
+        with mock.patch('awx.main.dispatch.reaper.reap') as reap:
+            self.pool.cleanup()
+        reap.assert_called_once()
+
+    def test_groups_split_the_max_workers(self, settings):
+        settings.SYSTEM_TASK_ABS_MEM = 2
+        pool = RoutedPool(groups={'control': {'min_workers': 1, 'max_workers': 4}}, routes={}, min_workers=2)
+        assert pool.pools['default'].max_workers == 6
+        assert pool.pools['control'].max_workers == 4
+
+    def test_groups_must_set_max_workers(self):
+        with pytest.raises(ImproperlyConfigured):
+            RoutedPool(groups={'control': {'min_workers': 1}}, routes={})
+
 
 @pytest.mark.usefixtures("disable_database_settings")
 class TestTaskDispatcher:
@@ -365,6 +517,255 @@ class TestTaskPublisher:
         message, queue = add.apply_async([2, 2], queue=lambda: 'called')
         assert queue == 'called'
 
+    def test_publish_many(self):
+        with mock.patch('awx.main.dispatch.publish.settings.IS_TESTING', return_value=False):
+            with mock.patch('awx.main.dispatch.publish.get_publisher') as get_publisher:
+                publish_many([
+                    add.build_message([2, 2], queue='foobar', uuid='1'),
+                    multiply.build_message([3, 3], uuid='2'),
+                ])
+        notifications = get_publisher.return_value.notify_many.call_args[0][0]
+        assert get_publisher.return_value.notify_many.call_count == 1
+        assert [queue for queue, payload in notifications] == ['foobar', 'hard-math']
+        assert json.loads(notifications[1][1]) == {
+            'uuid': '2', 'args': [3, 3], 'kwargs': {},
+            'task': 'awx.main.tests.functional.test_dispatch.multiply'
+        }
+
+
+class TestPublisher:
+
+    @pytest.fixture
+    def connect(self):
+        with mock.patch('awx.main.dispatch.publish.connect_pg_bus') as connect:
+            connect.side_effect = lambda: mock.Mock(**{'conn.closed': 0, 'queue_usage.return_value': 0.0})
+            yield connect
+
+    def test_connection_is_reused(self, connect):
+        publisher = Publisher()
+        publisher.notify('foo', '1')
+        publisher.notify_many([('foo', '2'), ('bar', '3')])
+        assert connect.call_count == 1
+        assert publisher.pubsub.notify_many.call_args_list == [
+            mock.call([('foo', '1')]),
+            mock.call([('foo', '2'), ('bar', '3')]),
+        ]
+        assert publisher.messages._value.get() == 3
+
+    def test_lost_connection_is_reopened(self, connect):
+        publisher = Publisher()
+        publisher.notify('foo', '1')
+        lost = publisher.pubsub
+        lost.notify_many.side_effect = psycopg2.OperationalError
+        publisher.notify('foo', '2')
+        assert lost.close.called
+        assert publisher.pubsub is not lost
+        publisher.pubsub.notify_many.assert_called_once_with([('foo', '2')])
+        assert publisher.connections._value.get() == 2
+        assert publisher.errors._value.get() == 1
+
+    def test_errors_are_raised_after_one_retry(self, connect):
+        connect.side_effect = lambda: mock.Mock(**{'conn.closed': 0, 'notify_many.side_effect': psycopg2.OperationalError})
+        publisher = Publisher()
+        with pytest.raises(psycopg2.OperationalError):
+            publisher.notify('foo', '1')
+        assert connect.call_count == 2
+        assert publisher.pubsub is None
+
+    def test_large_payloads_are_counted(self, connect, settings):
+        settings.DISPATCHER_NOTIFY_PAYLOAD_LIMIT = 10
+        publisher = Publisher()
+        with mock.patch('awx.main.dispatch.envelope.get_redis'):
+            publisher.notify_many([('foo', 'x' * 10), ('foo', 'x' * 11)])
+        assert publisher.spilled._value.get() == 1
+
+    def test_payloads_are_wrapped_once(self, connect):
+        publisher = Publisher()
+        publisher.notify('foo', '1')
+        publisher.pubsub.notify_many.side_effect = psycopg2.OperationalError
+        with mock.patch('awx.main.dispatch.publish.wrap_payload', side_effect=lambda channel, payload: 'wrapped ' + payload) as wrap:
+            publisher.notify_many([('foo', '2'), ('bar', '3')])
+        # the retry sends the same (e.g., spilled) payloads
+        assert wrap.call_count == 2
+        publisher.pubsub.notify_many.assert_called_once_with([('foo', 'wrapped 2'), ('bar', 'wrapped 3')])
+
+    def test_queue_usage_is_monitored(self, connect, settings):
+        settings.DISPATCHER_NOTIFY_QUEUE_WARNING = 0.5
+        publisher = Publisher()
+        connect.side_effect = lambda: mock.Mock(**{'conn.closed': 0, 'queue_usage.return_value': 0.75})
+        with mock.patch('awx.main.dispatch.publish.logger') as logger:
+            publisher.notify('foo', '1')
+            publisher.notify('foo', '2')
+        assert publisher.pubsub.queue_usage.call_count == 1
+        assert publisher.queue_usage._value.get() == 0.75
+        assert 'is 75% full' in logger.warning.call_args[0][0]
+
+    def test_forked_processes_get_their_own_publisher(self, connect):
+        with mock.patch('awx.main.dispatch.publish._publisher', None):
+            parent = get_publisher()
+            assert get_publisher() is parent
+            parent.pid = -1
+            child = get_publisher()
+            assert child is not parent
+            assert child.parent is parent
+
+
+class TestPubSub:
+
+    @pytest.fixture
+    def pubsub(self):
+        conn = mock.MagicMock(autocommit=True, closed=0)
+        with mock.patch('awx.main.dispatch.execute_values') as execute_values:
+            yield PubSub(conn), conn.cursor.return_value.__enter__.return_value, execute_values
+
+    def test_one_page_is_sent_as_is(self, pubsub):
+        pubsub, cursor, execute_values = pubsub
+        pubsub.notify_many([('foo', '1'), ('bar', '2')], page_size=2)
+        assert execute_values.call_args[0][2] == [('foo', '1'), ('bar', '2')]
+        assert not cursor.execute.called
+
+    def test_pages_are_sent_in_a_transaction(self, pubsub):
+        pubsub, cursor, execute_values = pubsub
+        pubsub.notify_many([('foo', '1'), ('bar', '2'), ('baz', '3')], page_size=2)
+        assert cursor.execute.call_args_list == [mock.call('BEGIN;'), mock.call('COMMIT;')]
+
+    def test_partially_sent_pages_are_rolled_back(self, pubsub):
+        pubsub, cursor, execute_values = pubsub
+        execute_values.side_effect = psycopg2.OperationalError
+        with pytest.raises(psycopg2.OperationalError):
+            pubsub.notify_many([('foo', '1'), ('bar', '2'), ('baz', '3')], page_size=2)
+        assert cursor.execute.call_args_list == [mock.call('BEGIN;'), mock.call('ROLLBACK;')]
+
+
+class TestEnvelope:
+
+    @pytest.fixture(autouse=True)
+    def redis(self, settings):
+        settings.DISPATCHER_NOTIFY_PAYLOAD_LIMIT = 100
+        settings.DISPATCHER_SPILL_TIMEOUT = 60
+        store = {}
+        conn = mock.Mock()
+        conn.set.side_effect = lambda key, value, ex: store.__setitem__(key, value.encode('utf-8'))
+        conn.get.side_effect = store.get
+        conn.delete.side_effect = store.pop
+        with mock.patch('awx.main.dispatch.envelope.get_redis', return_value=conn):
+            yield store
+
+    def test_small_payloads_are_sent_as_is(self, redis):
+        payload = json.dumps({'uuid': '1', 'args': [1]})
+        assert wrap_payload('foo', payload) == payload
+        assert unwrap_payload('foo', payload) == payload
+        assert redis == {}
+
+    def test_large_payloads_are_spilled(self, redis):
+        payload = json.dumps({'uuid': '1', 'args': ['x' * 100]})
+        wrapped = wrap_payload('foo', payload)
+        assert len(wrapped) < 100
+        assert list(redis) == [json.loads(wrapped)['spilled']]
+        assert unwrap_payload('foo', wrapped) == payload
+        # each message sent to a queue is read by only one dispatcher
+        assert redis == {}
+
+    def test_broadcast_payloads_are_kept(self, redis):
+        payload = json.dumps({'uuid': '1', 'args': ['x' * 100]})
+        wrapped = wrap_payload('tower_broadcast_all', payload)
+        assert unwrap_payload('tower_broadcast_all', wrapped) == payload
+        assert unwrap_payload('tower_broadcast_all', wrapped) == payload
+
+    def test_expired_payloads_are_dropped(self, redis):
+        wrapped = wrap_payload('foo', json.dumps({'args': ['x' * 100]}))
+        redis.clear()
+        assert unwrap_payload('foo', wrapped) is None
+
+
+class TestDurableQueues:
+
+    key = 'awx_dispatcher_stream:awx'
+
+    @pytest.fixture(autouse=True)
+    def durable(self, settings):
+        settings.DISPATCHER_DURABLE_QUEUES = True
+        settings.DISPATCHER_DURABLE_BATCH_SIZE = 2
+
+    @pytest.fixture
+    def redis(self):
+        conn = mock.Mock()
+        with mock.patch('awx.main.dispatch.durable.get_redis', return_value=conn):
+            yield conn
+
+    def entry(self, entry_id, **body):
+        return (entry_id.encode('utf-8'), {b'body': json.dumps(body).encode('utf-8')})
+
+    def test_broadcasts_are_not_durable(self):
+        assert is_durable('awx')
+        assert not is_durable('tower_broadcast_all')
+
+    def test_publisher_rings_a_doorbell(self, redis):
+        with mock.patch('awx.main.dispatch.publish.connect_pg_bus') as connect:
+            connect.return_value = mock.Mock(**{'conn.closed': 0, 'queue_usage.return_value': 0.0})
+            publisher = Publisher()
+            publisher.notify_many([
+                ('awx', '{"uuid": "1"}'),
+                ('awx', '{"uuid": "2"}'),
+                ('tower_broadcast_all', '{"uuid": "3"}'),
+            ])
+        assert redis.pipeline.return_value.xadd.call_args_list == [
+            mock.call(self.key, {'body': '{"uuid": "1"}'}, maxlen=10000, approximate=True),
+            mock.call(self.key, {'body': '{"uuid": "2"}'}, maxlen=10000, approximate=True),
+        ]
+        connect.return_value.notify_many.assert_called_once_with([
+            ('tower_broadcast_all', '{"uuid": "3"}'),
+            ('awx', DOORBELL),
+        ])
+        assert publisher.messages._value.get() == 3
+
+    def test_pending_messages_are_read_first(self, redis):
+        redis.xreadgroup.side_effect = [
+            [[self.key, [self.entry('1-0', uuid='a'), self.entry('2-0', uuid='b')]]],
+            [[self.key, [self.entry('3-0', uuid='c')]]],
+            [[self.key, []]],
+            [[self.key, [self.entry('4-0', uuid='d')]]],
+            [],
+        ]
+        queue = DurableQueue('awx', consumer='node1')
+        bodies = list(queue.read())
+        assert [body['uuid'] for body in bodies] == ['a', 'b', 'c', 'd']
+        assert bodies[0]['delivery'] == {'stream': self.key, 'id': '1-0'}
+        redis.xgroup_create.assert_called_once_with(self.key, 'dispatcher', id='0', mkstream=True)
+        assert [c[0][2] for c in redis.xreadgroup.call_args_list] == [
+            {self.key: '0'}, {self.key: b'2-0'}, {self.key: b'3-0'}, {self.key: '>'}, {self.key: '>'}
+        ]
+
+        # once recovered, only new messages are read
+        redis.xreadgroup.reset_mock()
+        redis.xreadgroup.side_effect = [[]]
+        assert list(queue.read()) == []
+        assert [c[0][2] for c in redis.xreadgroup.call_args_list] == [{self.key: '>'}]
+
+    def test_deleted_pending_messages_are_skipped(self, redis):
+        redis.xreadgroup.side_effect = [[[self.key, [(b'1-0', {})]]], [[self.key, []]], []]
+        assert list(DurableQueue('awx').read()) == []
+        redis.xack.assert_called_once_with(self.key, 'dispatcher', '1-0')
+
+    def test_messages_are_acknowledged_when_started(self, redis):
+        pipe = redis.pipeline.return_value
+        acknowledge({'uuid': 'a', 'delivery': {'stream': self.key, 'id': '1-0'}})
+        pipe.xack.assert_called_once_with(self.key, 'dispatcher', '1-0')
+        pipe.xdel.assert_called_once_with(self.key, '1-0')
+        # messages that were only notified have nothing to acknowledge
+        acknowledge({'uuid': 'b'})
+        assert pipe.execute.call_count == 1
+
+    def test_queued_uuids(self, redis):
+        redis.xrange.return_value = [self.entry('1-0', uuid='a'), self.entry('2-0', uuid='b')]
+        assert queued_uuids(['tower_broadcast_all', 'awx']) == ['a', 'b']
+        redis.xrange.assert_called_once_with(self.key)
+
+    def test_streams_of_removed_nodes_are_removed(self, redis):
+        remove_queue('tower_broadcast_all')
+        remove_queue('awx')
+        redis.delete.assert_called_once_with(self.key)
+
 
 yesterday = tz_now() - datetime.timedelta(days=1)
 
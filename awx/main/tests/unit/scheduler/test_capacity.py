@@ -0,0 +1,80 @@
+import pytest
+from unittest import mock
+
+from awx.main.scheduler.capacity import CapacitySnapshot
+
+
+def Inst(hostname, capacity=100, enabled=True):
+    return mock.Mock(hostname=hostname, capacity=capacity, enabled=enabled)
+
+
+def G(name, instances, id=None, controller_id=None):
+    group = mock.Mock(id=id, controller_id=controller_id)
+    group.name = name
+    group.instances.all.return_value = instances
+    return group
+
+
+def T(impact, execution_node=None):
+    return mock.Mock(task_impact=impact, execution_node=execution_node)
+
+
+class TestCapacitySnapshot(object):
+
+    @pytest.mark.parametrize('task,capacities,running,instance_fit_index,reason', [
+        (T(100), [100], [], 0, "Only one, pick it"),
+        (T(100), [100, 100], [], 0, "Two equally good fits, pick the first"),
+        (T(150), [100, 200], [T(100, 'i1')], None, "Neither has enough remaining capacity"),
+        (T(50), [100, 200], [T(100, 'i1')], 0, "Second instance has less remaining capacity"),
+        (T(50), [100, 0], [], 0, "Never pick an offline instance"),
+    ])
+    def test_fit_task_to_most_remaining_capacity_instance(self, task, capacities, running, instance_fit_index, reason):
+        instances = [Inst('i{}'.format(i), capacity) for i, capacity in enumerate(capacities)]
+        group = G('default', instances)
+        snapshot = CapacitySnapshot([group], running)
+
+        if instance_fit_index is None:
+            assert snapshot.fit_task_to_most_remaining_capacity_instance(task, group) is None, reason
+        else:
+            assert snapshot.fit_task_to_most_remaining_capacity_instance(task, group) == \
+                instances[instance_fit_index], reason
+
+    @pytest.mark.parametrize('capacities,running,instance_fit_index,reason', [
+        ([100], [], 0, "One idle instance, pick it"),
+        ([100], [T(1, 'i0')], None, "One un-idle instance, pick nothing"),
+        ([100, 200, 500, 700], [T(1, 'i2')], 3, "Pick the largest idle instance"),
+        ([100, 200, 10000, 700], [T(1, 'i2')], 3, "Pick the largest idle instance"),
+        ([0], [], None, "One idle but down instance, don't pick it"),
+    ])
+    def test_find_largest_idle_instance(self, capacities, running, instance_fit_index, reason):
+        instances = [Inst('i{}'.format(i), capacity) for i, capacity in enumerate(capacities)]
+        group = G('default', instances)
+        snapshot = CapacitySnapshot([group], running)
+
+        if instance_fit_index is None:
+            assert snapshot.find_largest_idle_instance(group) is None, reason
+        else:
+            assert snapshot.find_largest_idle_instance(group) == instances[instance_fit_index], reason
+
+    def test_consume_capacity_updates_shared_instances(self):
+        shared = Inst('shared', 100)
+        ig1 = G('ig1', [shared])
+        ig2 = G('ig2', [Inst('shared', 100)])
+        snapshot = CapacitySnapshot([ig1, ig2])
+
+        assert snapshot.fit_task_to_most_remaining_capacity_instance(T(60), ig2) == shared
+        snapshot.consume_capacity(T(60, 'shared'))
+        assert snapshot.remaining_capacity(shared) == 40
+        assert snapshot.fit_task_to_most_remaining_capacity_instance(T(60), ig1) is None
+        assert snapshot.fit_task_to_most_remaining_capacity_instance(T(60), ig2) is None
+        assert snapshot.find_largest_idle_instance(ig2) is None
+
+    def test_choose_controller_node(self):
+        controller = G('controller', [Inst('c1'), Inst('c2', capacity=0)], id=1)
+        isolated = G('isolated', [Inst('iso1')], id=2, controller_id=1)
+        snapshot = CapacitySnapshot([controller, isolated])
+
+        assert snapshot.choose_controller_node(isolated) == 'c1'
+        assert snapshot.choose_controller_node(isolated, online=False) in ('c1', 'c2')
+        with pytest.raises(IndexError):
+            snapshot.choose_controller_node(controller)
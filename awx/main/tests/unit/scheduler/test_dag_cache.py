@@ -0,0 +1,155 @@
+from unittest import mock
+
+import pytest
+import redis
+
+from awx.main.scheduler.dag_cache import WorkflowDAGCache, VERSIONS_KEY
+
+
+def WJ(pk):
+    return mock.Mock(id=pk)
+
+
+def Node(job_id=None, status=None):
+    node = mock.Mock(job_id=job_id)
+    node.job.status = status
+    return node
+
+
+class FakeDAG(object):
+
+    built = []
+
+    def __init__(self, workflow_job):
+        self.built.append(workflow_job.id)
+        self.nodes = [{'node_object': n} for n in workflow_job.nodes]
+
+
+@pytest.fixture
+def cache():
+    FakeDAG.built = []
+    with mock.patch('awx.main.scheduler.dag_cache.redis.Redis.from_url'):
+        with mock.patch('awx.main.scheduler.dag_cache.WorkflowDAG', FakeDAG):
+            with mock.patch('awx.main.scheduler.dag_cache.UnifiedJob') as UnifiedJob:
+                cache = WorkflowDAGCache()
+                # workflow versions recorded in redis
+                cache.remote = {}
+
+                def hincrby(key, pk):
+                    cache.remote[pk] = cache.remote.get(pk, 0) + 1
+                    return cache.remote[pk]
+                cache.redis.hmget.side_effect = lambda key, pks: [cache.remote.get(pk) for pk in pks]
+                cache.redis.hincrby.side_effect = hincrby
+                cache.statuses = UnifiedJob.objects.filter.return_value.values_list
+                cache.statuses.return_value = []
+                yield cache
+
+
+def test_graphs_are_built_once(cache):
+    wj = WJ(1)
+    wj.nodes = [Node()]
+    cache.sync([wj])
+    dag = cache.get_dag(wj)
+    cache.sync([wj])
+    assert cache.get_dag(wj) is dag
+    assert FakeDAG.built == [1]
+
+
+def test_finished_workflows_are_evicted(cache):
+    wj1, wj2 = WJ(1), WJ(2)
+    wj1.nodes = [Node(10, 'running')]
+    wj2.nodes = [Node(20, 'running')]
+    cache.sync([wj1, wj2])
+    cache.get_dag(wj1)
+    cache.get_dag(wj2)
+
+    cache.statuses.return_value = [(20, 'running')]
+    cache.sync([wj2])
+    assert list(cache.dags) == [2]
+    assert list(cache.job_nodes) == [20]
+    cache.redis.hdel.assert_called_once_with(VERSIONS_KEY, 1)
+
+
+def test_only_unfinished_jobs_are_refreshed(cache):
+    running, pending = Node(10, 'running'), Node(11, 'pending')
+    wj = WJ(1)
+    wj.nodes = [Node(9, 'successful'), running, pending, Node()]
+    cache.sync([wj])
+    cache.get_dag(wj)
+    assert set(cache.job_nodes) == {10, 11}
+
+    cache.statuses.return_value = [(10, 'failed'), (11, 'running')]
+    cache.sync([wj])
+    assert running.job.status == 'failed'
+    assert pending.job.status == 'running'
+    assert set(cache.job_nodes) == {11}
+
+
+def test_spawned_jobs_are_tracked(cache):
+    node = Node()
+    wj = WJ(1)
+    wj.nodes = [node]
+    cache.sync([wj])
+    cache.get_dag(wj)
+
+    node.job_id = 10
+    node.job.status = 'pending'
+    cache.add_job(wj, node)
+    cache.statuses.return_value = [(10, 'successful')]
+    cache.sync([wj])
+    assert node.job.status == 'successful'
+    assert FakeDAG.built == [1]
+
+
+def test_deleted_jobs_evict_their_workflow(cache):
+    wj = WJ(1)
+    wj.nodes = [Node(10, 'running')]
+    cache.sync([wj])
+    cache.get_dag(wj)
+
+    cache.sync([wj])
+    assert cache.dags == {}
+    assert cache.job_nodes == {}
+
+
+def test_changes_made_elsewhere_invalidate(cache):
+    wj1, wj2 = WJ(1), WJ(2)
+    wj1.nodes = [Node()]
+    wj2.nodes = [Node()]
+    cache.sync([wj1, wj2])
+    cache.get_dag(wj1)
+    cache.get_dag(wj2)
+
+    # another process spawned a job in the second workflow
+    cache.remote[2] = 1
+    cache.sync([wj1, wj2])
+    cache.get_dag(wj1)
+    cache.get_dag(wj2)
+    assert FakeDAG.built == [1, 2, 2]
+
+
+def test_own_changes_dont_invalidate(cache):
+    wj = WJ(1)
+    wj.nodes = [Node()]
+    for i in range(3):
+        cache.sync([wj])
+        cache.get_dag(wj)
+        cache.changed(wj)
+    assert cache.remote == {1: 3}
+    assert FakeDAG.built == [1]
+
+
+def test_redis_errors_invalidate(cache):
+    wj = WJ(1)
+    wj.nodes = [Node()]
+    hmget = cache.redis.hmget.side_effect
+    cache.redis.hmget.side_effect = [[None], redis.ConnectionError, [None]]
+    for i in range(3):
+        cache.sync([wj])
+        cache.get_dag(wj)
+    assert FakeDAG.built == [1, 1, 1]
+
+    cache.redis.hmget.side_effect = hmget
+    cache.redis.hincrby.side_effect = redis.ConnectionError
+    with pytest.raises(redis.ConnectionError):
+        cache.changed(wj)
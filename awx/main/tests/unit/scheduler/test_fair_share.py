@@ -0,0 +1,72 @@
+from unittest import mock
+
+import pytest
+
+from awx.main.scheduler.fair_share import FairShareQueue
+
+
+def IG(name):
+    group = mock.Mock()
+    group.name = name
+    return group
+
+
+def T(pk, org, group='default', template=None, status='pending'):
+    return mock.Mock(id=pk, created=pk, organization_id=org, unified_job_template_id=template,
+                     preferred_instance_groups=[IG(group)], instance_group=IG(group), status=status)
+
+
+def run(queue, start=lambda task: True):
+    order = []
+    for task in queue:
+        order.append(task.id)
+        if start(task):
+            task.status = 'waiting'
+    return order
+
+
+@pytest.fixture(autouse=True)
+def priorities(settings):
+    settings.TASK_MANAGER_TEMPLATE_PRIORITY = {}
+    return settings.TASK_MANAGER_TEMPLATE_PRIORITY
+
+
+def test_organizations_take_turns():
+    tasks = [T(1, 'a'), T(2, 'a'), T(3, 'a'), T(4, 'b'), T(5, 'b')]
+    assert run(FairShareQueue(tasks)) == [1, 4, 2, 5, 3]
+
+
+def test_running_tasks_count_against_their_organization():
+    usage = FairShareQueue.get_usage([T(10, 'a', status='running'), T(11, 'a', status='running')])
+    tasks = [T(1, 'a'), T(2, 'b'), T(3, 'b'), T(4, 'b')]
+    assert run(FairShareQueue(tasks, usage)) == [2, 3, 1, 4]
+
+
+def test_instance_groups_are_shared_separately():
+    tasks = [T(1, 'a', 'ig1'), T(2, 'a', 'ig1'), T(3, 'a', 'ig2'), T(4, 'b', 'ig1')]
+    assert run(FairShareQueue(tasks)) == [1, 3, 4, 2]
+
+
+def test_template_priority(priorities):
+    priorities[42] = 10
+    tasks = [T(1, 'a'), T(2, 'b'), T(3, 'b', template=42)]
+    assert run(FairShareQueue(tasks)) == [3, 1, 2]
+
+
+def test_tasks_that_do_not_start_do_not_count():
+    tasks = [T(1, 'a'), T(2, 'a'), T(3, 'b'), T(4, 'b')]
+    # a's tasks are blocked, so a still has the least running when 2 is considered
+    assert run(FairShareQueue(tasks), start=lambda task: task.organization_id == 'b') == [1, 2, 3, 4]
+
+
+def test_usage_is_shared_between_queues():
+    usage = FairShareQueue.get_usage([])
+    run(FairShareQueue([T(1, 'a')], usage))
+    assert run(FairShareQueue([T(2, 'a'), T(3, 'b')], usage)) == [3, 2]
+
+
+def test_each_task_is_yielded_once():
+    tasks = [T(i, i % 3) for i in range(30)]
+    queue = FairShareQueue(tasks)
+    assert len(queue) == 30
+    assert sorted(run(queue)) == list(range(30))
@@ -0,0 +1,92 @@
+import json
+from unittest import mock
+
+import pytest
+import redis
+from django.db import connection
+
+from awx.main.scheduler.profiler import CycleProfile, CYCLES_KEY
+
+
+def query():
+    # what a cursor does on every execute() while a phase is running
+    for wrapper in connection.execute_wrappers:
+        wrapper(mock.Mock(), 'SELECT 1', None, False, {})
+
+
+@pytest.fixture
+def conn():
+    with mock.patch('awx.main.scheduler.profiler.redis.Redis.from_url') as from_url:
+        with mock.patch('awx.main.analytics.subsystem_metrics.SubsystemMetrics.send'):
+            yield from_url.return_value
+
+
+def test_phases_count_queries():
+    profile = CycleProfile()
+    with profile.phase('get_tasks'):
+        query()
+        query()
+    with profile.phase('process_pending_tasks'):
+        query()
+    query()
+
+    assert list(profile.phases) == ['get_tasks', 'process_pending_tasks']
+    assert profile.phases['get_tasks']['queries'] == 2
+    assert profile.phases['process_pending_tasks']['queries'] == 1
+    assert profile.as_dict()['queries'] == 3
+    assert connection.execute_wrappers == []
+
+
+def test_repeated_phases_are_summed():
+    profile = CycleProfile()
+    with mock.patch('awx.main.scheduler.profiler.time.time', side_effect=[1, 3, 10, 14]):
+        with profile.phase('process_pending_tasks'):
+            query()
+        with profile.phase('process_pending_tasks'):
+            query()
+    assert profile.phases['process_pending_tasks'] == {'seconds': 6, 'queries': 2}
+
+
+def test_phase_is_recorded_on_error():
+    profile = CycleProfile()
+    with pytest.raises(ValueError):
+        with profile.phase('generate_dependencies'):
+            query()
+            raise ValueError()
+    assert profile.phases['generate_dependencies']['queries'] == 1
+    assert connection.execute_wrappers == []
+
+
+def test_finish_records_history(conn, settings):
+    settings.TASK_MANAGER_CYCLE_HISTORY = 10
+    profile = CycleProfile()
+    with profile.phase('get_tasks'):
+        query()
+    profile.count('started')
+    profile.count('blocked')
+    profile.count('started')
+    profile.finish()
+
+    pipe = conn.pipeline.return_value
+    key, data = pipe.lpush.call_args[0]
+    assert key == CYCLES_KEY
+    cycle = json.loads(data)
+    assert cycle['phases']['get_tasks']['queries'] == 1
+    assert cycle['tasks'] == {'blocked': 1, 'started': 2, 'skipped_capacity': 0}
+    pipe.ltrim.assert_called_once_with(CYCLES_KEY, 0, 9)
+
+
+def test_finish_tolerates_redis_errors(conn):
+    conn.pipeline.return_value.execute.side_effect = redis.ConnectionError
+    cycle = CycleProfile().finish()
+    assert cycle['queries'] == 0
+
+
+def test_metrics_outlive_the_interval_between_cycles(settings):
+    settings.TASK_MANAGER_METRICS_EXPIRE = 3600
+    settings.SUBSYSTEM_METRICS_INTERVAL = 5
+    with mock.patch('awx.main.scheduler.profiler.redis.Redis.from_url'):
+        with mock.patch('awx.main.analytics.subsystem_metrics.redis.Redis.from_url') as from_url:
+            with mock.patch('awx.main.scheduler.profiler._metrics', None):
+                CycleProfile().finish()
+    assert from_url.return_value.set.call_args[1]['ex'] == 3600
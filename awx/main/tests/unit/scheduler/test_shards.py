@@ -0,0 +1,125 @@
+import json
+from unittest import mock
+
+import pytest
+import redis
+
+from awx.main.scheduler.shards import CapacityLedger, get_shard, shard_order
+
+
+@pytest.fixture
+def ledgers(mock_redis):
+    with mock.patch('awx.main.scheduler.shards.redis.Redis.from_url', return_value=mock_redis):
+        yield [CapacityLedger(shard, shards=2) for shard in range(2)]
+
+
+def task(pk, task_impact):
+    return mock.Mock(id=pk, task_impact=task_impact)
+
+
+def try_to_start(ledger, reservations, started, task, capacity=100):
+    '''
+    Start `task` in the "tower" group unless that would exceed its capacity,
+    deciding again whenever the ledger hands back reservations, like
+    TaskManager.process_pending_task
+    '''
+    while True:
+        consumed = sum(r['task_impact'] for r in reservations.values()) + sum(t.task_impact for t in started)
+        if consumed + task.task_impact > capacity:
+            return False
+        unseen = ledger.reserve(task, 'tower', 'awx-1')
+        if unseen is None:
+            started.append(task)
+            return True
+        reservations.update(unseen)
+
+
+def test_tasks_are_sharded_by_template():
+    assert get_shard(mock.Mock(id=10, unified_job_template_id=7), 4) == 3
+    assert get_shard(mock.Mock(id=10, unified_job_template_id=None), 4) == 2
+
+
+@pytest.mark.parametrize('count', [1, 2, 5])
+def test_shard_order(settings, count):
+    settings.CLUSTER_HOST_ID = 'awx-1'
+    order = shard_order(count)
+    assert sorted(order) == list(range(count))
+    assert shard_order(count) == order
+
+
+def test_reserve(ledgers, mock_redis):
+    ledger = ledgers[1]
+    assert ledger.snapshot() == {}
+    assert ledger.reserve(task(42, 5), 'tower', 'awx-1') is None
+    entries = mock_redis.hgetall('awx_task_manager_ledger:1')
+    assert json.loads(entries[b'42']) == {'instance_group': 'tower', 'execution_node': 'awx-1', 'task_impact': 5}
+
+
+def test_snapshot_of_other_shards(ledgers):
+    ledgers[0].snapshot()
+    ledgers[0].reserve(task(42, 5), 'tower', 'awx-1')
+    assert ledgers[1].snapshot() == {42: {'instance_group': 'tower', 'execution_node': 'awx-1', 'task_impact': 5}}
+    # an unfinished cycle of a shard is discarded by its next one
+    assert ledgers[0].snapshot() == {}
+    assert ledgers[1].snapshot() == {}
+
+
+def test_interleaved_shards_share_capacity(ledgers):
+    reservations = [ledger.snapshot() for ledger in ledgers]
+    started = [[], []]
+    # both shards see 100 remaining in "tower"; shard 0 reserves first, and
+    # shard 1 is handed its reservation instead of over-committing
+    assert try_to_start(ledgers[0], reservations[0], started[0], task(1, 60))
+    assert not try_to_start(ledgers[1], reservations[1], started[1], task(2, 60))
+    assert reservations[1] == {1: {'instance_group': 'tower', 'execution_node': 'awx-1', 'task_impact': 60}}
+    assert try_to_start(ledgers[1], reservations[1], started[1], task(3, 30))
+    assert not try_to_start(ledgers[0], reservations[0], started[0], task(4, 20))
+    assert try_to_start(ledgers[0], reservations[0], started[0], task(5, 10))
+    assert sum(t.task_impact for t in started[0] + started[1]) == 100
+
+
+def test_committed_reservations_outlive_older_snapshots(ledgers):
+    ledgers[0].snapshot()
+    ledgers[1].snapshot()
+    ledgers[0].reserve(task(42, 5), 'tower', 'awx-1')
+    ledgers[0].release(committed=True)
+    # shard 1 loaded its tasks before 42 was committed, so still has to
+    # count it...
+    assert ledgers[1].reserve(task(43, 5), 'tower', 'awx-1') == {
+        42: {'instance_group': 'tower', 'execution_node': 'awx-1', 'task_impact': 5}
+    }
+    # ...but won't be handed it again, and later cycles find it in the
+    # database
+    assert ledgers[1].reserve(task(43, 5), 'tower', 'awx-1') is None
+    assert ledgers[1].snapshot() == {}
+
+
+def test_rolled_back_reservations_are_removed(ledgers, mock_redis):
+    ledgers[0].snapshot()
+    ledgers[0].reserve(task(42, 5), 'tower', 'awx-1')
+    ledgers[0].release(committed=False)
+    assert mock_redis.hgetall('awx_task_manager_ledger:0') == {}
+    assert ledgers[1].snapshot() == {}
+
+
+def test_reserve_retries_when_the_sequence_changes(ledgers, mock_redis):
+    ledgers[1].snapshot()
+    pipeline = type(mock_redis.pipeline())
+    execute, raced = pipeline.execute, []
+
+    def execute_after_another_reservation(pipe):
+        # another process reserves between WATCH and EXEC, once
+        if not raced:
+            raced.append(True)
+            mock_redis.incr('awx_task_manager_ledger_sequence')
+        return execute(pipe)
+
+    with mock.patch.object(pipeline, 'execute', execute_after_another_reservation):
+        assert ledgers[1].reserve(task(42, 5), 'tower', 'awx-1') is None
+    assert raced
+    assert b'42' in mock_redis.hgetall('awx_task_manager_ledger:1')
+
+
+def test_snapshot_without_redis(ledgers, mock_redis):
+    with mock.patch.object(mock_redis, 'pipeline', side_effect=redis.ConnectionError()):
+        assert ledgers[1].snapshot() == {}
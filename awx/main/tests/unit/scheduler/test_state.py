@@ -0,0 +1,99 @@
+import datetime
+from unittest import mock
+
+import pytest
+import redis
+
+from awx.main.scheduler.state import SchedulerState
+
+
+def T(pk, status='pending', dependent_jobs=()):
+    task = mock.Mock(id=pk, status=status, created=datetime.datetime(2020, 1, 1) + datetime.timedelta(seconds=pk))
+    task.dependent_jobs.all.return_value = list(dependent_jobs)
+    return task
+
+
+class FakeTaskManager(object):
+
+    def __init__(self, tasks):
+        self.tasks = tasks
+        self.calls = []
+
+    def get_tasks(self, pks=None):
+        self.calls.append(pks)
+        return [t for t in self.tasks if pks is None or t.id in pks]
+
+
+@pytest.fixture
+def state(settings):
+    settings.TASK_MANAGER_INCREMENTAL = True
+    settings.TASK_MANAGER_RECONCILE_INTERVAL = 300
+    with mock.patch('awx.main.scheduler.state.redis.Redis.from_url'):
+        yield SchedulerState()
+
+
+def test_first_cycle_reconciles(state):
+    tm = FakeTaskManager([T(2), T(1)])
+    assert [t.id for t in state.get_tasks(tm)] == [1, 2]
+    assert tm.calls == [None]
+    state.redis.zremrangebyscore.assert_called_once()
+
+
+def test_only_changed_tasks_are_reloaded(state):
+    tm = FakeTaskManager([T(1), T(2), T(3)])
+    state.get_tasks(tm)
+
+    # 2 finished, and 4 was created
+    tm.tasks = [T(1), T(3), T(4)]
+    state.redis.zrangebyscore.return_value = [b'2', b'4']
+    assert [t.id for t in state.get_tasks(tm)] == [1, 3, 4]
+    assert tm.calls[1] == {2, 4}
+
+
+def test_tasks_blocked_on_changed_tasks_are_reloaded(state):
+    update = T(1, status='running')
+    tm = FakeTaskManager([update, T(2, dependent_jobs=[update])])
+    state.get_tasks(tm)
+
+    tm.tasks = [T(2, dependent_jobs=[T(1, status='successful')])]
+    state.redis.zrangebyscore.return_value = [b'1']
+    assert [t.id for t in state.get_tasks(tm)] == [2]
+    assert tm.calls[1] == {1, 2}
+
+
+def test_tasks_that_finished_in_memory_are_dropped(state):
+    tasks = [T(1), T(2)]
+    tm = FakeTaskManager(tasks)
+    state.get_tasks(tm)
+
+    tasks[0].status = 'failed'
+    state.redis.zrangebyscore.return_value = []
+    assert [t.id for t in state.get_tasks(tm)] == [2]
+    assert tm.calls[1:] == []
+
+
+def test_redis_errors_reconcile(state):
+    tm = FakeTaskManager([T(1)])
+    state.get_tasks(tm)
+
+    state.redis.zrangebyscore.side_effect = redis.ConnectionError
+    state.get_tasks(tm)
+    assert tm.calls == [None, None]
+
+
+def test_reconcile_interval(state, settings):
+    tm = FakeTaskManager([T(1)])
+    state.get_tasks(tm)
+
+    settings.TASK_MANAGER_RECONCILE_INTERVAL = 0
+    state.reconciled -= 1
+    state.get_tasks(tm)
+    assert tm.calls == [None, None]
+
+
+def test_invalidate(state):
+    tm = FakeTaskManager([T(1)])
+    state.get_tasks(tm)
+    state.invalidate()
+    state.get_tasks(tm)
+    assert tm.calls == [None, None]
@@ -0,0 +1,102 @@
+import asyncio
+import json
+import time
+from unittest import mock
+
+import pytest
+
+from awx.main import consumers
+
+
+@pytest.fixture
+def consumer():
+    consumer = consumers.EventConsumer({})
+    consumer.frames = []
+
+    async def send(text):
+        consumer.frames.append(json.loads(text))
+
+    consumer.send = send
+    return consumer
+
+
+def batch(emitted=None):
+    events = [
+        {'group_name': 'job_events', 'job': 1, 'counter': 1, 'event': 'playbook_on_task_start', 'event_data': {'task': 'ping'}},
+        {'group_name': 'job_events', 'job': 1, 'counter': 2, 'event': 'runner_on_ok', 'event_data': {'res': {'ping': 'pong'}}},
+    ]
+    return {
+        'type': 'internal.batch',
+        'group_name': 'job_events',
+        'emitted': emitted or time.time(),
+        'messages': [
+            [json.dumps(events[0]), None],
+            [json.dumps(events[1]), json.dumps(consumers._summarize_payload(events[1]))],
+        ],
+    }
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_batch_as_individual_frames(consumer):
+    run(consumer.internal_batch(batch()))
+    assert [frame['counter'] for frame in consumer.frames] == [1, 2]
+    assert consumer.frames[1]['event_data'] == {'res': {'ping': 'pong'}}
+
+
+def test_batch_as_single_frame(consumer):
+    consumer.batch_events = True
+    run(consumer.internal_batch(batch()))
+    assert len(consumer.frames) == 1
+    frame = consumer.frames[0]
+    assert frame['type'] == 'event_batch'
+    assert frame['group_name'] == 'job_events'
+    assert [event['counter'] for event in frame['events']] == [1, 2]
+
+
+def test_batch_summarized_for_slow_clients(consumer, settings):
+    settings.UI_LIVE_UPDATES_MAX_LAG = 2
+    run(consumer.internal_batch(batch(emitted=time.time() - 5)))
+    assert [frame['counter'] for frame in consumer.frames] == [1, 2]
+    assert consumer.frames[0]['event_data'] == {'task': 'ping'}
+    assert consumer.frames[1]['event_data'] == {'res': {}}
+
+
+def test_chunk_messages():
+    messages = [['a' * 4, None], ['b' * 3, 'c'], ['d' * 10, None], ['e', None]]
+    assert list(consumers._chunk_messages(messages, 8)) == [
+        [['a' * 4, None], ['b' * 3, 'c']],
+        # larger than the limit on its own
+        [['d' * 10, None]],
+        [['e', None]],
+    ]
+
+
+def test_emit_batch_in_chunks(settings):
+    settings.BROADCAST_WEBSOCKET_BATCH_SIZE = 200
+    payloads = [
+        {'group_name': 'job_events', 'job': 1, 'counter': i, 'event': 'verbose', 'stdout': 'x' * 50}
+        for i in range(10)
+    ]
+    sent = []
+
+    async def group_send(group, message):
+        sent.append((group, message))
+
+    with mock.patch('awx.main.consumers.get_channel_layer') as get_channel_layer:
+        get_channel_layer.return_value.group_send = group_send
+        consumers.emit_channel_notification_batch('job_events-1', payloads)
+
+    local = [message for group, message in sent if group == 'job_events-1']
+    relayed = [message for group, message in sent if group == settings.BROADCAST_WEBSOCKET_GROUP_NAME]
+    assert len(local) == len(relayed) > 1
+    counters = [json.loads(text)['counter'] for batch in local for text, _ in batch['messages']]
+    assert counters == list(range(10))
+    for batch in local:
+        assert sum(len(text) for text, _ in batch['messages']) <= 200
@@ -159,3 +159,19 @@ def test_large_string_performance():
     redacted = UriCleaner.remove_sensitive('x' * length)
     assert len(redacted) == length
 
+
+def test_uri_scm_redact_data():
+    uri = URI(scheme="https", username="myusername", password="mypassword", host="nonexistant.ansible.com/ansible.git/")
+    data = {
+        'event': 'runner_on_failed',
+        'counter': 5,
+        'event_data': {
+            'res': {'msg': 'Failed to clone {}'.format(uri), 'cmd': ['git', 'clone', str(uri)], 'rc': 128},
+        },
+    }
+    redacted = UriCleaner.remove_sensitive_from_data(data)
+    assert uri.username not in str(redacted)
+    assert uri.password not in str(redacted)
+    assert redacted['counter'] == 5
+    assert redacted['event_data']['res']['rc'] == 128
+    assert redacted['event_data']['res']['cmd'][:2] == ['git', 'clone']
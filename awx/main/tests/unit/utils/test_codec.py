@@ -0,0 +1,58 @@
+import datetime
+import json
+
+import pytest
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.timezone import utc
+
+from awx.main.queue import AnsibleJSONEncoder
+from awx.main.utils import codec
+
+
+class Vault(object):
+    yaml_tag = '!vault'
+    data = '$ANSIBLE_VAULT;1.1;AES256'
+
+
+@pytest.fixture(params=sorted(codec.CODECS))
+def json_codec(request):
+    return codec.CODECS[request.param]
+
+
+def test_auto_codec(settings):
+    settings.EVENT_JSON_CODEC = 'auto'
+    assert codec.get_codec() is codec.CODECS.get('orjson', codec.CODECS['json'])
+
+
+def test_unavailable_codec():
+    assert codec.get_codec('not-a-codec') is codec.CODECS['json']
+
+
+def test_round_trip(json_codec):
+    event = {
+        'event': 'runner_on_ok',
+        'counter': 1,
+        'event_data': {'res': {'changed': False, 'msg': 'café', 'items': [1, 2.5, None, True]}},
+    }
+    assert json_codec.loads(json_codec.dumps(event)) == event
+
+
+def test_encoder_default(json_codec):
+    payload = {'vault': Vault(), 'big': 2 ** 70, 1: 'int key'}
+    assert json.loads(json_codec.dumps(payload, cls=AnsibleJSONEncoder)) == {
+        'vault': Vault.data, 'big': 2 ** 70, '1': 'int key'
+    }
+
+
+def test_datetimes_match_encoder(json_codec):
+    # websocket clients should see the same timestamps, regardless of codec
+    payload = {'created': datetime.datetime(2020, 1, 1, 12, 30, 15, 123456, tzinfo=utc)}
+    assert json.loads(json_codec.dumps(payload, cls=DjangoJSONEncoder)) == json.loads(
+        json.dumps(payload, cls=DjangoJSONEncoder)
+    )
+
+
+def test_decode_error(json_codec):
+    with pytest.raises(json.JSONDecodeError):
+        json_codec.loads('not-json')
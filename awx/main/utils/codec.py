@@ -0,0 +1,96 @@
+# Copyright (c) 2020 Ansible, Inc.
+# All Rights Reserved.
+
+# Python
+import functools
+import json
+import logging
+
+# Django
+from django.conf import settings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+__all__ = ['dumps', 'loads', 'get_codec', 'CODECS']
+
+logger = logging.getLogger('awx.main.utils.codec')
+
+
+class JSONCodec(object):
+    '''
+    Encodes and decodes using the standard library's json module.
+    '''
+
+    name = 'json'
+
+    def dumps(self, obj, cls=None):
+        return json.dumps(obj, cls=cls)
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class ORJSONCodec(JSONCodec):
+    '''
+    Encodes and decodes using orjson (https://github.com/ijl/orjson), which
+    is several times faster than the standard library for the large, deeply
+    nested payloads that job events tend to have.
+
+    When a json.JSONEncoder subclass is specified, its default() is used to
+    serialize objects orjson doesn't support; datetimes are passed through to
+    it as well, so that they're formatted exactly as the encoder would format
+    them.  Payloads that orjson can't encode at all (e.g., integers larger
+    than 64 bits) fall back to the standard library.
+    '''
+
+    name = 'orjson'
+
+    def dumps(self, obj, cls=None):
+        option = orjson.OPT_NON_STR_KEYS
+        default = None
+        if cls is not None:
+            option |= orjson.OPT_PASSTHROUGH_DATETIME
+            default = cls().default
+        try:
+            return orjson.dumps(obj, default=default, option=option).decode('utf-8')
+        except orjson.JSONEncodeError:
+            return super(ORJSONCodec, self).dumps(obj, cls=cls)
+
+    def loads(self, data):
+        # orjson.JSONDecodeError is a subclass of json.JSONDecodeError
+        return orjson.loads(data)
+
+
+CODECS = {'json': JSONCodec()}
+if orjson is not None:
+    CODECS['orjson'] = ORJSONCodec()
+
+
+@functools.lru_cache()
+def _lookup(name):
+    if name == 'auto':
+        return CODECS.get('orjson', CODECS['json'])
+    if name not in CODECS:
+        logger.warning('JSON codec {} is not available, falling back to json'.format(name))
+        return CODECS['json']
+    return CODECS[name]
+
+
+def get_codec(name=None):
+    '''
+    Return the codec named by `name` (or settings.EVENT_JSON_CODEC); `auto`
+    selects the fastest codec that is installed.
+    '''
+    return _lookup(name or getattr(settings, 'EVENT_JSON_CODEC', 'auto'))
+
+
+def dumps(obj, cls=None):
+    return get_codec().dumps(obj, cls=cls)
+
+
+def loads(data):
+    return get_codec().loads(data)
@@ -1,6 +1,7 @@
 import json
 import logging
 import asyncio
+import time
 
 import aiohttp
 from aiohttp import client_exceptions
@@ -11,6 +12,8 @@ from django.conf import settings
 from django.apps import apps
 from django.core.serializers.json import DjangoJSONEncoder
 
+from awx.main.utils import codec
+
 from awx.main.analytics.broadcast_websocket import (
     BroadcastWebsocketStats,
     BroadcastWebsocketStatsManager,
@@ -20,10 +23,12 @@ from awx.main.analytics.broadcast_websocket import (
 logger = logging.getLogger('awx.main.wsbroadcast')
 
 
-def wrap_broadcast_msg(group, message: str):
+def wrap_broadcast_msg(group, message):
     # TODO: Maybe wrap as "group","message" so that we don't need to
     # encode/decode as json.
-    return json.dumps(dict(group=group, message=message), cls=DjangoJSONEncoder)
+    # `message` is either the text of a single message, or a batch of
+    # messages (see awx.main.consumers.emit_channel_notification_batch)
+    return codec.dumps(dict(group=group, message=message), cls=DjangoJSONEncoder)
 
 
 def unwrap_broadcast_msg(payload: dict):
@@ -93,7 +98,8 @@ class WebsocketTask():
         try:
             async with aiohttp.ClientSession(headers={'secret': secret_val},
                                              timeout=timeout) as session:
-                async with session.ws_connect(uri, ssl=self.verify_ssl, heartbeat=20) as websocket:
+                async with session.ws_connect(uri, ssl=self.verify_ssl, heartbeat=20,
+                                              max_msg_size=settings.BROADCAST_WEBSOCKET_MAX_MESSAGE_SIZE) as websocket:
                     logger.info(f"Connection from {self.name} to {self.remote_host} established.")
                     self.stats.record_connection_established()
                     attempt = 0
@@ -133,7 +139,7 @@ class BroadcastWebsocketTask(WebsocketTask):
                 break
             elif msg.type == aiohttp.WSMsgType.TEXT:
                 try:
-                    payload = json.loads(msg.data)
+                    payload = codec.loads(msg.data)
                 except json.JSONDecodeError:
                     logmsg = "Failed to decode broadcast message"
                     if logger.isEnabledFor(logging.DEBUG):
@@ -143,7 +149,13 @@ class BroadcastWebsocketTask(WebsocketTask):
 
                 (group, message) = unwrap_broadcast_msg(payload)
 
-                await self.channel_layer.group_send(group, {"type": "internal.message", "text": message})
+                if isinstance(message, dict):
+                    # measure how far behind clients are from when the batch
+                    # reached this node, rather than comparing this node's
+                    # clock with the one of the node that emitted it
+                    await self.channel_layer.group_send(group, dict(message, type="internal.batch", emitted=time.time()))
+                else:
+                    await self.channel_layer.group_send(group, {"type": "internal.message", "text": message})
 
 
 class BroadcastWebsocketManager(object):
@@ -174,6 +174,21 @@ CUSTOM_VENV_PATHS = []
 # Note: This setting may be overridden by database settings.
 STDOUT_MAX_BYTES_DISPLAY = 1048576
 
+# The callback receiver stores the stdout of each job in compressed chunks of
+# this many lines, so that stdout can be read (and ranges of it served)
+# without reading every event of the job; set to 0 to disable
+STDOUT_CHUNK_LINES = 1000
+
+# Once a job has finished and all of its events are saved, the chunks of its
+# stdout are compacted (and from then on, stdout is served from them); if a
+# job's events still haven't all been saved this many seconds after it
+# finished, its chunks are discarded, and stdout is served from its events
+STDOUT_CHUNK_COMPACT_TIMEOUT = 60 * 60
+
+# Stdout downloads are streamed from the database, reading this many events
+# at a time
+STDOUT_STREAM_BATCH_SIZE = 2000
+
 # Returned in the header on event api lists as a recommendation to the UI
 # on how many events to display before truncating/hiding
 MAX_UI_JOB_EVENTS = 4000
@@ -182,6 +197,11 @@ MAX_UI_JOB_EVENTS = 4000
 # to update job data in response to status changes websocket events
 UI_LIVE_UPDATES_ENABLED = True
 
+# When a websocket client falls more than this many seconds behind a job's
+# event stream, runner_on_ok events are sent to it without their module result
+# (event_data.res) until it catches up
+UI_LIVE_UPDATES_MAX_LAG = 2
+
 # The maximum size of the ansible callback event's res data structure
 # beyond this limit and the value will be removed
 MAX_EVENT_RES_DATA = 700000
@@ -189,8 +209,8 @@ MAX_EVENT_RES_DATA = 700000
 # Note: This setting may be overridden by database settings.
 EVENT_STDOUT_MAX_BYTES_DISPLAY = 1024
 
-# The amount of time before a stdout file is expired and removed locally
-# Note that this can be recreated if the stdout is downloaded
+# The amount of time before a stdout file spooled by an earlier version is
+# expired and removed locally
 LOCAL_STDOUT_EXPIRE_TIME = 2592000
 
 # The number of processes spawned by the callback receiver to process job
@@ -201,6 +221,27 @@ JOB_EVENT_WORKERS = 4
 # writes in memory before flushing via JobEvent.objects.bulk_create()
 JOB_EVENT_BUFFER_SECONDS = 1
 
+# The maximum number of events (of each type) the callback receiver buffers in
+# memory before writing them to the database
+JOB_EVENT_BUFFER_SIZE = 1000
+
+# The JSON codec used to serialize job events on their way from the dispatcher
+# to the callback receiver and out to websocket clients; 'json' uses the
+# standard library, 'orjson' requires the orjson package, and 'auto' uses
+# orjson when it is installed
+EVENT_JSON_CODEC = 'auto'
+
+# The maximum number of messages each callback receiver worker reads from
+# redis per round trip
+JOB_EVENT_READ_BATCH_SIZE = 100
+
+# Per-event-type overrides for callback receiver buffering, keyed by event
+# model name; e.g., {'ProjectUpdateEvent': {'size': 100, 'max_age': 0.25}}
+# flushes project update events when 100 are buffered, or when the oldest has
+# been buffered for 250ms (a max_age of less than a second requires redis 6
+# or later, which accepts fractional BLPOP timeouts)
+JOB_EVENT_BUFFER_POLICY = {}
+
 # The interval at which callback receiver statistics should be
 # recorded
 JOB_EVENT_STATISTICS_INTERVAL = 5
@@ -208,12 +249,118 @@ JOB_EVENT_STATISTICS_INTERVAL = 5
 # The maximum size of the job event worker queue before requests are blocked
 JOB_EVENT_MAX_QUEUE_SIZE = 10000
 
+# The number of processes spawned by the callback receiver to finalize jobs
+# (host summaries, inventory computed fields, notifications) once their
+# playbook_on_stats event has been saved
+JOB_FINALIZE_WORKERS = 2
+
+# The maximum number of queued job finalizations handled by a finalize
+# worker per batch
+JOB_FINALIZE_BATCH_SIZE = 50
+
+# Jobs whose finalization hasn't finished this many seconds after a finalize
+# worker started it (e.g., because the worker died) are finalized again
+JOB_FINALIZE_TIMEOUT = 60 * 10
+
+# How the callback receiver writes job events to the database; 'bulk_create'
+# uses multi-row INSERT statements, and 'copy' streams events using
+# PostgreSQL's COPY
+JOB_EVENT_INGEST_ENGINE = 'bulk_create'
+
+# The interval (in seconds) at which long-running services (the callback
+# receiver, the dispatcher) record their metrics for /api/v2/metrics/
+SUBSYSTEM_METRICS_INTERVAL = 5
+
+# Dispatcher messages larger than this (in bytes) are stored in redis for up
+# to DISPATCHER_SPILL_TIMEOUT seconds, and only a reference to them is sent
+# with pg_notify (which allows at most 8000 bytes)
+DISPATCHER_NOTIFY_PAYLOAD_LIMIT = 7000
+DISPATCHER_SPILL_TIMEOUT = 60 * 60
+
+# Warn when at least this fraction of the database's notification queue is
+# filled by dispatcher messages that haven't been read yet
+DISPATCHER_NOTIFY_QUEUE_WARNING = 0.5
+
+# Keep the messages published to each node's dispatcher in a redis stream
+# until a worker starts them, rather than only notifying them, so that they
+# aren't lost while the dispatcher restarts; the dispatcher reads up to
+# DISPATCHER_DURABLE_BATCH_SIZE of them at a time
+DISPATCHER_DURABLE_QUEUES = False
+DISPATCHER_DURABLE_BATCH_SIZE = 100
+# Each stream is trimmed to (approximately) this many of its most recent
+# messages, so that the stream of a node that has stopped reading it doesn't
+# grow without bound
+DISPATCHER_DURABLE_MAXLEN = 10000
+
+# Fork dispatcher workers ahead of demand, rather than one at a time once
+# every worker is busy: keep DISPATCHER_WARM_WORKERS idle workers beyond
+# what the messages of the last DISPATCHER_AUTOSCALE_WINDOW seconds call for,
+# fork another for each message that waits longer than
+# DISPATCHER_MAX_QUEUE_WAIT seconds for a worker, and only stop workers that
+# have been idle for DISPATCHER_SCALE_DOWN_DELAY seconds
+DISPATCHER_PREDICTIVE_AUTOSCALE = False
+DISPATCHER_WARM_WORKERS = 4
+DISPATCHER_AUTOSCALE_WINDOW = 30
+DISPATCHER_MAX_QUEUE_WAIT = 1
+DISPATCHER_SCALE_DOWN_DELAY = 120
+
+# Named groups of dispatcher workers, each scaled separately between its own
+# min_workers and (required) max_workers, e.g.,
+# {'control': {'min_workers': 2, 'max_workers': 8}}; the default group gets
+# the rest of the node's maximum number of workers.  Each message is run by
+# the group that its task is routed to by DISPATCHER_TASK_ROUTES (which maps
+# task names, or fnmatch patterns of them, to groups), or by the default
+# group if its task isn't routed to a group that exists
+DISPATCHER_WORKER_GROUPS = {}
+DISPATCHER_TASK_ROUTES = {
+    'awx.main.scheduler.tasks.run_task_manager': 'control',
+    'awx.main.tasks.cluster_node_heartbeat': 'control',
+    'awx.main.tasks.awx_periodic_scheduler': 'control',
+    'awx.main.tasks.handle_work_success': 'control',
+    'awx.main.tasks.handle_work_error': 'control',
+    'awx.main.tasks.handle_success_and_failure_notifications': 'control',
+    'awx.main.tasks.send_notifications': 'control',
+    'awx.main.tasks.handle_setting_changes': 'control',
+}
+
 # The number of job events to migrate per-transaction when moving from int -> bigint
 JOB_EVENT_MIGRATION_CHUNK_SIZE = 1000000
 
 # The maximum allowed jobs to start on a given task manager cycle
 START_TASK_LIMIT = 100
 
+# In incremental mode, the task manager keeps the set of pending, waiting, and
+# running tasks between cycles and only reloads the tasks whose state changed;
+# every TASK_MANAGER_RECONCILE_INTERVAL seconds it reloads all of them
+TASK_MANAGER_INCREMENTAL = False
+TASK_MANAGER_RECONCILE_INTERVAL = 300
+
+# The number of task manager cycles (and the time and queries spent in each
+# of their phases) to keep for /api/v2/task_manager/cycles/
+TASK_MANAGER_CYCLE_HISTORY = 100
+
+# Task manager metrics are reported by each dispatcher worker that runs a
+# cycle, and only sent when it does; keep them this long after the last one,
+# which should be well beyond the interval between cycles times the number of
+# dispatcher workers, or a worker's series will disappear (and reappear, with
+# its counters reset) between the cycles it happens to run
+TASK_MANAGER_METRICS_EXPIRE = 60 * 60
+
+# By default, pending tasks are started in the order they were created.  In
+# fair share mode, each organization's tasks are queued separately for each
+# instance group, and the next task started is always taken from the
+# organization running the fewest tasks there; TASK_MANAGER_TEMPLATE_PRIORITY
+# maps the ids of (unified job) templates whose jobs should be started ahead of
+# others to their priority (higher first, default 0)
+TASK_MANAGER_FAIR_SHARE = False
+TASK_MANAGER_TEMPLATE_PRIORITY = {}
+
+# By default, one task manager schedules every pending task in the cluster at
+# a time.  With TASK_MANAGER_SHARDS > 1, pending tasks are split into shards
+# (by template), each scheduled under its own lock, so that several nodes can
+# schedule at once (TASK_MANAGER_INCREMENTAL has no effect when sharded)
+TASK_MANAGER_SHARDS = 1
+
 # Disallow sending session cookies over insecure connections
 SESSION_COOKIE_SECURE = True
 
@@ -441,6 +588,15 @@ CELERYBEAT_SCHEDULE = {
         'schedule': timedelta(seconds=20),
         'options': {'expires': 20}
     },
+    'stdout_chunk_compaction': {
+        'task': 'awx.main.tasks.compact_stdout_chunks',
+        'schedule': timedelta(seconds=60),
+        'options': {'expires': 50,}
+    },
+    'purge_stdout_files': {
+        'task': 'awx.main.tasks.purge_old_stdout_files',
+        'schedule': timedelta(days=1),
+    },
     'k8s_reaper': {
         'task': 'awx.main.tasks.awx_k8s_reaper',
         'schedule': timedelta(seconds=60),
@@ -1107,3 +1263,11 @@ BROADCAST_WEBSOCKET_NEW_INSTANCE_POLL_RATE_SECONDS = 10
 
 # How often websocket process will generate stats
 BROADCAST_WEBSOCKET_STATS_POLL_RATE_SECONDS = 5
+
+# Batches of job events are split into messages of at most this many
+# characters of (serialized) events before they're sent to other nodes, each
+# of which accepts messages of up to BROADCAST_WEBSOCKET_MAX_MESSAGE_SIZE
+# bytes; the limit leaves room for the events to be escaped as JSON strings,
+# and for single events larger than the batch size
+BROADCAST_WEBSOCKET_BATCH_SIZE = 1024 * 1024
+BROADCAST_WEBSOCKET_MAX_MESSAGE_SIZE = 8 * 1024 * 1024
@@ -10,6 +10,80 @@ export default
         var needsResubscribing = false,
         socketPromise = $q.defer(),
         needsRefreshAfterBlur;
+
+        function routeMessage(data) {
+            // Route each message to the appropriate controller for the
+            // current $state.
+            var str = "";
+            if (data.group_name === 'jobs' &&
+                'type' in data &&
+                 data.type === 'workflow_approval'
+            ) {
+                $rootScope.$broadcast('ws-approval');
+            }
+
+            if (
+                !window.liveUpdates &&
+                data.group_name !== "control" &&
+                $state.current.name !== "output" &&
+                !$state.current.name.includes('settings')
+            ) {
+                $log.debug('Message from server dropped: ' + JSON.stringify(data));
+                needsRefreshAfterBlur = true;
+                return;
+            }
+
+            if(data.group_name==="jobs" && !('status' in data)){
+                // we know that this must have been a
+                // summary complete message b/c status is missing.
+                // A an object w/ group_name === "jobs" AND a 'status' key
+                // means it was for the event: status_changed.
+                $log.debug('Job summary_complete ' + data.unified_job_id);
+                $rootScope.$broadcast('ws-jobs-summary', data);
+                return;
+            }
+            else if(data.group_name==="job_events"){
+                // The naming scheme is "ws" then a
+                // dash (-) and the group_name, then the job ID
+                // ex: 'ws-jobs-<jobId>'
+                str = `ws-${data.group_name}-${data.job}`;
+            }
+            else if(data.group_name==="project_update_events"){
+                str = `ws-${data.group_name}-${data.project_update}`;
+            }
+            else if(data.group_name==="ad_hoc_command_events"){
+                str = `ws-${data.group_name}-${data.ad_hoc_command}`;
+            }
+            else if(data.group_name==="system_job_events"){
+                str = `ws-${data.group_name}-${data.system_job}`;
+            }
+            else if(data.group_name==="inventory_update_events"){
+                str = `ws-${data.group_name}-${data.inventory_update}`;
+            }
+            else if(data.group_name === "control" && data.reason === "limit_reached"){
+                // If we got a `limit_reached_<user_pk>` message, determine
+                // if the current session is still valid (it may have been
+                // invalidated)
+                // If so, log the user out and show a meaningful error
+                $log.debug(data.reason);
+                let url = GetBasePath('me'); 
+                Rest.get(url)
+                .catch(function(resp) {
+                    if (resp.status === 401) {
+                        $rootScope.sessionTimer.expireSession('session_limit');
+                        $state.go('signOut');
+                    }
+                });
+            }
+            else {
+                // The naming scheme is "ws" then a
+                // dash (-) and the group_name.
+                // ex: 'ws-jobs'
+                str = `ws-${data.group_name}`;
+            }
+            $rootScope.$broadcast(str, data);
+        }
+
         return {
             init: function() {
                 var self = this,
@@ -95,75 +169,14 @@ export default
                 // the appropriate controller for the current $state.
                 $log.debug('Received From Server: ' + e.data);
 
-                var data = JSON.parse(e.data), str = "";
-
-                if (data.group_name === 'jobs' &&
-                    'type' in data &&
-                     data.type === 'workflow_approval'
-                ) {
-                    $rootScope.$broadcast('ws-approval');
-                }
-
-                if (
-                    !window.liveUpdates &&
-                    data.group_name !== "control" &&
-                    $state.current.name !== "output" &&
-                    !$state.current.name.includes('settings')
-                ) {
-                    $log.debug('Message from server dropped: ' + e.data);
-                    needsRefreshAfterBlur = true;
-                    return;
-                }
+                var data = JSON.parse(e.data);
 
-                if(data.group_name==="jobs" && !('status' in data)){
-                    // we know that this must have been a
-                    // summary complete message b/c status is missing.
-                    // A an object w/ group_name === "jobs" AND a 'status' key
-                    // means it was for the event: status_changed.
-                    $log.debug('Job summary_complete ' + data.unified_job_id);
-                    $rootScope.$broadcast('ws-jobs-summary', data);
-                    return;
-                }
-                else if(data.group_name==="job_events"){
-                    // The naming scheme is "ws" then a
-                    // dash (-) and the group_name, then the job ID
-                    // ex: 'ws-jobs-<jobId>'
-                    str = `ws-${data.group_name}-${data.job}`;
-                }
-                else if(data.group_name==="project_update_events"){
-                    str = `ws-${data.group_name}-${data.project_update}`;
-                }
-                else if(data.group_name==="ad_hoc_command_events"){
-                    str = `ws-${data.group_name}-${data.ad_hoc_command}`;
-                }
-                else if(data.group_name==="system_job_events"){
-                    str = `ws-${data.group_name}-${data.system_job}`;
-                }
-                else if(data.group_name==="inventory_update_events"){
-                    str = `ws-${data.group_name}-${data.inventory_update}`;
-                }
-                else if(data.group_name === "control" && data.reason === "limit_reached"){
-                    // If we got a `limit_reached_<user_pk>` message, determine
-                    // if the current session is still valid (it may have been
-                    // invalidated)
-                    // If so, log the user out and show a meaningful error
-                    $log.debug(data.reason);
-                    let url = GetBasePath('me'); 
-                    Rest.get(url)
-                    .catch(function(resp) {
-                        if (resp.status === 401) {
-                            $rootScope.sessionTimer.expireSession('session_limit');
-                            $state.go('signOut');
-                        }
-                    });
-                }
-                else {
-                    // The naming scheme is "ws" then a
-                    // dash (-) and the group_name.
-                    // ex: 'ws-jobs'
-                    str = `ws-${data.group_name}`;
+                if (data.type === 'event_batch') {
+                    // several job events, emitted together
+                    data.events.forEach(routeMessage);
+                } else {
+                    routeMessage(data);
                 }
-                $rootScope.$broadcast(str, data);
             },
             disconnect: function(){
                 if(this.socket){
@@ -179,6 +192,7 @@ export default
                 // This is used by all socket-enabled $states
                 state.data.socket.groups.control = ['limit_reached_' + $rootScope.current_user.id];
                 state.data.socket.xrftoken = $cookies.get('csrftoken');
+                state.data.socket.batch_events = true;
                 this.emit(JSON.stringify(state.data.socket));
                 this.setLast(state);
             },
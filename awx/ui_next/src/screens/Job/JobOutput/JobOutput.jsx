@@ -78,12 +78,18 @@ function connectJobSocket({ type, id }, onMessage) {
       JSON.stringify({
         xrftoken,
         groups: { jobs: ['summary', 'status_changed'], [eventGroup]: [id] },
+        batch_events: true,
       })
     );
   };
 
   ws.onmessage = e => {
-    onMessage(JSON.parse(e.data));
+    const data = JSON.parse(e.data);
+    if (data.type === 'event_batch') {
+      data.events.forEach(onMessage);
+    } else {
+      onMessage(data);
+    }
   };
 
   ws.onclose = e => {
@@ -0,0 +1,93 @@
+#! /usr/bin/env awx-python
+
+#
+# Compare the JSON codecs available to AWX (see awx.main.utils.codec) by
+# encoding and decoding job event payloads the way the dispatcher, callback
+# receiver, and websocket emitter do.
+#
+# usage: benchmark_json_codecs.py [--events N] [--hosts N] [--repeat N]
+#
+
+import argparse
+import datetime
+import os
+import timeit
+from uuid import uuid4
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'awx.settings.development')
+
+import django  # noqa
+django.setup()
+
+from django.core.serializers.json import DjangoJSONEncoder  # noqa
+
+from awx.main.queue import AnsibleJSONEncoder  # noqa
+from awx.main.utils.codec import CODECS  # noqa
+
+
+def generate_event(i, hosts):
+    # roughly the shape of a runner_on_ok event for a module that returns a
+    # modest amount of data
+    return {
+        'uuid': str(uuid4()),
+        'parent_uuid': str(uuid4()),
+        'counter': i,
+        'job_id': 1,
+        'event': 'runner_on_ok',
+        'stdout': 'ok: [host-{}] => {{"changed": false, "ping": "pong"}}'.format(i % hosts),
+        'start_line': i,
+        'end_line': i + 1,
+        'created': datetime.datetime.utcnow().isoformat(),
+        'event_data': {
+            'host': 'host-{}'.format(i % hosts),
+            'task': 'Gather some facts',
+            'task_action': 'setup',
+            'play': 'all',
+            'res': {
+                'changed': False,
+                'ansible_facts': dict(
+                    ('fact_{}'.format(n), {'value': n, 'items': list(range(10))})
+                    for n in range(25)
+                ),
+            },
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', type=int, default=1000, help='number of events per iteration')
+    parser.add_argument('--hosts', type=int, default=100, help='number of distinct hosts')
+    parser.add_argument('--repeat', type=int, default=5, help='number of iterations')
+    params = parser.parse_args()
+
+    events = [generate_event(i, params.hosts) for i in range(params.events)]
+    websocket_events = [
+        dict(e, created=datetime.datetime.utcnow()) for e in events
+    ]
+
+    print('{:<8} {:>18} {:>18} {:>18}'.format('codec', 'dispatch (ev/s)', 'receive (ev/s)', 'websocket (ev/s)'))
+    for name, codec in sorted(CODECS.items()):
+        encoded = [codec.dumps(e, cls=AnsibleJSONEncoder) for e in events]
+
+        def dispatch():
+            for e in events:
+                codec.dumps(e, cls=AnsibleJSONEncoder)
+
+        def receive():
+            for e in encoded:
+                codec.loads(e)
+
+        def websocket():
+            for e in websocket_events:
+                codec.dumps(e, cls=DjangoJSONEncoder)
+
+        rates = [
+            params.events / min(timeit.repeat(fn, number=1, repeat=params.repeat))
+            for fn in (dispatch, receive, websocket)
+        ]
+        print('{:<8} {:>18,.0f} {:>18,.0f} {:>18,.0f}'.format(name, *rates))
+
+
+if __name__ == '__main__':
+    main()